@@ -12,6 +12,7 @@ TMUX_LAYOUT = OrderedDict({
   'Started':  {'width':   TMUX_SIDE_WIDTH,  'Check': True},
   'Progress': {'width':   TMUX_SIDE_WIDTH,  'Check': True},
 })
+TMUX_SESSIONS_WIDTH = 42
 
 # ddrescue
 AUTO_PASS_THRESHOLDS = {
@@ -26,6 +27,7 @@ DDRESCUE_SETTINGS = {
     '--data-preview':     {'Selected': True,  'Value': '5', 'Hidden': True, },
     '--idirect':          {'Selected': True,                                },
     '--odirect':          {'Selected': True,                                },
+    '--mapfile-interval': {'Selected': True,  'Value': '10', 'Hidden': True,},
     '--max-error-rate':   {'Selected': True,  'Value': '100MiB',            },
     '--max-read-rate':    {'Selected': False, 'Value': '1MiB',              },
     '--min-read-rate':    {'Selected': True,  'Value': '64KiB',             },
@@ -49,7 +51,26 @@ DDRESCUE_SETTINGS = {
     '--timeout':          {'Selected': False, 'Value': '30m',               },
     },
   }
+# NOTE: Free space gaps smaller than this are rescued with the used space
+DOMAIN_MERGE_GAP = 1024**2
 DRIVE_POWEROFF_TIMEOUT = 90
+# NOTE: Health checks are polled faster while SMART attributes are changing.
+#       They're only polled slower than HEALTH_CHECK_INTERVAL while stable
+#       if HEALTH_CHECK_ADAPTIVE is enabled.
+HEALTH_CHECK_ADAPTIVE = False
+HEALTH_CHECK_INTERVAL = 30
+HEALTH_CHECK_INTERVAL_MAX = 120
+HEALTH_CHECK_INTERVAL_MIN = 5
+HEALTH_CHECK_STOP_TIMEOUT = 5
+LOCAL_MAP_DIR = '/tmp/ddrescue-tui-maps'
+# NOTE: Map files are parsed natively, enable this to also run ddrescuelog
+#       and log any differences. (debugging only)
+MAP_CROSS_CHECK = False
+SESSION_DIR = '/tmp/ddrescue-tui-sessions'
+# NOTE: Throughput is sampled when the map is saved, keep this in sync with
+#       the --mapfile-interval setting above
+THROUGHPUT_SAMPLE_INTERVAL = 10
+THROUGHPUT_SLOWDOWN_FACTOR = 0.25
 PARTITION_TYPES = {
   'GPT': {
     'NTFS':   'EBD0A0A2-B9E5-4433-87C0-68B6B72699C7', # Basic Data Partition
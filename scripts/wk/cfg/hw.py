@@ -19,6 +19,18 @@ BADBLOCKS_LARGE_DISK = 3 * 1024**4
 CPU_CRITICAL_TEMP = 99
 CPU_FAILURE_TEMP = 90
 CPU_TEST_MINUTES = 7
+# NOTE: Stress tests are stopped early if CPU temps are projected to reach
+#       CPU_CRITICAL_TEMP within CPU_THERMAL_GUARD_HORIZON seconds. The
+#       projection must hold for CPU_THERMAL_GUARD_HOLD seconds after temps
+#       have been above CPU_THERMAL_GUARD_MIN_TEMP for a full slope window,
+#       and slopes above CPU_THERMAL_GUARD_MAX_SLOPE (°C/s) are ignored as
+#       load steps (e.g. Prime95 starting).
+CPU_THERMAL_GUARD_HOLD = 1
+CPU_THERMAL_GUARD_HORIZON = 5
+CPU_THERMAL_GUARD_MAX_SLOPE = 5
+CPU_THERMAL_GUARD_MIN_TEMP = 85
+CPU_THERMAL_GUARD_WINDOW = 2
+DISK_DISCOVERY_THREADS = 8
 KEY_NVME = 'nvme_smart_health_information_log'
 KEY_SMART = 'ata_smart_attributes'
 KNOWN_DISK_ATTRIBUTES = {
@@ -63,6 +75,14 @@ KNOWN_RAM_VENDOR_IDS = {
 REGEX_POWER_ON_TIME = re.compile(
   r'^(\d+)([Hh].*|\s+\(\d+\s+\d+\s+\d+\).*)'
   )
+# NOTE: Temp history is a ring buffer, the running stats cover all temps
+SENSORS_EWMA_ALPHA = 0.2
+SENSORS_HISTORY_SIZE = 4096
+# NOTE: Temps are polled faster when read directly from hwmon
+SENSORS_POLL_INTERVAL = 0.05
+SENSORS_REPORT_INTERVAL = 0.5
+# NOTE: Full SMART details are reused for this long (in seconds)
+SMART_CACHE_SECONDS = 10
 SMC_IDS = {
   # Sources:  https://github.com/beltex/SMCKit/blob/master/SMCKit/SMC.swift
   #           http://www.opensource.apple.com/source/net_snmp/
@@ -119,6 +139,15 @@ TEMP_COLORS = {
   90:             'RED',
   100:            'ORANGE_RED',
   }
+# NOTE: Sampled scans read random regions from each stratum until time runs out
+SAMPLED_SCAN_REGION_SIZE = 1024**2
+SAMPLED_SCAN_SECONDS = 5 * 60
+SAMPLED_SCAN_STRATA = 1024
+# NOTE: Surface scans stop after SURFACE_SCAN_MAX_BAD_SECTORS (like badblocks -e)
+SURFACE_SCAN_CHECKPOINT_DIR = '~/.cache/wizardkit/surface_scan'
+SURFACE_SCAN_CHECKPOINT_INTERVAL = 60
+SURFACE_SCAN_CHUNK_SIZE = 8 * 1024**2
+SURFACE_SCAN_MAX_BAD_SECTORS = 1
 TESTSTATION_FILE = '/run/archiso/bootmnt/teststation.name'
 # THRESHOLDS: Rates used to determine HDD/SSD pass/fail
 THRESH_HDD_MIN =       50 * 1024**2
@@ -127,6 +156,16 @@ THRESH_HDD_AVG_LOW =   65 * 1024**2
 THRESH_SSD_MIN =       90 * 1024**2
 THRESH_SSD_AVG_HIGH = 135 * 1024**2
 THRESH_SSD_AVG_LOW =  100 * 1024**2
+# THRESHOLDS: Random read IOPS and latency (in seconds) at queue depth 1
+THRESH_HDD_IOPS_MIN =         40
+THRESH_HDD_LATENCY_P99 =      0.150
+THRESH_HDD_LATENCY_P999 =     0.500
+THRESH_SSD_IOPS_MIN =       1500
+THRESH_SSD_LATENCY_P99 =      0.005
+THRESH_SSD_LATENCY_P999 =     0.050
+LATENCY_BLOCK_SIZE = 4096
+LATENCY_QUEUE_DEPTHS = (1, 8)
+LATENCY_TEST_DURATION = 10 # Seconds per queue depth
 TMUX_SIDE_WIDTH = 20
 TMUX_LAYOUT = OrderedDict({
   'Top':            {'height':  2,                'Check': True},
@@ -137,6 +176,7 @@ TMUX_LAYOUT = OrderedDict({
   'Prime95':        {'height':  11,               'Check': False},
   'SMART':          {'height':  4,                'Check': True},
   'badblocks':      {'height':  5,                'Check': True},
+  'Sampled Scan':   {'height':  5,                'Check': True},
   'I/O Benchmark':  {'height':  1000,             'Check': False},
   })
 
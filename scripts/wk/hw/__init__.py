@@ -2,5 +2,6 @@
 
 from . import ddrescue
 from . import diags
+from . import fs_bitmap
 from . import obj
 from . import sensors
@@ -3,26 +3,37 @@
 # vim: sts=2 sw=2 ts=2
 
 import atexit
+import bisect
+import csv
 import datetime
+import fcntl
 import json
 import logging
 import math
 import os
 import pathlib
 import plistlib
+import pty
+import queue
 import re
+import shlex
 import shutil
+import struct
 import subprocess
+import sys
+import threading
 import time
 
+from array import array
 from collections import OrderedDict
 from docopt import docopt
 
 import psutil
 import pytz
 
-from wk import cfg, debug, exe, io, log, net, std, tmux
+from wk import cfg, debug, exe, graph, io, log, net, std, tmux
 from wk.cfg.ddrescue import DDRESCUE_SETTINGS
+from wk.hw import fs_bitmap
 from wk.hw import obj as hw_obj
 
 
@@ -32,12 +43,15 @@ DOCSTRING = f'''{cfg.main.KIT_NAME_FULL}: ddrescue TUI
 Usage:
   ddrescue-tui
   ddrescue-tui [options] (clone|image) [<source> [<destination>]]
+  ddrescue-tui [options] sessions
   ddrescue-tui (-h | --help)
 
 Options:
   -h --help           Show this page
   -s --dry-run        Print commands to be used instead of running them
   --force-local-map   Skip mounting shares and save map to local drive
+  --local-map         Save map locally and mirror it to the working dir
+  --mirror=<path>     Also copy rescued data to image(s) in this directory
   --start-fresh       Ignore previous runs and start new recovery
 '''
 DETECT_DRIVES_NOTICE = '''
@@ -67,16 +81,19 @@ DDRESCUE_LOG_REGEX = re.compile(
   r'.*\(\s*(?P<percent>\d+\.?\d*)%\)$',
   re.IGNORECASE,
   )
-REGEX_REMAINING_TIME = re.compile(
-  r'remaining time:'
-  r'\s*((?P<days>\d+)d)?'
-  r'\s*((?P<hours>\d+)h)?'
-  r'\s*((?P<minutes>\d+)m)?'
-  r'\s*((?P<seconds>\d+)s)?'
-  r'\s*(?P<na>n/a)?',
-  re.IGNORECASE
-  )
+DDRESCUE_STATUS_KEY_REGEX = re.compile(r'^[a-z][a-z -]*$')
+DDRESCUE_TIME_REGEX = re.compile(r'(?P<value>\d+)\s*(?P<unit>[dhms])')
 LOG = logging.getLogger(__name__)
+# NOTE: Maps modified more recently than this (in seconds) are always parsed
+#       again since the mtime may not have changed between writes.
+MAP_CACHE_MIN_AGE = 2
+MAP_STATUS_NAMES = {
+  '?': 'non-tried',
+  '*': 'non-trimmed',
+  '/': 'non-scraped',
+  '-': 'bad-sector',
+  '+': 'rescued',
+  }
 MENU_ACTIONS = (
   'Start',
   f'Change settings {std.color_string("(experts only)", "YELLOW")}',
@@ -85,13 +102,16 @@ MENU_ACTIONS = (
 MENU_TOGGLES = {
   'Auto continue (if recovery % over threshold)': True,
   'Retry (mark non-rescued sectors "non-tried")': False,
+  'Rescue used space first (NTFS/ext2/3/4 partitions only)': False,
   }
+PASS_NAMES = ('read', 'trim', 'scrape')
 PANE_RATIOS = (
   12, # SMART
   22, # ddrescue progress
   4,  # Journal (kernel messages)
   )
 PLATFORM = std.PLATFORM
+REGEX_ANSI_ESCAPE = re.compile(r'\x1b(\[[0-9;?]*[A-Za-z]|[()][0-9A-Za-z]|[=>])')
 RECOMMENDED_FSTYPES = re.compile(r'^(ext[234]|ntfs|xfs)$')
 if PLATFORM == 'Darwin':
   RECOMMENDED_FSTYPES = re.compile(r'^(apfs|hfs.?)$')
@@ -124,8 +144,15 @@ class BlockPair():
     """
     self.source = source.path
     self.destination = destination
+    self.domain_map_path = None
     self.map_data = {}
+    self.map_mtime = None
     self.map_path = None
+    self.map_stat = None
+    self.mirror_map_path = None
+    self.mirror_path = None
+    self.share_map_path = None
+    self.share_rates_path = None
     self.size = source.details['size']
     self.status = OrderedDict({
       'read': 'Pending',
@@ -158,11 +185,87 @@ class BlockPair():
     else:
       # Cloning
       self.map_path = pathlib.Path(f'{working_dir}/Clone_{map_name}.map')
-    self.map_path.touch()
+    if not self.map_path.exists():
+      # NOTE: Existing maps keep their mtime, see use_local_map()
+      self.map_path.touch()
+    self.throughput = ThroughputRecorder(
+      self.map_path.with_suffix('.rates.csv'),
+      )
 
     # Set initial status
     self.set_initial_status()
 
+  def create_domain_map(self):
+    """Create domain map using the filesystem allocation bitmap.
+
+    Filesystem metadata is read from the destination if it has already
+    been rescued, otherwise it is read from the source.
+
+    NOTE: self.domain_map_path is left as None if the filesystem is
+          unsupported or the metadata couldn't be read.
+    """
+    domain_map_path = self.map_path.with_suffix('.domain.map')
+    files = {}
+    rescued_ends = []
+    rescued_starts = []
+    for pos, size, status in get_map_blocks(self.map_path):
+      if status == '+':
+        rescued_starts.append(pos)
+        rescued_ends.append(pos + size)
+    self.domain_map_path = None
+
+    def _read(offset, length):
+      """Read data from destination if rescued, otherwise the source.
+
+      NOTE: If a path can't be opened directly then sudo dd is used for
+            it from then on.
+      """
+      path = self.source
+      index = bisect.bisect_right(rescued_starts, offset) - 1
+      if index >= 0 and offset + length <= rescued_ends[index]:
+        path = self.destination
+      try:
+        if files.get(path, False) is None:
+          raise PermissionError(f'Permission denied: {path}')
+        if path not in files:
+          files[path] = None
+          files[path] = open(path, 'rb') # pylint: disable=consider-using-with
+        data = os.pread(files[path].fileno(), length, offset)
+      except PermissionError:
+        proc = exe.run_program(
+          ['sudo', 'dd', f'if={path}', f'bs={length}', f'skip={offset}',
+           'count=1', 'iflag=skip_bytes'],
+          encoding=None,
+          )
+        data = proc.stdout
+      if len(data) < length:
+        raise OSError(f'Failed to read {length} bytes at {offset} from {path}')
+      return data
+
+    # Get allocated ranges
+    try:
+      ranges = fs_bitmap.get_allocated_ranges(_read)
+    except fs_bitmap.UnsupportedFilesystemError as err:
+      LOG.warning('Domain map not created for %s: %s', self.source, err)
+      return
+    except (OSError, struct.error, subprocess.CalledProcessError) as err:
+      LOG.error(
+        'Failed to read filesystem metadata from %s: %s', self.source, err,
+        )
+      return
+    finally:
+      for _f in files.values():
+        if _f:
+          _f.close()
+    ranges = fs_bitmap.merge_ranges(ranges, cfg.ddrescue.DOMAIN_MERGE_GAP)
+    if not ranges:
+      LOG.warning('No allocated areas found for %s', self.source)
+      return
+
+    # Save domain map
+    write_domain_map(domain_map_path, ranges, self.size)
+    self.domain_map_path = domain_map_path
+
   def get_error_size(self):
     """Get error size in bytes, returns int."""
     return self.size - self.get_rescued_size()
@@ -184,6 +287,39 @@ class BlockPair():
 
     NOTE: If the file is missing it is assumed that recovery hasn't
           started yet so default values will be returned instead.
+          The file is only parsed again if it has changed since the last
+          call, see MAP_CACHE_MIN_AGE.
+    """
+    stat_key = None
+    try:
+      map_stat = self.map_path.stat()
+    except FileNotFoundError:
+      map_stat = None
+
+    # Skip parsing if the map hasn't changed
+    self.map_mtime = map_stat.st_mtime if map_stat else None
+    if map_stat:
+      stat_key = (map_stat.st_ino, map_stat.st_size, map_stat.st_mtime_ns)
+      if stat_key == self.map_stat:
+        return
+      if time.time() - map_stat.st_mtime < MAP_CACHE_MIN_AGE:
+        # Timestamp too recent to trust, parse again next time
+        stat_key = None
+
+    # Parse map
+    data = parse_map_file(self.map_path, self.size)
+    if cfg.ddrescue.MAP_CROSS_CHECK:
+      compare_map_data(data, self.load_map_data_ddrescuelog())
+
+    # Done
+    self.map_data.clear()
+    self.map_data.update(data)
+    self.map_stat = stat_key
+
+  def load_map_data_ddrescuelog(self):
+    """Load map data using ddrescuelog, returns dict.
+
+    NOTE: This is only used to cross-check parse_map_file().
     """
     data = {'full recovery': False, 'pass completed': False}
 
@@ -223,7 +359,7 @@ class BlockPair():
       data['full recovery'] = proc.returncode == 0
 
     # Done
-    self.map_data.update(data)
+    return data
 
   def pass_complete(self, pass_name):
     """Check if pass_num is complete based on map data, returns bool."""
@@ -249,6 +385,34 @@ class BlockPair():
     # Done
     return complete
 
+  def record_throughput(self, pass_name, map_data, status=None):
+    """Record throughput sample using the map data.
+
+    map_data should be the map data already loaded for this update
+    (e.g. from update_progress()) so the map isn't parsed again.
+
+    NOTE: The sizes are read from the map since the ddrescue status is
+          rounded for display. The status is only used for the position.
+          A sample is only added if the map was written since the last one.
+    """
+    timestamp = self.map_mtime
+    if timestamp is None or 'rescued' not in map_data:
+      # Map hasn't been written yet
+      return
+    if self.throughput.times and self.throughput.times[-1] >= timestamp:
+      # Map hasn't changed
+      return
+    pos = -1
+    if status and status.current_pos is not None:
+      pos = status.current_pos
+    self.throughput.add_sample(
+      pass_name,
+      map_data['rescued'],
+      pos,
+      map_data['bad-sector'],
+      timestamp=timestamp,
+      )
+
   def safety_check(self):
     """Run safety check and abort if necessary."""
     dest_size = -1
@@ -275,13 +439,87 @@ class BlockPair():
           self.status[name] = percent
         break
 
+  def set_mirror(self, mirror_dir):
+    """Set mirror image and map paths using mirror_dir."""
+    self.mirror_path = pathlib.Path(
+      f'{mirror_dir}/Mirror_{self.map_path.stem}.dd',
+      )
+    self.mirror_map_path = self.mirror_path.with_suffix('.map')
+
   def skip_pass(self, pass_name):
     """Mark pass as skipped if applicable."""
     if self.status[pass_name] == 'Pending':
       self.status[pass_name] = 'Skipped'
 
+  def use_local_map(self, local_dir):
+    """Use local map file that will be mirrored to the current map path.
+
+    NOTE: If both copies exist then the newer valid copy is used.
+          Copies keep their original mtime (see MapMirror.sync()) so
+          the local map isn't touched unless it's missing.
+    """
+    local_path = pathlib.Path(f'{local_dir}/{self.map_path.name}')
+    local_rates_path = local_path.with_suffix('.rates.csv')
+    self.share_map_path = self.map_path
+    self.share_rates_path = self.throughput.csv_path
+
+    # Select newer valid copy
+    copies = [
+      path for path in (local_path, self.share_map_path)
+      if path.exists() and 'non-tried' in parse_map_file(path, self.size)
+      ]
+    newest = max(copies, key=lambda path: path.stat().st_mtime, default=None)
+    if newest == self.share_map_path:
+      LOG.info('Resuming using map: %s', newest)
+      shutil.copy2(self.share_map_path, local_path)
+      if self.share_rates_path.exists():
+        shutil.copy2(self.share_rates_path, local_rates_path)
+    if not local_path.exists():
+      local_path.touch()
+
+    # Update map data and throughput samples
+    self.map_data = {}
+    self.map_mtime = None
+    self.map_path = local_path
+    self.map_stat = None
+    self.set_initial_status()
+    self.throughput = ThroughputRecorder(local_rates_path)
+
+  def update_mirror(self, dry_run=True):
+    """Copy rescued data from the destination to the mirror image.
+
+    The map file is used as the domain so only rescued areas are copied
+    and the source isn't read again.
+    """
+    cmd = [
+      'sudo', 'ddrescue', '--binary-prefixes', '--quiet',
+      f'--domain-mapfile={self.map_path}',
+      f'--size={self.size}',
+      self.destination, self.mirror_path, self.mirror_map_path,
+      ]
+    if dry_run:
+      LOG.info('Mirror cmd: %s', cmd)
+      return
+
+    # Copy rescued data
+    proc = exe.run_program(cmd, check=False)
+    if proc.returncode:
+      LOG.error('Failed to update mirror: %s', proc.stderr)
+      std.print_error(f'Failed to update mirror: {self.mirror_path}')
+      return
+
+    # Verify mirror map
+    mirror_rescued = parse_map_file(self.mirror_map_path, self.size).get(
+      'rescued', 0,
+      )
+    if mirror_rescued != self.get_rescued_size():
+      std.print_warning(
+        f'Mirror is missing {self.get_rescued_size() - mirror_rescued} '
+        f'rescued bytes: {self.mirror_path}',
+        )
+
   def update_progress(self, pass_name):
-    """Update progress via map data."""
+    """Update progress via map data, returns dict."""
     self.load_map_data()
 
     # Update status
@@ -296,16 +534,333 @@ class BlockPair():
       if pass_name in ('read', 'trim'):
         self.status['scrape'] = 'Skipped'
 
+    # Done
+    return self.map_data
+
+
+class DDRescueStatus():
+  # pylint: disable=too-many-instance-attributes
+  """Object for tracking the live status reported by ddrescue.
+
+  NOTE: Sizes are in bytes, rates in bytes per second, and times in seconds.
+        Values that haven't been reported (or are n/a) are set to None.
+  """
+  def __init__(self):
+    self.average_rate = None
+    self.current_pos = None
+    self.current_rate = None
+    self.errors = None
+    self.errsize = None
+    self.fields = {}
+    self.last_successful_read = None
+    self.remaining_time = None
+    self.rescued = None
+    self.updated = None
+    self._buffer = ''
+
+  def _update_field(self, key, value):
+    """Update typed attribute(s) using ddrescue key and value."""
+    if key == 'ipos':
+      self.current_pos = std.string_to_bytes(value)
+    elif key == 'current rate':
+      self.current_rate = std.string_to_bytes(value.replace('/s', ''))
+    elif key == 'average rate':
+      self.average_rate = std.string_to_bytes(value.replace('/s', ''))
+    elif key == 'errsize':
+      self.errsize = std.string_to_bytes(value)
+    elif key in ('non-trimmed', 'non-scraped', 'bad-sector'):
+      # NOTE: Newer ddrescue versions don't report errsize directly
+      self.errsize = sum(
+        std.string_to_bytes(self.fields[k])
+        for k in ('non-trimmed', 'non-scraped', 'bad-sector')
+        if k in self.fields
+        )
+    elif key in ('errors', 'read errors'):
+      self.errors = int(value)
+    elif key in ('successful read', 'time since last successful read'):
+      self.last_successful_read = parse_ddrescue_time(value.replace('ago', ''))
+    elif key == 'remaining time':
+      self.remaining_time = parse_ddrescue_time(value)
+    elif key == 'rescued':
+      self.rescued = std.string_to_bytes(value)
+
+  def feed(self, data):
+    """Parse raw ddrescue output."""
+    text = REGEX_ANSI_ESCAPE.sub('', data.decode('utf-8', errors='ignore'))
+    self._buffer += text.replace('\r', '\n')
+    *lines, self._buffer = self._buffer.split('\n')
+    for line in lines:
+      self.parse_line(line)
+
+  def monitor(self, pty_fd, mirror_fd=None):
+    """Read ddrescue output from pty_fd until closed.
+
+    The raw output is also written to mirror_fd (default: stdout)
+    so ddrescue is still shown as usual.
+
+    NOTE: This should be called as a thread.
+    """
+    if mirror_fd is None:
+      mirror_fd = sys.stdout.fileno()
+    while True:
+      try:
+        data = os.read(pty_fd, 4096)
+      except OSError:
+        # Assuming ddrescue exited and the pty was closed (EIO)
+        break
+      if not data:
+        break
+      os.write(mirror_fd, data)
+      self.feed(data)
+    os.close(pty_fd)
+
+  def parse_line(self, line):
+    """Parse status line, e.g. "ipos: 1048 kB, non-trimmed: 0 B, [...]"."""
+    for item in line.split(','):
+      key, _, value = item.partition(':')
+      key = key.strip().lower()
+      value = value.strip()
+      if not (value and DDRESCUE_STATUS_KEY_REGEX.match(key)):
+        continue
+      self.fields[key] = value
+      try:
+        self._update_field(key, value)
+      except ValueError:
+        LOG.error('Failed to parse ddrescue status: %s: %s', key, value)
+        continue
+      self.updated = time.time()
+
+
+class HealthMonitor():
+  """Object for checking source and destination health in the background.
+
+  Each device is polled in a separate thread so a slow or hung smartctl
+  call never blocks the ddrescue loop. The interval is shortened while
+  SMART attributes are changing and lengthened while they're stable
+  (up to HEALTH_CHECK_INTERVAL unless HEALTH_CHECK_ADAPTIVE is enabled).
+  Problems are published to self.queue as (name, message) tuples and
+  fileno() becomes ready to read until they're retrieved.
+  """
+  def __init__(self, state):
+    self.queue = queue.Queue()
+    self.state = state
+    self._read_fd, self._write_fd = os.pipe()
+    self._stop_event = threading.Event()
+    self._threads = []
+    os.set_blocking(self._read_fd, False)
+
+  def _check_destination(self):
+    """Check destination health, returns dict of attribute values."""
+    message = check_destination_health(self.state.destination)
+    if message:
+      self._publish('Destination', message)
+    return get_attribute_values(self.state.destination)
+
+  def _check_source(self):
+    """Update SMART pane, returns dict of attribute values."""
+    source = self.state.source
+    source.update_smart_details(max_age=0)
+    now = datetime.datetime.now(tz=TIMEZONE).strftime('%Y-%m-%d %H:%M %Z')
+    with open(f'{self.state.log_dir}/smart.out', 'w', encoding='utf-8') as _f:
+      _f.write(
+        std.color_string(
+          ['SMART Attributes', f'Updated: {now}\n'],
+          ['BLUE', 'YELLOW'],
+          sep='\t\t',
+          ),
+        )
+      _f.write('\n'.join(source.generate_report(header=False)))
+    return get_attribute_values(source)
+
+  def _poll(self, check_func):
+    """Run check_func on a loop using an adaptive interval.
+
+    NOTE: This should be called as a thread.
+    """
+    interval = cfg.ddrescue.HEALTH_CHECK_INTERVAL
+    max_interval = cfg.ddrescue.HEALTH_CHECK_INTERVAL
+    if cfg.ddrescue.HEALTH_CHECK_ADAPTIVE:
+      max_interval = cfg.ddrescue.HEALTH_CHECK_INTERVAL_MAX
+    previous_values = None
+    while not self._stop_event.is_set():
+      try:
+        values = check_func()
+      except Exception: # pylint: disable=broad-except
+        LOG.exception('Health check failed: %s', check_func.__name__)
+        values = previous_values
+
+      # Adjust interval
+      if previous_values is not None and values != previous_values:
+        interval = max(cfg.ddrescue.HEALTH_CHECK_INTERVAL_MIN, interval / 2)
+      else:
+        interval = min(max_interval, interval * 1.5)
+      previous_values = values
+      self._stop_event.wait(interval)
+
+  def _publish(self, name, message):
+    """Publish message and wake up anything waiting on fileno()."""
+    self.queue.put((name, message))
+    try:
+      os.write(self._write_fd, b'\0')
+    except OSError:
+      # Already stopped
+      pass
+
+  def fileno(self):
+    """Get fd that's ready to read while messages are pending, returns int."""
+    return self._read_fd
+
+  def get_messages(self):
+    """Get published messages without blocking, returns list."""
+    messages = []
+    try:
+      while os.read(self._read_fd, 4096):
+        pass
+    except BlockingIOError:
+      pass
+    while True:
+      try:
+        messages.append(self.queue.get_nowait())
+      except queue.Empty:
+        break
+    return messages
+
+  def start(self):
+    """Start polling threads."""
+    self._stop_event.clear()
+    self._threads = [
+      exe.start_thread(self._poll, [self._check_source]),
+      exe.start_thread(self._poll, [self._check_destination]),
+      ]
+
+  def stop(self):
+    """Stop polling threads.
+
+    NOTE: Threads stuck in a smartctl call for longer than
+          HEALTH_CHECK_STOP_TIMEOUT are left to exit on their own.
+    """
+    self._stop_event.set()
+    deadline = time.monotonic() + cfg.ddrescue.HEALTH_CHECK_STOP_TIMEOUT
+    for thread in self._threads:
+      thread.join(timeout=max(deadline - time.monotonic(), 0))
+      if thread.is_alive():
+        LOG.warning('Health check thread still running after stop')
+        return
+    self._threads.clear()
+    os.close(self._read_fd)
+    os.close(self._write_fd)
+
+
+class MapMirror():
+  """Object for mirroring local map files to the working dir.
+
+  ddrescue only writes to the local map files so it never waits on the
+  network. Changed maps are copied to the working dir (e.g. the backup
+  share) in the background and replaced atomically along with the
+  throughput samples.
+  """
+  def __init__(self, block_pairs):
+    self.block_pairs = block_pairs
+    self.synced = {}
+    self._lock = threading.Lock()
+    self._stop_event = threading.Event()
+    self._thread = None
+    self._watcher = io.FileWatcher(*[pair.map_path for pair in block_pairs])
+
+  def __getstate__(self):
+    """Exclude locks and threads when pickling (e.g. debug reports)."""
+    return {
+      key: value for key, value in self.__dict__.items()
+      if not key.startswith('_')
+      }
+
+  def _mirror_loop(self):
+    """Sync map files whenever they change.
+
+    NOTE: This should be called as a thread.
+    """
+    while not self._stop_event.is_set():
+      if self._watcher.wait(timeout=1):
+        self.sync()
+
+  def start(self):
+    """Start mirroring map files."""
+    self.sync()
+    self._thread = exe.start_thread(self._mirror_loop)
+
+  def stop(self):
+    """Stop mirroring map files after a final sync."""
+    self._stop_event.set()
+    if self._thread:
+      self._thread.join(timeout=5)
+    self._watcher.close()
+    self.sync()
+
+  def sync(self):
+    """Copy changed map files to the working dir.
+
+    ddrescue rewrites the map in place so the copy is checked instead
+    of the source. If the copy is invalid or the map changed during the
+    copy then it's dropped and retried on the next sync.
+    """
+    with self._lock:
+      for pair in self.block_pairs:
+        try:
+          stat = pair.map_path.stat()
+        except FileNotFoundError:
+          continue
+        key = (stat.st_mtime_ns, stat.st_size)
+        if self.synced.get(pair.map_path) == key:
+          continue
+
+        # Copy to temp file
+        tmp_path = pair.share_map_path.with_name(
+          f'{pair.share_map_path.name}.tmp',
+          )
+        try:
+          shutil.copy2(pair.map_path, tmp_path)
+          stat = pair.map_path.stat()
+        except OSError as err:
+          LOG.error('Failed to mirror map %s: %s', pair.map_path, err)
+          continue
+
+        # Skip empty or partially written maps
+        copy_ok = (stat.st_mtime_ns, stat.st_size) == key
+        if copy_ok:
+          copy_ok = 'non-tried' in parse_map_file(tmp_path, pair.size)
+        if not copy_ok:
+          tmp_path.unlink(missing_ok=True)
+          continue
+
+        # Replace map and throughput samples
+        try:
+          os.replace(tmp_path, pair.share_map_path)
+          if pair.throughput.csv_path.exists():
+            tmp_path = pair.share_rates_path.with_name(
+              f'{pair.share_rates_path.name}.tmp',
+              )
+            shutil.copy2(pair.throughput.csv_path, tmp_path)
+            os.replace(tmp_path, pair.share_rates_path)
+        except OSError as err:
+          LOG.error('Failed to mirror map %s: %s', pair.map_path, err)
+          continue
+        self.synced[pair.map_path] = key
+
 
 class State():
   # pylint: disable=too-many-public-methods
   """Object for tracking hardware diagnostic data."""
   def __init__(self):
     self.block_pairs = []
+    self.ddrescue_status = None
     self.destination = None
     self.log_dir = None
+    self.map_mirror = None
+    self.mirror_dir = None
     self.mode = None
     self.panes = {}
+    self.session = {}
+    self.session_path = None
     self.source = None
     self.working_dir = None
 
@@ -361,13 +916,11 @@ class State():
         tmux.resize_pane(self.panes['Journal'], height=p_ratios[2])
 
   def _fix_tmux_layout_loop(self):
-    """Fix tmux layout on a loop.
+    """Fix tmux layout whenever it changes.
 
     NOTE: This should be called as a thread.
     """
-    while True:
-      self._fix_tmux_layout(forced=False)
-      std.sleep(1)
+    tmux.watch_layout(lambda: self._fix_tmux_layout(forced=False))
 
   def _init_tmux(self):
     """Initialize tmux layout."""
@@ -526,6 +1079,70 @@ class State():
       bp_dest = self.destination
       self._add_block_pair(part, bp_dest)
 
+  def claim_devices(self):
+    """Claim source and destination devices for this session.
+
+    Sessions are tracked in cfg.ddrescue.SESSION_DIR so concurrent
+    sessions never share a source or destination device. Image
+    directories are claimed by path as well since several sessions can
+    use the same share. Sessions can share a mirror directory since the
+    mirror images are named after each source.
+
+    NOTE: A GenericAbort is raised if a device is in use by another session.
+    """
+    conflicts = []
+    destination = getattr(self.destination, 'path', self.destination)
+    disk_ids = [get_disk_id(self.source.path), get_disk_id(destination)]
+    paths = []
+    if pathlib.Path(destination).is_dir():
+      paths.append(str(pathlib.Path(destination).resolve()))
+    if self.mirror_dir:
+      disk_ids.append(get_disk_id(self.mirror_dir))
+    session_dir = pathlib.Path(cfg.ddrescue.SESSION_DIR)
+    session_dir.mkdir(parents=True, exist_ok=True)
+    self.session = {
+      'pid': os.getpid(),
+      'source': str(self.source.path),
+      'destination': str(destination),
+      'disk_ids': disk_ids,
+      'paths': paths,
+      'status': 'Idle',
+      }
+
+    # Check for conflicts and claim devices
+    lock_path = session_dir.joinpath('sessions.lock')
+    with open(lock_path, 'w', encoding='utf-8') as lock_file:
+      fcntl.flock(lock_file, fcntl.LOCK_EX)
+      for session in get_sessions():
+        if session['pid'] == os.getpid():
+          continue
+        for name, disk_id in zip(('Source', 'Destination', 'Mirror'), disk_ids):
+          other_ids = session['disk_ids']
+          if name == 'Mirror':
+            # Only conflicts with the other session's source or destination
+            other_ids = other_ids[:2]
+          if disk_id and disk_id in other_ids:
+            conflicts.append(
+              f'{name} in use by another session '
+              f'({session["source"]} -> {session["destination"]})'
+              )
+        for path in paths:
+          if path in session.get('paths', []):
+            conflicts.append(
+              f'{path} in use by another session '
+              f'({session["source"]} -> {session["destination"]})'
+              )
+      if not conflicts:
+        self.session_path = session_dir.joinpath(f'{os.getpid()}.json')
+        self.save_session()
+        atexit.register(self.release_devices)
+
+    # Abort if necessary
+    if conflicts:
+      for line in conflicts:
+        std.print_error(line)
+      raise std.GenericAbort()
+
   def confirm_selections(self, prompt, source_parts=None):
     """Show selection details and prompt for confirmation."""
     report = []
@@ -620,6 +1237,8 @@ class State():
       report.append(f'Destination: {self.destination.description}')
     else:
       report.append(f'Destination: {self.destination}/')
+    if self.mirror_dir:
+      report.append(f'Mirror: {self.mirror_dir}/')
 
     # Overall
     report.append(' ')
@@ -648,6 +1267,14 @@ class State():
           f'error size: {error_size_str}'
           )
 
+    # Throughput
+    for pair in self.block_pairs:
+      throughput_report = pair.throughput.generate_report()
+      if throughput_report:
+        report.append(' ')
+        report.append(f'{pair.source.name} throughput:')
+        report.extend(throughput_report)
+
     # Done
     return report
 
@@ -711,12 +1338,22 @@ class State():
         self.destination = select_path('Destination')
     self.update_top_panes()
 
+    # Set mirror
+    if docopt_args['--mirror']:
+      self.mirror_dir = pathlib.Path(docopt_args['--mirror']).resolve()
+      if not self.mirror_dir.is_dir():
+        std.print_error(f'Invalid mirror directory: {self.mirror_dir}')
+        raise std.GenericAbort()
+
     # Confirmation #1
     self.confirm_selections(
       prompt='Are these selections correct?',
       source_parts=source_parts,
       )
 
+    # Claim devices
+    self.claim_devices()
+
     # Update panes
     self.panes['Progress'] = tmux.split_window(
       lines=cfg.ddrescue.TMUX_SIDE_WIDTH,
@@ -742,10 +1379,28 @@ class State():
       source_parts = select_disk_parts(self.mode, self.source)
       self.add_image_block_pairs(source_parts)
 
+    # Use local map(s) if requested
+    if docopt_args['--local-map']:
+      local_dir = pathlib.Path(
+        f'{cfg.ddrescue.LOCAL_MAP_DIR}/{self.working_dir.name}',
+        )
+      local_dir.mkdir(parents=True, exist_ok=True)
+      if docopt_args['--start-fresh']:
+        clean_working_dir(local_dir)
+      for pair in self.block_pairs:
+        pair.use_local_map(local_dir)
+      self.map_mirror = MapMirror(self.block_pairs)
+      self.map_mirror.start()
+      atexit.register(self.map_mirror.stop)
+
     # Safety Checks #1
     if self.mode == 'Clone':
       self.safety_check_destination()
     self.safety_check_size()
+    if self.mirror_dir:
+      for pair in self.block_pairs:
+        pair.set_mirror(self.mirror_dir)
+      self.safety_check_mirror()
 
     # Confirmation #2
     self.update_progress_pane('Idle')
@@ -898,30 +1553,29 @@ class State():
     settings['Needs Format'] = False
     self._save_settings(settings)
 
+  def release_devices(self):
+    """Release devices claimed by this session."""
+    if self.session_path:
+      self.session_path.unlink(missing_ok=True)
+      self.session_path = None
+
   def retry_all_passes(self):
     """Prep block_pairs for a retry recovery attempt."""
-    bad_statuses = ('*', '/', '-')
     LOG.warning('Updating block_pairs for retry')
 
     # Update all block_pairs
     for pair in self.block_pairs:
-      map_data = []
 
       # Reset status strings
       for name in pair.status.keys():
         pair.status[name] = 'Pending'
 
       # Mark all non-trimmed, non-scraped, and bad areas as non-tried
-      with open(pair.map_path, 'r', encoding='utf-8') as _f:
-        for line in _f.readlines():
-          line = line.strip()
-          if line.startswith('0x') and line.endswith(bad_statuses):
-            line = f'{line[:-1]}?'
-          map_data.append(line)
-
-      # Save updated map
-      with open(pair.map_path, 'w', encoding='utf-8') as _f:
-        _f.write('\n'.join(map_data))
+      try:
+        reset_map_for_retry(pair.map_path)
+      except (OSError, ValueError):
+        LOG.exception('Failed to reset map: %s', pair.map_path)
+        std.print_error(f'Failed to reset map: {pair.map_path}')
 
       # Reinitialize status
       pair.set_initial_status()
@@ -936,6 +1590,21 @@ class State():
         )
       raise std.GenericAbort() from err
 
+  def safety_check_mirror(self):
+    """Run mirror safety checks and abort if necessary."""
+    required_size = 0
+    for pair in self.block_pairs:
+      required_size += pair.size
+      if pair.mirror_path.exists():
+        # NOTE: This uses the "max space" like safety_check_size()
+        required_size -= pair.mirror_path.stat().st_size
+      if pair.destination.resolve() == pair.mirror_path.resolve():
+        std.print_error('The mirror must be separate from the destination')
+        raise std.GenericAbort()
+    if required_size > psutil.disk_usage(self.mirror_dir).free:
+      std.print_error('Not enough free space for the mirror')
+      raise std.GenericAbort()
+
   def safety_check_size(self):
     """Run size safety check and abort if necessary."""
     required_size = sum(pair.size for pair in self.block_pairs)
@@ -982,6 +1651,28 @@ class State():
       std.print_error(error_msg)
       raise std.GenericAbort()
 
+  def save_session(self, overall_status=None):
+    """Save session details used by the combined progress pane."""
+    if not self.session_path:
+      return
+
+    # Update details
+    if overall_status:
+      self.session['status'] = overall_status
+    self.session['rate'] = None
+    if self.block_pairs:
+      self.session['percent'] = self.get_percent_recovered()
+      self.session['rescued'] = self.get_rescued_size()
+    if self.ddrescue_status and self.session['status'] == 'Active':
+      self.session['rate'] = self.ddrescue_status.current_rate
+
+    # Write to file
+    # NOTE: The file is replaced to avoid partial reads by other sessions
+    tmp_path = self.session_path.with_suffix('.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as _f:
+      json.dump(self.session, _f)
+    os.replace(tmp_path, self.session_path)
+
   def save_debug_reports(self):
     """Save debug reports to disk."""
     LOG.info('Saving debug reports')
@@ -1054,7 +1745,7 @@ class State():
 
     # EToC
     if overall_status in ('Active', 'NEEDS ATTENTION'):
-      etoc = get_etoc()
+      etoc = get_etoc(self.ddrescue_status)
       report.append(separator)
       report.append(std.color_string('Estimated Pass Finish', 'BLUE'))
       if overall_status == 'NEEDS ATTENTION' or etoc == 'N/A':
@@ -1067,6 +1758,9 @@ class State():
     with open(out_path, 'w', encoding='utf-8') as _f:
       _f.write('\n'.join(report))
 
+    # Update session
+    self.save_session(overall_status)
+
   def update_top_panes(self):
     """(Re)create top source/destination panes."""
     source_exists = True
@@ -1142,6 +1836,158 @@ class State():
       )
 
 
+class ThroughputRecorder():
+  """Object for recording ddrescue throughput over time.
+
+  Samples are appended to a CSV file (e.g. next to the map file)
+  so the history is kept across runs.
+
+  NOTE: Sizes and positions are in bytes, positions are -1 if unknown.
+  """
+  def __init__(self, csv_path):
+    self.csv_path = pathlib.Path(csv_path)
+    self.errsizes = array('q')
+    self.passes = array('B')
+    self.positions = array('q')
+    self.rescued = array('q')
+    self.times = array('d')
+
+    # Load previous samples
+    self.load_samples()
+
+  def add_sample(self, pass_name, rescued, pos, errsize, timestamp=None):
+    """Add sample and append it to the CSV file."""
+    if timestamp is None:
+      timestamp = time.time()
+    self.errsizes.append(errsize)
+    self.passes.append(PASS_NAMES.index(pass_name))
+    self.positions.append(pos)
+    self.rescued.append(rescued)
+    self.times.append(timestamp)
+
+    # Save sample
+    try:
+      with open(self.csv_path, 'a', encoding='utf-8', newline='') as _f:
+        csv.writer(_f).writerow(
+          [f'{timestamp:.1f}', pass_name, rescued, pos, errsize],
+          )
+    except OSError:
+      LOG.error('Failed to save throughput sample to %s', self.csv_path)
+
+  def generate_report(self, graph_width=40):
+    """Generate rate graph(s) and slowdown report, returns list."""
+    report = []
+
+    for pass_name in PASS_NAMES:
+      rates = [rate for _, _, rate in self.get_rates(pass_name)]
+      if not rates:
+        continue
+
+      # Graph
+      report.append(std.color_string(f'{pass_name.title()} rate', 'BLUE'))
+      for line in graph.generate_horizontal_graph(
+          rates, graph_width=min(graph_width, len(rates))):
+        if std.strip_colors(line).strip():
+          report.append(f'  {line}')
+      report.append(
+        f'  avg: {std.bytes_to_string(sum(rates)/len(rates), 1)}/s'
+        f' min: {std.bytes_to_string(min(rates), 1)}/s'
+        f' max: {std.bytes_to_string(max(rates), 1)}/s'
+        )
+
+      # Slowdowns
+      for start, end, rate, median in self.get_slow_regions(pass_name):
+        report.append(
+          std.color_string(
+            [
+              '  Slow region:',
+              f'{std.bytes_to_string(start, 2)} -',
+              std.bytes_to_string(end, 2),
+              f'({std.bytes_to_string(rate, 1)}/s'
+              f' vs {std.bytes_to_string(median, 1)}/s median)',
+              ],
+            ['YELLOW', None, None, None],
+            ),
+          )
+
+    # Done
+    return report
+
+  def get_rates(self, pass_name):
+    """Get rates between consecutive samples for pass_name, returns list.
+
+    Each entry is (start_pos, end_pos, rate) with the rate in bytes/s.
+
+    NOTE: Samples too far apart (e.g. between separate runs) are skipped.
+    """
+    max_delta = 3 * cfg.ddrescue.THROUGHPUT_SAMPLE_INTERVAL
+    pass_index = PASS_NAMES.index(pass_name)
+    rates = []
+    for _i in range(1, len(self.times)):
+      if not self.passes[_i-1] == self.passes[_i] == pass_index:
+        continue
+      delta = self.times[_i] - self.times[_i-1]
+      if 0 < delta <= max_delta:
+        rates.append((
+          self.positions[_i-1],
+          self.positions[_i],
+          max(self.rescued[_i] - self.rescued[_i-1], 0) / delta,
+          ))
+
+    # Done
+    return rates
+
+  def get_slow_regions(self, pass_name):
+    """Find regions where the rate dropped sharply, returns list.
+
+    Each entry is (start_pos, end_pos, avg_rate, median_rate).
+    A region is flagged if the rate stayed below the median rate times
+    THROUGHPUT_SLOWDOWN_FACTOR for at least two consecutive samples.
+    """
+    rates = self.get_rates(pass_name)
+    regions = []
+    slow = []
+
+    # Bail early
+    if len(rates) < 4:
+      return regions
+
+    # Find slow regions
+    median = sorted(rate for _, _, rate in rates)[len(rates) // 2]
+    threshold = median * cfg.ddrescue.THROUGHPUT_SLOWDOWN_FACTOR
+    for entry in [*rates, (-1, -1, float('inf'))]:
+      if entry[2] < threshold:
+        slow.append(entry)
+        continue
+      if len(slow) >= 2 and slow[0][0] >= 0 and slow[-1][1] >= 0:
+        regions.append((
+          min(slow[0][0], slow[-1][1]),
+          max(slow[0][0], slow[-1][1]),
+          sum(rate for _, _, rate in slow) / len(slow),
+          median,
+          ))
+      slow = []
+
+    # Done
+    return regions
+
+  def load_samples(self):
+    """Load samples from CSV file."""
+    if not self.csv_path.exists():
+      return
+    try:
+      with open(self.csv_path, 'r', encoding='utf-8', newline='') as _f:
+        for row in csv.reader(_f):
+          timestamp, pass_name, rescued, pos, errsize = row
+          self.errsizes.append(int(errsize))
+          self.passes.append(PASS_NAMES.index(pass_name))
+          self.positions.append(int(pos))
+          self.rescued.append(int(rescued))
+          self.times.append(float(timestamp))
+    except (OSError, ValueError):
+      LOG.error('Failed to load throughput samples from %s', self.csv_path)
+
+
 # Functions
 def build_block_pair_report(block_pairs, settings):
   """Build block pair report, returns list."""
@@ -1366,6 +2212,47 @@ def build_object_report(obj):
   return report
 
 
+def build_sessions_report(sessions):
+  """Build combined progress report for all sessions, returns list."""
+  report = []
+  separator = '─' * cfg.ddrescue.TMUX_SESSIONS_WIDTH
+  total_rate = sum(session.get('rate') or 0 for session in sessions)
+
+  # Overall
+  report.append(std.color_string('Sessions', 'BLUE'))
+  report.append(f'Active: {len(sessions)}')
+  report.append(
+    f'Combined rate: {std.bytes_to_string(total_rate, decimals=1)}/s',
+    )
+  report.append(separator)
+
+  # Sessions
+  for session in sessions:
+    percent = session.get('percent', 0)
+    status = session.get('status', 'Unknown')
+    report.append(
+      std.color_string(
+        f'{session["source"]} -> {session["destination"]}', 'BLUE',
+        ),
+      )
+    if 'NEEDS ATTENTION' in status:
+      status = std.color_string(status, 'YELLOW_BLINK')
+    report.append(f'  Status:  {status}')
+    report.append(
+      f'  Rescued: '
+      f'{std.color_string(f"{percent:.2f} %", get_percent_color(percent))}'
+      f' ({std.bytes_to_string(session.get("rescued", 0), decimals=2)})',
+      )
+    if session.get('rate') is not None:
+      report.append(
+        f'  Rate:    {std.bytes_to_string(session["rate"], decimals=1)}/s',
+        )
+    report.append(' ')
+
+  # Done
+  return report
+
+
 def build_settings_menu(silent=True):
   """Build settings menu, returns wk.std.Menu."""
   title_text = [
@@ -1481,12 +2368,31 @@ def clean_working_dir(working_dir):
 
   # Move settings, maps, etc to backup_dir
   for entry in os.scandir(working_dir):
-    if entry.name.endswith(('.dd', '.json', '.map')):
+    if entry.name.endswith(('.csv', '.dd', '.json', '.map')):
       new_path = f'{backup_dir}/{entry.name}'
       new_path = io.non_clobber_path(new_path)
       shutil.move(entry.path, new_path)
 
 
+def compare_map_data(map_data, ddrescuelog_data):
+  """Compare parsed map data against ddrescuelog data and log differences.
+
+  NOTE: ddrescuelog sizes are rounded so small differences are ignored.
+  """
+  for key in (*MAP_STATUS_NAMES.values(), 'full recovery', 'pass completed'):
+    value = map_data.get(key, 0)
+    log_value = ddrescuelog_data.get(key, 0)
+    if isinstance(value, bool):
+      mismatch = value != log_value
+    else:
+      mismatch = abs(value - log_value) > max(value, log_value) * 0.01
+    if mismatch:
+      LOG.warning(
+        'Map data mismatch for %s: %s (parsed) vs %s (ddrescuelog)',
+        key, value, log_value,
+        )
+
+
 def format_status_string(status, width):
   """Format colored status string, returns str."""
   color = None
@@ -1574,30 +2480,66 @@ def get_ddrescue_settings(settings_menu):
   return settings
 
 
-def get_etoc():
-  """Get EToC from ddrescue output, returns str."""
-  delta = None
-  delta_dict = {}
-  etoc = 'Unknown'
-  now = datetime.datetime.now(tz=TIMEZONE)
-  output = tmux.capture_pane()
-
-  # Search for EToC delta
-  matches = re.findall(r'remaining time:.*$', output, re.MULTILINE)
-  if matches:
-    match = REGEX_REMAINING_TIME.search(matches[-1])
-    if match.group('na'):
-      etoc = 'N/A'
+def get_disk_id(path):
+  """Get ID for the disk containing path, returns str or None.
+
+  The ID is the major:minor number of the whole disk so partitions
+  on the same disk share the same ID.
+  """
+  path = pathlib.Path(path)
+  try:
+    if path.is_block_device():
+      dev = path.stat().st_rdev
     else:
-      for key in ('days', 'hours', 'minutes', 'seconds'):
-        delta_dict[key] = match.group(key)
-      delta_dict = {k: int(v) if v else 0 for k, v in delta_dict.items()}
-      delta = datetime.timedelta(**delta_dict)
+      dev = path.stat().st_dev
+  except OSError:
+    return None
+  dev_id = f'{os.major(dev)}:{os.minor(dev)}'
+
+  # Use parent disk for partitions
+  sysfs_path = pathlib.Path(f'/sys/dev/block/{dev_id}')
+  if sysfs_path.joinpath('partition').exists():
+    try:
+      dev_id = sysfs_path.resolve().parent.joinpath('dev').read_text(
+        encoding='utf-8',
+        ).strip()
+    except OSError:
+      pass
+
+  # Done
+  return dev_id
+
+
+def get_attribute_values(dev):
+  """Get SMART attribute raw values for dev, returns dict.
 
-  # Calc EToC if delta found
-  if delta:
-    etoc_datetime = now + delta
-    etoc = etoc_datetime.strftime('%Y-%m-%d %H:%M %Z')
+  NOTE: Returns an empty dict if dev isn't a wk.hw.obj.Disk() object.
+  """
+  if not isinstance(dev, hw_obj.Disk):
+    return {}
+  return {
+    name: details.get('raw') for name, details in dev.attributes.items()
+    }
+
+
+def get_etoc(status):
+  """Get EToC from ddrescue status, returns str."""
+  etoc = 'Unknown'
+
+  # Check status
+  if not (status and status.updated):
+    return etoc
+  if status.fields.get('remaining time', '').lower() == 'n/a':
+    return 'N/A'
+  if status.remaining_time is None:
+    return etoc
+
+  # Calc EToC using the time the status was reported
+  etoc_datetime = datetime.datetime.fromtimestamp(
+    status.updated + status.remaining_time,
+    tz=TIMEZONE,
+    )
+  etoc = etoc_datetime.strftime('%Y-%m-%d %H:%M %Z')
 
   # Done
   return etoc
@@ -1621,6 +2563,26 @@ def get_fstype_macos(path):
   return fstype
 
 
+def get_map_blocks(map_path):
+  """Get data blocks from ddrescue map file, returns generator.
+
+  Blocks are yielded as (pos, size, status) tuples.
+
+  NOTE: Nothing is yielded if the map is missing or invalid.
+  """
+  try:
+    with open(map_path, 'r', encoding='utf-8') as _f:
+      blocks = [parse_map_line(line) for line in _f]
+  except FileNotFoundError:
+    return
+  except (UnicodeDecodeError, ValueError):
+    LOG.error('Invalid map file: %s', map_path)
+    return
+  for block in blocks:
+    if block and block[1] is not None:
+      yield block
+
+
 def get_object(path):
   """Get object based on path, returns obj."""
   obj = None
@@ -1681,6 +2643,28 @@ def get_percent_color(percent):
   return color
 
 
+def get_sessions():
+  """Get active ddrescue-tui sessions, returns list of dicts.
+
+  NOTE: Sessions left behind by exited processes are removed.
+  """
+  sessions = []
+  for path in sorted(pathlib.Path(cfg.ddrescue.SESSION_DIR).glob('*.json')):
+    try:
+      with open(path, 'r', encoding='utf-8') as _f:
+        session = json.load(_f)
+    except (OSError, json.JSONDecodeError):
+      continue
+    if not psutil.pid_exists(session.get('pid', -1)):
+      LOG.warning('Removing stale session file: %s', path)
+      path.unlink(missing_ok=True)
+      continue
+    sessions.append(session)
+
+  # Done
+  return sessions
+
+
 def get_table_type(disk):
   """Get disk partition table type, returns str.
 
@@ -1819,6 +2803,11 @@ def main():
     LOG.error('tmux session not found')
     raise RuntimeError('tmux session not found')
 
+  # Run multiple sessions
+  if args['sessions']:
+    run_sessions(args)
+    return
+
   # Init
   atexit.register(tmux.kill_all_panes)
   main_menu = build_main_menu()
@@ -1950,6 +2939,164 @@ def mount_raw_image_macos(path):
   return loopback_path
 
 
+def parse_ddrescue_time(time_str):
+  """Parse ddrescue time string (e.g. "1h 2m 3s"), returns int or None.
+
+  NOTE: None is returned for "n/a" and other unknown values.
+  """
+  multipliers = {'d': 86400, 'h': 3600, 'm': 60, 's': 1}
+  matches = DDRESCUE_TIME_REGEX.findall(time_str)
+  if not matches:
+    return None
+  return sum(int(value) * multipliers[unit] for value, unit in matches)
+
+
+def parse_map_file(map_path, size):
+  """Parse ddrescue map file, returns dict.
+
+  The sizes for each status are in bytes and limited to the first size bytes
+  of the map. Any area not covered by the map is counted as non-tried.
+
+  NOTE: If the map is missing, empty, or invalid then only the
+        'full recovery' and 'pass completed' keys are returned.
+  """
+  current_status = None
+  data = {'full recovery': False, 'pass completed': False}
+  mapped_size = 0
+  totals = {name: 0 for name in MAP_STATUS_NAMES.values()}
+
+  # Read map
+  try:
+    with open(map_path, 'r', encoding='utf-8') as _f:
+      for line in _f:
+        entry = parse_map_line(line)
+        if not entry:
+          continue
+        pos, block_size, status = entry
+        if block_size is None:
+          current_status = status
+          continue
+
+        # Only count data within the block pair
+        block_size = min(pos + block_size, size) - pos
+        if block_size > 0:
+          totals[MAP_STATUS_NAMES[status]] += block_size
+          mapped_size += block_size
+  except FileNotFoundError:
+    return data
+  except (KeyError, UnicodeDecodeError, ValueError):
+    LOG.error('Invalid map file: %s', map_path)
+    return data
+
+  # Bail if no blocks were found
+  if not mapped_size:
+    return data
+
+  # Add unmapped area
+  totals['non-tried'] += max(size - mapped_size, 0)
+
+  # Done
+  data.update(totals)
+  data['full recovery'] = totals['rescued'] == size
+  data['pass completed'] = current_status == '+'
+  return data
+
+
+def parse_map_line(line):
+  """Parse ddrescue map file line, returns tuple or None.
+
+  Data blocks are returned as (pos, size, status) and the current status
+  line is returned as (pos, None, status). Comments and empty lines
+  return None.
+
+  NOTE: A ValueError is raised if the line is invalid.
+  """
+  fields = line.split('#', 1)[0].split()
+
+  # Comment or empty line
+  if not fields:
+    return None
+
+  # Current status line, e.g. "0x00000000  ?  1"
+  if len(fields) in (2, 3) and not fields[1][0].isdigit():
+    return (int(fields[0], 0), None, fields[1])
+
+  # Data block, e.g. "0x00000000  0x00100000  +"
+  if len(fields) == 3 and fields[2] in MAP_STATUS_NAMES:
+    return (int(fields[0], 0), int(fields[1], 0), fields[2])
+
+  # Invalid line
+  raise ValueError(f'Invalid map line: {line.strip()}')
+
+
+def reset_map_for_retry(map_path):
+  """Mark non-trimmed, non-scraped, and bad areas as non-tried in map.
+
+  The map is streamed to a temp file while merging adjacent blocks with
+  the same status. The temp file is then synced to disk and replaces the
+  original atomically. The original map is kept as <map>.bak.
+
+  NOTE: The original map is left untouched if it's invalid.
+  """
+  backup_path = map_path.with_name(f'{map_path.name}.bak')
+  block = None
+  tmp_path = map_path.with_name(f'{map_path.name}.tmp')
+
+  def _write_block(out_file):
+    """Write current block to out_file."""
+    out_file.write(f'0x{block[0]:08X}  0x{block[1]:08X}  {block[2]}\n')
+
+  # Write updated map to temp file
+  try:
+    with open(map_path, 'r', encoding='utf-8') as _in:
+      with open(tmp_path, 'w', encoding='utf-8') as _out:
+        for line in _in:
+          entry = parse_map_line(line)
+          if not entry or entry[1] is None:
+            # Comments and current status line are kept as-is
+            if block:
+              _write_block(_out)
+              block = None
+            _out.write(f'{line.rstrip()}\n')
+            continue
+          pos, size, status = entry
+          if status in ('*', '/', '-'):
+            status = '?'
+          if block and block[2] == status and block[0] + block[1] == pos:
+            block[1] += size
+            continue
+          if block:
+            _write_block(_out)
+          block = [pos, size, status]
+        if block:
+          _write_block(_out)
+        _out.flush()
+        os.fsync(_out.fileno())
+  except (OSError, ValueError):
+    tmp_path.unlink(missing_ok=True)
+    raise
+
+  # Keep backup
+  backup_path.unlink(missing_ok=True)
+  try:
+    os.link(map_path, backup_path)
+  except OSError:
+    # Hard links aren't supported on all filesystems (e.g. SMB shares)
+    shutil.copy2(map_path, backup_path)
+
+  # Replace map
+  os.replace(tmp_path, map_path)
+  try:
+    dir_fd = os.open(map_path.parent, os.O_RDONLY)
+    try:
+      os.fsync(dir_fd)
+    finally:
+      os.close(dir_fd)
+  except OSError:
+    # Not supported on all filesystems
+    pass
+
+
 def run_ddrescue(state, block_pair, pass_name, settings, dry_run=True):
   # pylint: disable=too-many-statements
   """Run ddrescue using passed settings."""
@@ -1993,55 +3140,65 @@ def run_ddrescue(state, block_pair, pass_name, settings, dry_run=True):
       'Press Enter to return to main menu...', end='', flush=True,
       )
 
-  def _update_smart_pane():
-    """Update SMART pane every 30 seconds."""
-    state.source.update_smart_details()
-    now = datetime.datetime.now(tz=TIMEZONE).strftime('%Y-%m-%d %H:%M %Z')
-    with open(f'{state.log_dir}/smart.out', 'w', encoding='utf-8') as _f:
-      _f.write(
-        std.color_string(
-          ['SMART Attributes', f'Updated: {now}\n'],
-          ['BLUE', 'YELLOW'],
-          sep='\t\t',
-          ),
-        )
-      _f.write('\n'.join(state.source.generate_report(header=False)))
-
   # Dry run
   if dry_run:
     LOG.info('ddrescue cmd: %s', cmd)
     return
 
   # Start ddrescue
-  proc = exe.popen_program(cmd)
+  # NOTE: The output is read through a pty to parse the live status,
+  #       it's mirrored to this pane so ddrescue is still shown as usual.
+  map_watcher = io.FileWatcher(block_pair.map_path)
+  state.ddrescue_status = DDRescueStatus()
+  pty_fd, pty_child_fd = pty.openpty()
+  proc = exe.popen_program(cmd, stderr=pty_child_fd, stdout=pty_child_fd)
+  os.close(pty_child_fd)
+  status_thread = exe.start_thread(state.ddrescue_status.monitor, [pty_fd])
+  health_monitor = HealthMonitor(state)
+  health_monitor.start()
 
   # ddrescue loop
-  _i = 0
+  # NOTE: Progress is only updated after ddrescue (re)writes the map file.
+  #       The loop sleeps until then unless ddrescue exits (see pidfd) or
+  #       a health check fails. proc.poll() is only used on a timeout if
+  #       pidfd_open() isn't available.
+  try:
+    proc_fd = os.pidfd_open(proc.pid)
+  except (AttributeError, OSError):
+    proc_fd = None
+  wait_fds = [health_monitor.fileno()]
+  if proc_fd is not None:
+    wait_fds.append(proc_fd)
+  map_updated = True
+  next_clear = 0
   while True:
-    if _i % 30 == 0:
-      # Update SMART pane
-      _update_smart_pane()
-
-      # Check destination
-      warning_message = check_destination_health(state.destination)
-      if warning_message:
-        # Error detected on destination, stop recovery
-        exe.stop_process(proc)
-        std.print_error(warning_message)
-        break
-    if _i % 60 == 0:
+    now = time.monotonic()
+    for _, message in health_monitor.get_messages():
+      # Error detected on destination, stop recovery
+      warning_message = message
+    if warning_message:
+      exe.stop_process(proc)
+      std.print_error(warning_message)
+      break
+    if now >= next_clear:
       # Clear ddrescue pane
+      next_clear = now + 60
       tmux.clear_pane()
-    _i += 1
 
-    # Update progress
-    block_pair.update_progress(pass_name)
-    state.update_progress_pane('Active')
+    # Update progress and record throughput
+    if map_updated:
+      map_data = block_pair.update_progress(pass_name)
+      block_pair.record_throughput(
+        pass_name, map_data, state.ddrescue_status,
+        )
+      state.update_progress_pane('Active')
 
-    # Check if complete
+    # Wait for map update
+    timeout = max(next_clear - time.monotonic(), 0)
+    if proc_fd is None:
+      timeout = min(timeout, 1)
     try:
-      proc.wait(timeout=1)
-      break
+      map_updated = map_watcher.wait(timeout=timeout, fds=wait_fds)
     except KeyboardInterrupt:
       # Wait a bit to let ddrescue exit safely
       LOG.warning('ddrescue stopped by user')
@@ -2049,18 +3206,21 @@ def run_ddrescue(state, block_pair, pass_name, settings, dry_run=True):
       std.sleep(2)
       exe.stop_process(proc, graceful=False)
       break
-    except subprocess.TimeoutExpired:
-      # Continue to next loop to update panes
-      pass
-    else:
-      # Done
-      std.sleep(1)
+
+    # Check if complete
+    if proc.poll() is not None:
       break
+  if proc_fd is not None:
+    os.close(proc_fd)
+  health_monitor.stop()
+  map_watcher.close()
+  status_thread.join(timeout=5)
 
   # Update progress
   # NOTE: Using 'Active' here to avoid flickering between block pairs
-  block_pair.update_progress(pass_name)
+  map_data = block_pair.update_progress(pass_name)
   state.update_progress_pane('Active')
+  block_pair.record_throughput(pass_name, map_data, state.ddrescue_status)
 
   # Check result
   if proc.poll():
@@ -2098,6 +3258,7 @@ def run_recovery(state, main_menu, settings_menu, dry_run=True):
   atexit.register(state.save_debug_reports)
   attempted_recovery = False
   auto_continue = False
+  used_space_first = False
 
   # Bail early
   if is_missing_source_or_destination(state):
@@ -2115,8 +3276,18 @@ def run_recovery(state, main_menu, settings_menu, dry_run=True):
     if 'Retry' in name and details['Selected']:
       details['Selected'] = False
       state.retry_all_passes()
+    if 'used space' in name and details['Selected']:
+      used_space_first = True
   settings = get_ddrescue_settings(settings_menu)
 
+  # Build domain maps
+  if used_space_first and not state.pass_complete('read'):
+    for pair in state.block_pairs:
+      std.print_info(f'Reading filesystem allocation data: {pair.source}')
+      pair.create_domain_map()
+      if not pair.domain_map_path:
+        std.print_warning('  Unsupported or unreadable filesystem, skipping')
+
   # Start SMART/Journal
   state.panes['SMART'] = tmux.split_window(
     behind=True, lines=12, vertical=True,
@@ -2143,6 +3314,13 @@ def run_recovery(state, main_menu, settings_menu, dry_run=True):
         attempted_recovery = True
         state.mark_started()
         try:
+          if pass_name == 'read' and pair.domain_map_path:
+            # Rescue used space first
+            run_ddrescue(
+              state, pair, pass_name,
+              [*settings, f'--domain-mapfile={pair.domain_map_path}'],
+              dry_run=dry_run,
+              )
           run_ddrescue(state, pair, pass_name, settings, dry_run=dry_run)
         except (FileNotFoundError, KeyboardInterrupt, std.GenericAbort):
           is_missing_source_or_destination(state)
@@ -2161,6 +3339,13 @@ def run_recovery(state, main_menu, settings_menu, dry_run=True):
     if pane in state.panes:
       tmux.kill_pane(state.panes.pop(pane))
 
+  # Update mirror(s)
+  if state.mirror_dir and attempted_recovery:
+    state.update_progress_pane('Updating mirror')
+    for pair in state.block_pairs:
+      std.print_standard(f'Updating mirror: {pair.mirror_path}')
+      pair.update_mirror(dry_run=dry_run)
+
   # Show warning if nothing was done
   if not attempted_recovery:
     std.print_warning('No actions performed')
@@ -2173,6 +3358,71 @@ def run_recovery(state, main_menu, settings_menu, dry_run=True):
   state.update_progress_pane('Idle')
 
 
+def run_sessions(docopt_args):
+  """Run multiple recovery sessions concurrently.
+
+  Each session runs in its own tmux window with a separate State,
+  ddrescue process, map file, and SMART pane. This window is used to
+  start sessions and shows the combined progress for all of them.
+  """
+  cmd = 'ddrescue-tui.py'
+  for option in (
+      '--dry-run', '--force-local-map', '--local-map', '--start-fresh'):
+    if docopt_args[option]:
+      cmd += f' {option}'
+  if docopt_args['--mirror']:
+    mirror_dir = pathlib.Path(docopt_args['--mirror']).resolve()
+    cmd += f' --mirror={shlex.quote(str(mirror_dir))}'
+  session_dir = pathlib.Path(cfg.ddrescue.SESSION_DIR)
+  session_dir.mkdir(parents=True, exist_ok=True)
+  progress_path = session_dir.joinpath('progress.out')
+  session_count = 0
+
+  def _update_progress_loop():
+    """Update combined progress file on a loop.
+
+    NOTE: This should be called as a thread.
+    """
+    while True:
+      report = build_sessions_report(get_sessions())
+      with open(progress_path, 'w', encoding='utf-8') as _f:
+        _f.write('\n'.join(report))
+      std.sleep(1)
+
+  # Init
+  atexit.register(tmux.kill_all_panes)
+  tmux.kill_all_panes()
+  tmux.split_window(
+    lines=cfg.ddrescue.TMUX_SESSIONS_WIDTH,
+    watch_file=progress_path,
+    )
+  exe.start_thread(_update_progress_loop)
+  menu = std.Menu(title=std.color_string('ddrescue TUI: Sessions', 'GREEN'))
+  menu.add_action('Start new session')
+  menu.add_action('Quit')
+
+  # Show menu
+  while True:
+    selection = menu.simple_select()
+
+    # Start session
+    if 'Start' in selection[0]:
+      session_count += 1
+      tmux.new_window(name=f'Session {session_count}', cmd=cmd)
+      std.print_info(
+        f'Started session {session_count}, use Ctrl+B N to switch windows',
+        )
+      std.sleep(2)
+
+    # Quit
+    if 'Quit' in selection[0]:
+      if get_sessions():
+        std.print_warning('Sessions will keep running in their own windows')
+        if not std.ask('Are you sure you want to quit?'):
+          continue
+      break
+
+
 def select_disk(prompt, skip_disk=None):
   """Select disk from list, returns Disk()."""
   std.print_info('Scanning disks...')
@@ -2365,5 +3615,37 @@ def unmount_loopback_device(path):
   exe.run_program(cmd, check=False)
 
 
+def write_domain_map(map_path, ranges, size):
+  """Write ddrescue domain map using ranges.
+
+  Ranges are marked as finished ('+') and everything else is marked
+  as non-tried ('?') so ddrescue only reads the ranges listed.
+  """
+  lines = [
+    '# Domain mapfile. Created by WizardKit',
+    '# current_pos  current_status  current_pass',
+    '0x00000000     +               1',
+    '#      pos        size  status',
+    ]
+  pos = 0
+
+  # Add blocks
+  for start, length in ranges:
+    end = min(start + length, size)
+    if end <= start:
+      continue
+    if start > pos:
+      lines.append(f'0x{pos:08X}  0x{start-pos:08X}  ?')
+    lines.append(f'0x{start:08X}  0x{end-start:08X}  +')
+    pos = end
+  if pos < size:
+    lines.append(f'0x{pos:08X}  0x{size-pos:08X}  ?')
+
+  # Save map
+  with open(map_path, 'w', encoding='utf-8') as _f:
+    _f.write('\n'.join(lines))
+    _f.write('\n')
+
+
 if __name__ == '__main__':
   print("This file is not meant to be called directly.")
@@ -3,14 +3,22 @@
 # vim: sts=2 sw=2 ts=2
 
 import atexit
+import json
 import logging
+import mmap
 import os
 import pathlib
+import random
 import re
+import socket
 import subprocess
+import sys
+import threading
 import time
 
+from array import array
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from docopt import docopt
 
 from wk import cfg, debug, exe, graph, log, net, std, tmux
@@ -44,6 +52,23 @@ IO_MINIMUM_TEST_SIZE = 10 * 1024**3
 IO_RATE_REGEX = re.compile(
   r'(?P<bytes>\d+) bytes.* (?P<seconds>\S+) s(?:,|ecs )',
   )
+LATENCY_HISTOGRAM_BUCKETS = (
+  # (Upper limit in ns, label)
+  (100 * 1000, '<100us'),
+  (1000**2, '<1ms'),
+  (10 * 1000**2, '<10ms'),
+  (100 * 1000**2, '<100ms'),
+  (1000**3, '<1s'),
+  (float('inf'), '>=1s'),
+  )
+MPRIME_COMPLETED_REGEX = re.compile(
+  r'(completed.*?\b(\d+) errors, (\d+) warnings)',
+  re.IGNORECASE,
+  )
+MPRIME_FAILURE_REGEX = re.compile(
+  r'(error|fail|illegal sumout|sum\(inputs\) != sum\(outputs\))',
+  re.IGNORECASE,
+  )
 MENU_ACTIONS = (
   'Audio Test',
   'Keyboard Test',
@@ -59,23 +84,43 @@ MENU_OPTIONS = (
   'CPU & Cooling',
   'Disk Attributes',
   'Disk Self-Test',
+  'Disk Surface Scan (Sampled)',
   'Disk Surface Scan',
   'Disk I/O Benchmark',
+  'Disk Latency',
 )
-MENU_OPTIONS_QUICK = ('Disk Attributes',)
+MENU_OPTIONS_QUICK = ('Disk Attributes', 'Disk Surface Scan (Sampled)')
 MENU_SETS = {
-  'Full Diagnostic': (*MENU_OPTIONS,),
+  'Full Diagnostic': (
+    'CPU & Cooling',
+    'Disk Attributes',
+    'Disk Self-Test',
+    'Disk Surface Scan',
+    'Disk I/O Benchmark',
+    'Disk Latency',
+    ),
   'Disk Diagnostic': (
     'Disk Attributes',
     'Disk Self-Test',
     'Disk Surface Scan',
     'Disk I/O Benchmark',
+    'Disk Latency',
     ),
-  'Disk Diagnostic (Quick)': ('Disk Attributes',),
+  'Disk Diagnostic (Quick)': (*MENU_OPTIONS_QUICK,),
 }
-MENU_TOGGLES = (
-  'Skip USB Benchmarks',
+MENU_TOGGLES = {
+  'Parallel Benchmarks (by controller)': False,
+  'Skip USB Benchmarks': True,
+  }
+# NOTE: Run via sudo to open a device and pass the fd back over stdin
+OPEN_DEVICE_SCRIPT = '''
+import array, os, socket, sys
+fd = os.open(sys.argv[1], int(sys.argv[2]))
+sock = socket.socket(fileno=0)
+sock.sendmsg(
+  [b'1'], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', [fd]))],
   )
+'''
 PLATFORM = std.PLATFORM
 STATUS_COLORS = {
   'Passed': 'GREEN',
@@ -97,39 +142,418 @@ class DeviceTooSmallError(RuntimeError):
 
 
 # Classes
+class DirectIOReader():
+  """Object for timing reads from a device while bypassing the page cache.
+
+  The device is opened once using O_DIRECT (F_NOCACHE under macOS) and
+  read into a reusable page-aligned buffer.
+
+  NOTE: The device is opened via sudo if necessary, see open_device().
+  """
+  def __init__(self, path, block_size=IO_BLOCK_SIZE):
+    self.block_size = block_size
+    self.fd = open_device(path, os.O_RDONLY | getattr(os, 'O_DIRECT', 0))
+    self.buffer = mmap.mmap(-1, block_size)
+    if PLATFORM == 'Darwin':
+      # pylint: disable=import-outside-toplevel
+      import fcntl
+      fcntl.fcntl(self.fd, fcntl.F_NOCACHE, 1)
+
+  def close(self):
+    """Close device and release buffer."""
+    os.close(self.fd)
+    self.buffer.close()
+
+  def read_chunk(self, offset, count):
+    """Read count blocks starting at offset (in blocks), returns float.
+
+    The rate is returned in bytes per second.
+    """
+    os.lseek(self.fd, offset * self.block_size, os.SEEK_SET)
+    start = time.perf_counter_ns()
+    for _ in range(count):
+      if os.readv(self.fd, [self.buffer]) != self.block_size:
+        raise OSError(f'Short read at block {offset} (count {count})')
+    elapsed = time.perf_counter_ns() - start
+    return count * self.block_size / (max(elapsed, 1) / 1000**3)
+
+  def read_at(self, offset, length):
+    """Read length bytes at offset (in bytes), returns int.
+
+    NOTE: An OSError is raised for read errors and short reads.
+    """
+    bytes_read = os.preadv(self.fd, [memoryview(self.buffer)[:length]], offset)
+    if bytes_read != length:
+      raise OSError(f'Short read at offset {offset}')
+    return bytes_read
+
+
+class MprimeMonitor():
+  """Object for checking mprime output while it runs.
+
+  Output is saved to the log (minus the stress.txt lines) and mprime is
+  stopped at the first error so failing CPUs fail fast.
+  """
+  def __init__(self, proc, log_path):
+    self.errors = []
+    self.failed_after = None
+    self.log_path = log_path
+    self.proc = proc
+    self.start_time = time.monotonic()
+    self.thread = exe.start_thread(self._monitor)
+
+  def _monitor(self):
+    """Read output line by line until mprime exits."""
+    with open(self.log_path, 'a', encoding='utf-8') as _f:
+      for line in iter(self.proc.stdout.readline, b''):
+        line = line.decode('utf-8', errors='ignore')
+        self.check_line(line.strip())
+        if 'stress.txt' not in line.lower():
+          _f.write(line)
+          _f.flush()
+
+  def check_line(self, line):
+    """Check line for errors and stop mprime if necessary."""
+    match = MPRIME_COMPLETED_REGEX.search(line)
+    if match:
+      if int(match.group(2)) + int(match.group(3)) == 0:
+        # No errors/warnings
+        return
+    elif not MPRIME_FAILURE_REGEX.search(line):
+      return
+
+    # Error or warning found
+    self.errors.append(line)
+    if self.failed_after is None:
+      self.failed_after = time.monotonic() - self.start_time
+      LOG.error('Prime95 error detected: %s', line)
+      if self.proc.poll() is None:
+        self.proc.terminate()
+
+  def wait(self, timeout=5):
+    """Wait for remaining output to be saved."""
+    self.thread.join(timeout=timeout)
+
+
+class SampledSurfaceScan():
+  """Object for reading a stratified random sample of a disk.
+
+  The disk is split into equal strata and each pass reads one random
+  region from every stratum (in LBA order) until the time budget is used.
+  """
+  def __init__(self, dev_path, size, log_path, abort_event):
+    self.abort_event = abort_event
+    self.bad_regions = []
+    self.dev_path = dev_path
+    self.log_path = log_path
+    self.region_size = cfg.hw.SAMPLED_SCAN_REGION_SIZE
+    self.regions_read = 0
+    self.regions_unique = set()
+    self.size = size
+    self.strata = max(
+      min(cfg.hw.SAMPLED_SCAN_STRATA, size // self.region_size), 1,
+      )
+
+  def _log(self, text):
+    """Append text to log."""
+    with open(self.log_path, 'a', encoding='utf-8') as _f:
+      _f.write(f'{text}\n')
+
+  def get_coverage(self):
+    """Get fraction of the disk read, returns float."""
+    return min(len(self.regions_unique) * self.region_size / self.size, 1)
+
+  def get_defect_rate_bound(self, confidence=0.95):
+    """Get upper confidence bound for the defective region rate, returns float.
+
+    NOTE: This is the exact binomial bound for zero defects, i.e.
+          1 - (1 - confidence)^(1/n) (~3/n for 95% confidence).
+          Scans stop at the first error so no other case is needed.
+    """
+    if self.bad_regions or not self.regions_read:
+      return 1.0
+    return 1 - (1 - confidence) ** (1 / self.regions_read)
+
+  def run(self, seconds):
+    """Read random regions until the time budget is used, returns bool.
+
+    NOTE: False is returned if the scan was aborted.
+    """
+    deadline = time.monotonic() + seconds
+    next_progress = 0
+    reader = DirectIOReader(self.dev_path, block_size=self.region_size)
+    regions_per_stratum = max(self.size // self.region_size // self.strata, 1)
+    stratum_size = regions_per_stratum * self.region_size
+
+    # Scan
+    self._log(
+      f'Reading random {std.bytes_to_string(self.region_size)} regions '
+      f'from {self.strata} strata (read-only test)',
+      )
+    try:
+      while time.monotonic() < deadline and not self.abort_event.is_set():
+        for stratum in range(self.strata):
+          offset = (
+            stratum * stratum_size
+            + random.randrange(regions_per_stratum) * self.region_size
+            )
+          length = min(self.region_size, self.size - offset)
+          try:
+            reader.read_at(offset, length)
+          except OSError:
+            self.bad_regions.append(offset)
+            self._log(f'  Read error in region at offset {offset}')
+          self.regions_read += 1
+          self.regions_unique.add(offset)
+
+          # Show progress
+          now = time.monotonic()
+          if now >= next_progress:
+            next_progress = now + 5
+            self._log(
+              f'  {self.regions_read} regions read, '
+              f'{100 * self.get_coverage():.2f}% coverage, '
+              f'{int(max(deadline - now, 0))}s remaining. '
+              f'({len(self.bad_regions)} errors)',
+              )
+          if self.bad_regions or self.abort_event.is_set() or now >= deadline:
+            break
+        if self.bad_regions:
+          break
+    finally:
+      reader.close()
+
+    # Done
+    return not self.abort_event.is_set()
+
+
+class SurfaceScan():
+  """Object for running a read-only surface scan using direct reads.
+
+  Chunks that fail to read are retried one sector at a time to find the
+  bad sectors. Progress is saved per disk serial so an interrupted scan
+  resumes where it stopped.
+  """
+  def __init__(self, dev, dev_path, log_path, abort_event):
+    self.abort_event = abort_event
+    self.bad_sectors = []
+    self.checkpoint_path = None
+    self.dev = dev
+    self.dev_path = dev_path
+    self.log_path = log_path
+    self.position = 0
+    self.read_errors = 0
+    self.resumed_from = 0
+    self.sector_size = dev.details['log-sec']
+    self.size = dev.details['size']
+
+    # Set checkpoint path
+    serial = dev.details['serial']
+    if serial and serial != 'Unknown Serial':
+      checkpoint_dir = pathlib.Path(
+        cfg.hw.SURFACE_SCAN_CHECKPOINT_DIR,
+        ).expanduser()
+      checkpoint_dir.mkdir(parents=True, exist_ok=True)
+      serial = re.sub(r'[^\w.-]', '_', serial)
+      self.checkpoint_path = checkpoint_dir.joinpath(f'{serial}.json')
+
+  def _log(self, text):
+    """Append text to log."""
+    with open(self.log_path, 'a', encoding='utf-8') as _f:
+      _f.write(f'{text}\n')
+
+  def _retry_sectors(self, reader, offset, length):
+    """Retry chunk one sector at a time to find bad sectors."""
+    for sector_offset in range(offset, offset + length, self.sector_size):
+      try:
+        reader.read_at(sector_offset, self.sector_size)
+      except OSError:
+        self.bad_sectors.append(sector_offset // self.sector_size)
+        self._log(f'  Bad sector: {sector_offset // self.sector_size}')
+        if self.stop_requested():
+          break
+
+  def load_checkpoint(self):
+    """Load checkpoint from a previous scan if available."""
+    if not (self.checkpoint_path and self.checkpoint_path.exists()):
+      return
+    try:
+      with open(self.checkpoint_path, 'r', encoding='utf-8') as _f:
+        checkpoint = json.load(_f)
+    except (OSError, json.JSONDecodeError):
+      LOG.error('Invalid surface scan checkpoint: %s', self.checkpoint_path)
+      return
+    if checkpoint.get('size') != self.size:
+      # Different disk or size changed
+      return
+    self.bad_sectors = checkpoint.get('bad_sectors', [])
+    self.position = checkpoint.get('position', 0)
+    self.read_errors = checkpoint.get('read_errors', 0)
+    self.resumed_from = self.position
+
+  def remove_checkpoint(self):
+    """Remove checkpoint after a completed scan."""
+    if self.checkpoint_path:
+      self.checkpoint_path.unlink(missing_ok=True)
+
+  def run(self):
+    """Run surface scan from the current position, returns bool.
+
+    NOTE: True is returned if the scan completed.
+    """
+    chunk_size = cfg.hw.SURFACE_SCAN_CHUNK_SIZE
+    next_checkpoint = time.monotonic() + cfg.hw.SURFACE_SCAN_CHECKPOINT_INTERVAL
+    next_progress = 0
+    reader = DirectIOReader(self.dev_path, block_size=chunk_size)
+    start_time = time.monotonic()
+    start_position = self.position
+
+    # Scan
+    self._log(
+      f'Checking sectors {self.position // self.sector_size} to '
+      f'{self.size // self.sector_size - 1} (read-only test)',
+      )
+    try:
+      while self.position < self.size and not self.stop_requested():
+        length = min(chunk_size, self.size - self.position)
+        try:
+          reader.read_at(self.position, length)
+        except OSError:
+          self.read_errors += 1
+          self._retry_sectors(reader, self.position, length)
+        self.position += length
+
+        # Show progress
+        now = time.monotonic()
+        if now >= next_progress or self.position >= self.size:
+          next_progress = now + 5
+          elapsed = max(now - start_time, 0.001)
+          rate = (self.position - start_position) / elapsed
+          self._log(
+            f'  {100 * self.position / self.size:5.2f}% done, '
+            f'{std.bytes_to_string(rate, decimals=1, use_binary=False)}/s, '
+            f'{int(elapsed // 3600)}:{int(elapsed % 3600 // 60):02d}:'
+            f'{int(elapsed % 60):02d} elapsed. '
+            f'(0/0/{len(self.bad_sectors)} errors)',
+            )
+
+        # Save checkpoint
+        if now >= next_checkpoint:
+          next_checkpoint = now + cfg.hw.SURFACE_SCAN_CHECKPOINT_INTERVAL
+          self.save_checkpoint()
+    finally:
+      reader.close()
+
+    # Done
+    if self.position < self.size and self.abort_event.is_set():
+      self.save_checkpoint()
+      return False
+    self.remove_checkpoint()
+    return True
+
+  def save_checkpoint(self):
+    """Save current position and bad sectors."""
+    if not self.checkpoint_path:
+      return
+    tmp_path = self.checkpoint_path.with_suffix('.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as _f:
+      json.dump(
+        {
+          'bad_sectors': self.bad_sectors,
+          'position': self.position,
+          'read_errors': self.read_errors,
+          'serial': self.dev.details['serial'],
+          'size': self.size,
+        },
+        _f,
+        )
+    os.replace(tmp_path, self.checkpoint_path)
+
+  def stop_requested(self):
+    """Check if the scan should stop, returns bool."""
+    return (
+      self.abort_event.is_set()
+      or len(self.bad_sectors) >= cfg.hw.SURFACE_SCAN_MAX_BAD_SECTORS
+      )
+
+
 class State():
-  """Object for tracking hardware diagnostic data."""
+  """Object for tracking hardware diagnostic data.
+
+  NOTE: Tests run concurrently when their resources don't conflict.
+        'Disks' is expanded to the disk(s) being tested and 'After'
+        lists the tests that must finish first (if enabled). 'Terminal'
+        is only used by tests that print to the main pane, the others
+        show their output in panes added with add_test_pane(). ui_lock
+        must be held while changing panes.
+  """
   def __init__(self):
+    self.abort_event = threading.Event()
     self.cpu = None
     self.disks = []
     self.layout = cfg.hw.TMUX_LAYOUT.copy()
     self.log_dir = None
     self.panes = {}
+    self.top_pane_texts = {}
+    self.ui_lock = threading.RLock()
     self.tests = OrderedDict({
       'CPU & Cooling': {
+        'After': (),
         'Enabled': False,
         'Function': cpu_stress_tests,
         'Objects': [],
+        'Resources': ('CPU', 'Terminal'),
         },
       'Disk Attributes': {
+        'After': (),
         'Enabled': False,
         'Function': disk_attribute_check,
         'Objects': [],
+        'Resources': ('Disks',),
         },
       'Disk Self-Test': {
+        'After': ('Disk Attributes',),
         'Enabled': False,
         'Function': disk_self_test,
         'Objects': [],
+        'Resources': ('Disks',),
+        },
+      'Disk Surface Scan (Sampled)': {
+        'After': ('Disk Attributes', 'Disk Self-Test'),
+        'Enabled': False,
+        'Function': disk_sampled_scan,
+        'Objects': [],
+        'Resources': ('Disks',),
         },
       'Disk Surface Scan': {
+        'After': (
+          'Disk Attributes', 'Disk Self-Test', 'Disk Surface Scan (Sampled)',
+          ),
         'Enabled': False,
         'Function': disk_surface_scan,
         'Objects': [],
+        'Resources': ('Disks',),
         },
+      # NOTE: Timed tests also use the CPU to avoid overlapping stress tests
       'Disk I/O Benchmark': {
+        'After': (
+          'Disk Attributes', 'Disk Self-Test', 'Disk Surface Scan (Sampled)',
+          'Disk Surface Scan',
+          ),
         'Enabled': False,
         'Function': disk_io_benchmark,
         'Objects': [],
+        'Resources': ('CPU', 'Disks', 'Terminal'),
+        },
+      'Disk Latency': {
+        'After': (
+          'Disk Attributes', 'Disk Self-Test', 'Disk Surface Scan (Sampled)',
+          'Disk Surface Scan', 'Disk I/O Benchmark',
+          ),
+        'Enabled': False,
+        'Function': disk_latency_test,
+        'Objects': [],
+        'Resources': ('CPU', 'Disks', 'Terminal'),
         },
       })
     self.top_text = std.color_string('Hardware Diagnostics', 'GREEN')
@@ -138,6 +562,19 @@ class State():
     self.init_tmux()
     exe.start_thread(self.fix_tmux_layout_loop)
 
+  def __getstate__(self):
+    """Exclude abort_event and ui_lock when pickling (e.g. debug reports)."""
+    state = self.__dict__.copy()
+    state.pop('abort_event', None)
+    state.pop('ui_lock', None)
+    return state
+
+  def __setstate__(self, state):
+    """Restore abort_event and ui_lock when unpickling."""
+    self.__dict__.update(state)
+    self.abort_event = threading.Event()
+    self.ui_lock = threading.RLock()
+
   def abort_testing(self):
     """Set unfinished tests as aborted and cleanup tmux panes."""
     for details in self.tests.values():
@@ -146,16 +583,29 @@ class State():
           test.set_status('Aborted')
 
     # Cleanup tmux
-    self.panes.pop('Current', None)
-    for key, pane_ids in self.panes.copy().items():
-      if key in ('Top', 'Started', 'Progress'):
-        continue
-      if isinstance(pane_ids, str):
-        tmux.kill_pane(self.panes.pop(key))
-      else:
-        for _id in pane_ids:
-          tmux.kill_pane(_id)
-        self.panes.pop(key)
+    with self.ui_lock:
+      self.panes.pop('Current', None)
+      for key, pane_ids in self.panes.copy().items():
+        if key in ('Top', 'Started', 'Progress'):
+          continue
+        if isinstance(pane_ids, str):
+          tmux.kill_pane(self.panes.pop(key))
+        else:
+          for _id in pane_ids:
+            tmux.kill_pane(_id)
+          self.panes.pop(key)
+
+  def add_test_pane(self, key, **kwargs):
+    """Split a pane for test output and save it under key, returns str.
+
+    NOTE: Panes are split from the Temps pane if the CPU test is running
+          since the main pane is only a few lines tall then.
+    """
+    with self.ui_lock:
+      kwargs.setdefault('target_id', self.panes.get('Temps'))
+      pane_id = tmux.split_window(vertical=True, **kwargs)
+      self.panes.setdefault(key, []).append(pane_id)
+    return pane_id
 
   def disk_safety_checks(self, prep=False, wait_for_self_tests=True):
     # pylint: disable=too-many-branches,too-many-statements
@@ -221,15 +671,19 @@ class State():
           disk.tests['Disk Attributes'].failed = True
           disk.tests['Disk Attributes'].set_status('Failed')
 
-      # Check Surface Scan
-      if (
-          'Disk Surface Scan' in disk.tests
-          and disk.tests['Disk Surface Scan'].failed
-          and 'Disk I/O Benchmark' in disk.tests
-          ):
+      # Check Surface Scan(s)
+      surface_scan_failed = any(
+        name in disk.tests and disk.tests[name].failed
+        for name in ('Disk Surface Scan', 'Disk Surface Scan (Sampled)')
+        )
+      if surface_scan_failed and 'Disk I/O Benchmark' in disk.tests:
         # Disable I/O Benchmark test
         disk.tests['Disk I/O Benchmark'].set_status('Skipped')
         disk.tests['Disk I/O Benchmark'].disabled = True
+      if surface_scan_failed and 'Disk Latency' in disk.tests:
+        # Disable Latency test
+        disk.tests['Disk Latency'].set_status('Skipped')
+        disk.tests['Disk Latency'].disabled = True
 
       # Disable tests if necessary
       if disable_tests:
@@ -237,33 +691,50 @@ class State():
 
     # Wait for self-test(s)
     if self_tests_in_progress:
-      std.print_warning('SMART self-test(s) in progress')
-      std.print_standard('Waiting 60 seconds before continuing...')
+      # NOTE: Shown in the top pane since other tests may be using the
+      #       main pane
+      LOG.warning('SMART self-test(s) in progress')
+      self.update_top_pane('Waiting 60 seconds for SMART self-test(s)...')
       std.sleep(60)
+      self.update_top_pane()
       self.disk_safety_checks(wait_for_self_tests=False)
 
   def fix_tmux_layout(self, forced=True):
     # pylint: disable=unused-argument
     """Fix tmux layout based on cfg.hw.TMUX_LAYOUT."""
     try:
-      tmux.fix_layout(self.panes, self.layout, forced=forced)
+      with self.ui_lock:
+        tmux.fix_layout(self.panes, self.layout, forced=forced)
     except RuntimeError:
       # Assuming self.panes changed while running
       pass
 
   def fix_tmux_layout_loop(self):
-    """Fix tmux layout on a loop.
+    """Fix tmux layout whenever it changes.
 
     NOTE: This should be called as a thread.
     """
-    while True:
-      self.fix_tmux_layout(forced=False)
-      std.sleep(1)
+    tmux.watch_layout(lambda: self.fix_tmux_layout(forced=False))
+
+  def get_test_resources(self, name):
+    """Get resources used by test, returns set."""
+    resources = set()
+    for resource in self.tests[name]['Resources']:
+      if resource == 'Disks':
+        resources.update(
+          str(test.dev.path) for test in self.tests[name]['Objects']
+          )
+      else:
+        resources.add(resource)
+
+    # Done
+    return resources
 
   def init_diags(self, menu):
     """Initialize diagnostic pass."""
 
     # Reset objects
+    self.abort_event.clear()
     self.disks.clear()
     self.layout.clear()
     self.layout.update(cfg.hw.TMUX_LAYOUT)
@@ -394,6 +865,11 @@ class State():
       with open(f'{debug_dir}/smc.data', 'a', encoding='utf-8') as _f:
         _f.write('\n'.join(data))
 
+  def sleep(self, seconds):
+    """Sleep for seconds, raises KeyboardInterrupt if testing was aborted."""
+    if self.abort_event.wait(seconds):
+      raise KeyboardInterrupt
+
   def update_clock(self):
     """Update 'Started' pane following clock sync."""
     tmux.respawn_pane(
@@ -428,12 +904,24 @@ class State():
 
     # Write to progress file
     out_path = pathlib.Path(f'{self.log_dir}/progress.out')
-    with open(out_path, 'w', encoding='utf-8') as _f:
+    with self.ui_lock, open(out_path, 'w', encoding='utf-8') as _f:
       _f.write('\n'.join(report))
 
-  def update_top_pane(self, text):
-    """Update top pane with text."""
-    tmux.respawn_pane(self.panes['Top'], text=f'{self.top_text}\n{text}')
+  def update_top_pane(self, text=None, ident=None):
+    """Update top pane with text for the current (or ident) thread.
+
+    NOTE: The text for each thread is shown so concurrent tests don't
+          replace each other's text. None removes the thread's text.
+    """
+    if ident is None:
+      ident = threading.get_ident()
+    with self.ui_lock:
+      if text is None:
+        self.top_pane_texts.pop(ident, None)
+      else:
+        self.top_pane_texts[ident] = text
+      text = ' & '.join(self.top_pane_texts.values())
+      tmux.respawn_pane(self.panes['Top'], text=f'{self.top_text}\n{text}')
 
 
 # Functions
@@ -469,9 +957,11 @@ def build_menu(cli_mode=False, quick_mode=False):
   for action in MENU_ACTIONS_SECRET:
     menu.add_action(action, {'Hidden': True})
   for option in MENU_OPTIONS:
-    menu.add_option(option, {'Selected': True})
-  for toggle in MENU_TOGGLES:
-    menu.add_toggle(toggle, {'Selected': True})
+    menu.add_option(
+      option, {'Selected': option in MENU_SETS['Full Diagnostic']},
+      )
+  for toggle, selected in MENU_TOGGLES.items():
+    menu.add_toggle(toggle, {'Selected': selected})
   for name, targets in MENU_SETS.items():
     menu.add_set(name, {'Targets': targets})
   menu.actions['Start']['Separator'] = True
@@ -583,6 +1073,20 @@ def check_cooling_results(test_obj, sensors, run_sysbench=False):
   for line in sensors.generate_report(*temp_labels, only_cpu=True):
     test_obj.report.append(f'  {line}')
 
+  # Add thermal guard details to report
+  if sensors.thermal_guard:
+    guard = sensors.thermal_guard
+    test_obj.report.append(std.color_string(
+      f'  Stopped early, {guard["Source"]} was projected to reach '
+      f'{cfg.hw.CPU_CRITICAL_TEMP}°C in {guard["Seconds"]:.1f}s',
+      'YELLOW',
+      ))
+    test_obj.report.append(
+      f'  Triggered at: {hw_sensors.get_temp_str(guard["Temp"])}'
+      f' ({guard["Slope"]:.1f}°C/s)'
+      f'  Peak after: {hw_sensors.get_temp_str(guard["Peak"])}'
+      )
+
 
 def check_io_benchmark_results(test_obj, rate_list, graph_width):
   """Generate colored report using rate_list, returns list of str."""
@@ -629,8 +1133,58 @@ def check_io_benchmark_results(test_obj, rate_list, graph_width):
     test_obj.set_status('Unknown')
 
 
-def check_mprime_results(test_obj, working_dir):
-  """Check mprime log files and update test_obj."""
+def check_latency_results(test_obj, results):
+  """Generate report using latency results and set status.
+
+  NOTE: Thresholds are compared using the first queue depth tested.
+  """
+  if test_obj.dev.details['ssd']:
+    thresh_iops = cfg.hw.THRESH_SSD_IOPS_MIN
+    thresh_p99 = cfg.hw.THRESH_SSD_LATENCY_P99
+    thresh_p999 = cfg.hw.THRESH_SSD_LATENCY_P999
+  else:
+    thresh_iops = cfg.hw.THRESH_HDD_IOPS_MIN
+    thresh_p99 = cfg.hw.THRESH_HDD_LATENCY_P99
+    thresh_p999 = cfg.hw.THRESH_HDD_LATENCY_P999
+
+  # Add results to report
+  for queue_depth, latencies in results.items():
+    stats = get_latency_stats(latencies, cfg.hw.LATENCY_TEST_DURATION)
+    test_obj.report.append(
+      f'QD{queue_depth:<3} IOPS: {stats["IOPS"]:.0f}'
+      f'  p50: {format_latency(stats["p50"])}'
+      f'  p99: {format_latency(stats["p99"])}'
+      f'  p99.9: {format_latency(stats["p99.9"])}'
+      f'  max: {format_latency(stats["max"])}'
+      )
+    test_obj.report.append(
+      '       '
+      + '  '.join(
+        f'{label}: {count}' for label, count in get_latency_histogram(latencies)
+        ),
+      )
+
+  # Compare against thresholds
+  first_results = next(iter(results.values()), None)
+  if not first_results:
+    test_obj.set_status('Unknown')
+    return
+  stats = get_latency_stats(first_results, cfg.hw.LATENCY_TEST_DURATION)
+  if (stats['IOPS'] < thresh_iops
+      or stats['p99'] > thresh_p99 * 1000**3
+      or stats['p99.9'] > thresh_p999 * 1000**3):
+    test_obj.failed = True
+    test_obj.set_status('Failed')
+  else:
+    test_obj.passed = True
+    test_obj.set_status('Passed')
+
+
+def check_mprime_results(test_obj, working_dir, monitor=None):
+  """Check mprime log files and update test_obj.
+
+  NOTE: Errors found by the MprimeMonitor are included if provided.
+  """
   passing_lines = {}
   warning_lines = {}
 
@@ -646,6 +1200,15 @@ def check_mprime_results(test_obj, working_dir):
 
     return lines
 
+  # Live output (check if failed early)
+  if monitor and monitor.errors:
+    for line in monitor.errors:
+      warning_lines[line] = None
+    elapsed = int(monitor.failed_after)
+    warning_lines[
+      f'Stopped early after {elapsed // 60}:{elapsed % 60:02d}'
+      ] = None
+
   # results.txt (check if failed)
   for line in _read_file('results.txt'):
     line = line.strip()
@@ -655,8 +1218,7 @@ def check_mprime_results(test_obj, working_dir):
   # print.log (check if passed)
   for line in _read_file('prime.log'):
     line = line.strip()
-    match = re.search(
-      r'(completed.*(\d+) errors, (\d+) warnings)', line, re.IGNORECASE)
+    match = MPRIME_COMPLETED_REGEX.search(line)
     if match:
       if int(match.group(2)) + int(match.group(3)) > 0:
         # Errors and/or warnings encountered
@@ -738,17 +1300,18 @@ def cpu_stress_tests(state, test_objects):
 
   # Create monitor and worker panes
   state.update_progress_pane()
-  state.panes['Prime95'] = tmux.split_window(
-    lines=10, vertical=True, watch_file=prime_log, watch_cmd='tail')
-  if PLATFORM == 'Darwin':
-    state.panes['Temps'] = tmux.split_window(
-      behind=True, percent=80, vertical=True, cmd='./hw-sensors')
-  elif PLATFORM == 'Linux':
-    state.panes['Temps'] = tmux.split_window(
-      behind=True, percent=80, vertical=True, watch_file=sensors_out)
-  tmux.resize_pane(height=3)
-  state.panes['Current'] = ''
-  state.layout['Current'] = {'height': 3, 'Check': True}
+  with state.ui_lock:
+    state.panes['Prime95'] = tmux.split_window(
+      lines=10, vertical=True, watch_file=prime_log, watch_cmd='tail')
+    if PLATFORM == 'Darwin':
+      state.panes['Temps'] = tmux.split_window(
+        behind=True, percent=80, vertical=True, cmd='./hw-sensors')
+    elif PLATFORM == 'Linux':
+      state.panes['Temps'] = tmux.split_window(
+        behind=True, percent=80, vertical=True, watch_file=sensors_out)
+    tmux.resize_pane(height=3)
+    state.panes['Current'] = ''
+    state.layout['Current'] = {'height': 3, 'Check': True}
 
   # Get idle temps
   std.print_standard('Saving idle temps...')
@@ -757,20 +1320,27 @@ def cpu_stress_tests(state, test_objects):
   # Stress CPU
   std.print_info('Running stress test')
   set_apple_fan_speed('max')
-  proc_mprime = start_mprime(state.log_dir, prime_log)
+  proc_mprime, mprime_monitor = start_mprime(state.log_dir, prime_log)
 
   # Show countdown
   print('')
   try:
-    print_countdown(proc=proc_mprime, seconds=cfg.hw.CPU_TEST_MINUTES*60)
+    print_countdown(
+      proc=proc_mprime,
+      seconds=cfg.hw.CPU_TEST_MINUTES*60,
+      abort_event=state.abort_event,
+      )
   except KeyboardInterrupt:
     aborted = True
 
   # Stop Prime95
   stop_mprime(proc_mprime)
+  mprime_monitor.wait()
+  if mprime_monitor.errors:
+    std.print_warning(f'Prime95 stopped early: {mprime_monitor.errors[0]}')
 
   # Update progress if necessary
-  if sensors.cpu_reached_critical_temp() or aborted:
+  if sensors.cpu_reached_critical_temp() or sensors.thermal_guard or aborted:
     test_cooling_obj.set_status('Aborted')
     test_mprime_obj.set_status('Aborted')
     state.update_progress_pane()
@@ -784,7 +1354,11 @@ def cpu_stress_tests(state, test_objects):
 
   # Check Prime95 results
   test_mprime_obj.report.append(std.color_string('Prime95', 'BLUE'))
-  check_mprime_results(test_obj=test_mprime_obj, working_dir=state.log_dir)
+  check_mprime_results(
+    test_obj=test_mprime_obj,
+    working_dir=state.log_dir,
+    monitor=mprime_monitor,
+    )
 
   # Run Sysbench test if necessary
   run_sysbench = (
@@ -804,7 +1378,11 @@ def cpu_stress_tests(state, test_objects):
       pane=state.panes['Prime95'],
       )
     try:
-      print_countdown(proc=proc_sysbench, seconds=cfg.hw.CPU_TEST_MINUTES*60)
+      print_countdown(
+        proc=proc_sysbench,
+        seconds=cfg.hw.CPU_TEST_MINUTES*60,
+        abort_event=state.abort_event,
+        )
     except AttributeError:
       # Assuming the sysbench process wasn't found and proc was set to None
       LOG.error('Failed to find sysbench process', exc_info=True)
@@ -815,7 +1393,7 @@ def cpu_stress_tests(state, test_objects):
     # Update progress
     # NOTE: CPU critical temp check isn't really necessary
     #       Hard to imagine it wasn't hit during Prime95 but was in sysbench
-    if sensors.cpu_reached_critical_temp() or aborted:
+    if sensors.cpu_reached_critical_temp() or sensors.thermal_guard or aborted:
       test_cooling_obj.set_status('Aborted')
       test_mprime_obj.set_status('Aborted')
       state.update_progress_pane()
@@ -827,9 +1405,10 @@ def cpu_stress_tests(state, test_objects):
   # Cleanup
   state.update_progress_pane()
   sensors.stop_background_monitor()
-  state.panes.pop('Current', None)
-  tmux.kill_pane(state.panes.pop('Prime95', None))
-  tmux.kill_pane(state.panes.pop('Temps', None))
+  with state.ui_lock:
+    state.panes.pop('Current', None)
+    tmux.kill_pane(state.panes.pop('Prime95', None))
+    tmux.kill_pane(state.panes.pop('Temps', None))
 
   # Done
   if aborted:
@@ -856,11 +1435,17 @@ def disk_attribute_check(state, test_objects):
   state.update_progress_pane()
 
 
-def disk_io_benchmark(state, test_objects, skip_usb=True):
+def disk_io_benchmark(state, test_objects, skip_usb=True, parallel=False):
   # pylint: disable=too-many-statements
-  """Disk I/O benchmark using dd."""
-  LOG.info('Disk I/O Benchmark (dd)')
-  aborted = False
+  """Disk I/O benchmark using direct reads (or dd).
+
+  NOTE: If parallel is True then disks on separate controllers are
+        tested at the same time.
+  """
+  LOG.info('Disk I/O Benchmark')
+  abort_event = state.abort_event
+  lock = threading.Lock()
+  tests = []
 
   def _run_io_benchmark(test_obj, log_path):
     """Run I/O benchmark and handle exceptions."""
@@ -869,8 +1454,8 @@ def disk_io_benchmark(state, test_objects, skip_usb=True):
       # Use "RAW" disks under macOS
       dev_path = dev_path.with_name(f'r{dev_path.name}')
       LOG.info('Using %s for better performance', dev_path)
-    offset = 0
     read_rates = []
+    reader = None
     test_obj.report.append(std.color_string('I/O Benchmark', 'BLUE'))
 
     # Get dd values or bail
@@ -883,65 +1468,69 @@ def disk_io_benchmark(state, test_objects, skip_usb=True):
         )
       return
 
-    # Run dd read tests
-    for _i in range(dd_values['Read Chunks']):
-      _i += 1
-
-      # Build cmd
-      skip = dd_values['Skip Blocks']
-      if dd_values['Skip Extra'] and _i % dd_values['Skip Extra'] == 0:
-        skip += 1
-      cmd = [
-        'sudo', 'dd',
-        f'bs={IO_BLOCK_SIZE}',
-        f'skip={offset+skip}',
-        f'count={dd_values["Read Blocks"]}',
-        f'if={dev_path}',
-        'of=/dev/null',
-        ]
-      if PLATFORM == 'Linux':
-        cmd.append('iflag=direct')
-
-      # Run and get read rate
-      try:
-        proc = exe.run_program(
-          cmd,
-          pipe=False,
-          stdout=subprocess.PIPE,
-          stderr=subprocess.STDOUT,
-          )
-      except PermissionError as err:
-        # Since we're using sudo we can't kill dd
-        # Assuming this happened during a CTRL+c
-        raise KeyboardInterrupt from err
-      match = IO_RATE_REGEX.search(proc.stdout)
-      if match:
-        read_rates.append(
-          int(match.group('bytes')) / float(match.group('seconds')),
-          )
-        match.group(1)
-
-      # Show progress
-      with open(log_path, 'a', encoding='utf-8') as _f:
-        if _i % 5 == 0:
-          percent = (_i / dd_values['Read Chunks']) * 100
-          _f.write(f'  {graph.vertical_graph_line(percent, read_rates[-1])}\n')
+    # Open device
+    # NOTE: dd is used instead if the device can't be opened directly
+    try:
+      reader = DirectIOReader(dev_path)
+    except OSError as err:
+      LOG.warning('Falling back to dd for %s: %s', dev_path, err)
 
-      # Update offset
-      offset += dd_values['Read Blocks'] + skip
+    # Run read tests
+    try:
+      for _i, offset in enumerate(get_io_offsets(dd_values), start=1):
+        if abort_event.is_set():
+          raise KeyboardInterrupt
+        if reader:
+          read_rates.append(
+            reader.read_chunk(offset, dd_values['Read Blocks']),
+            )
+        else:
+          rate = run_io_chunk_dd(dev_path, offset, dd_values['Read Blocks'])
+          if rate:
+            read_rates.append(rate)
+
+        # Show progress
+        with open(log_path, 'a', encoding='utf-8') as _f:
+          if _i % 5 == 0:
+            percent = (_i / dd_values['Read Chunks']) * 100
+            _f.write(
+              f'  {graph.vertical_graph_line(percent, read_rates[-1])}\n',
+              )
+    finally:
+      if reader:
+        reader.close()
 
     # Check results
     check_io_benchmark_results(test_obj, read_rates, IO_GRAPH_WIDTH)
 
-  # Run benchmarks
-  state.update_top_pane(
-    f'Disk I/O Benchmark{"s" if len(test_objects) > 1 else ""}',
-    )
-  state.panes['I/O Benchmark'] = tmux.split_window(
-    percent=50,
-    vertical=True,
-    text=' ',
-    )
+  def _run_tests(test_list):
+    """Run benchmarks for test_list in order and handle exceptions."""
+    for test_obj in test_list:
+      if abort_event.is_set():
+        break
+      with lock:
+        test_obj.set_status('Working')
+        state.update_progress_pane()
+      try:
+        _run_io_benchmark(
+          test_obj,
+          f'{state.log_dir}/{test_obj.dev.path.name}_benchmark.out',
+          )
+      except KeyboardInterrupt:
+        abort_event.set()
+      except (
+          OSError, subprocess.CalledProcessError, TypeError, ValueError,
+          ) as err:
+        # Something went wrong
+        LOG.error('%s', err)
+        test_obj.set_status('ERROR')
+        test_obj.report.append(std.color_string('  Unknown Error', 'RED'))
+
+      # Update progress after each test
+      with lock:
+        state.update_progress_pane()
+
+  # Get tests
   for test in test_objects:
     if test.disabled:
       # Skip
@@ -951,28 +1540,167 @@ def disk_io_benchmark(state, test_objects, skip_usb=True):
     if skip_usb and test.dev.details['bus'] == 'USB':
       test.set_status('Skipped')
       continue
+    tests.append(test)
 
-    # Start benchmark
-    if not aborted:
+  # Run benchmarks
+  state.update_top_pane(
+    f'Disk I/O Benchmark{"s" if len(test_objects) > 1 else ""}',
+    )
+  state.panes['I/O Benchmark'] = []
+  if parallel and tests:
+    # Add a pane for each disk
+    for _i, test in enumerate(tests):
+      test_log = f'{state.log_dir}/{test.dev.path.name}_benchmark.out'
+      with state.ui_lock:
+        if _i == 0:
+          pane = tmux.split_window(
+            percent=50, vertical=True, watch_cmd='tail', watch_file=test_log,
+            )
+        else:
+          pane = tmux.split_window(
+            percent=int(100 * (len(tests) - _i) / (len(tests) - _i + 1)),
+            target_id=state.panes['I/O Benchmark'][-1],
+            watch_cmd='tail',
+            watch_file=test_log,
+            )
+        state.panes['I/O Benchmark'].append(pane)
+
+    # Run benchmarks for each controller in parallel
+    std.clear_screen()
+    groups = OrderedDict()
+    for test in tests:
+      std.print_report(test.dev.generate_report())
+      groups.setdefault(get_controller_id(test.dev.path), []).append(test)
+    LOG.info('I/O Benchmark groups: %s', list(groups.keys()))
+    threads = [
+      exe.start_thread(_run_tests, [group]) for group in groups.values()
+      ]
+    for thread in threads:
+      while thread.is_alive():
+        try:
+          thread.join(timeout=1)
+        except KeyboardInterrupt:
+          abort_event.set()
+  else:
+    with state.ui_lock:
+      state.panes['I/O Benchmark'].append(
+        tmux.split_window(percent=50, vertical=True, text=' '),
+        )
+    for test in tests:
+      if abort_event.is_set():
+        break
       std.clear_screen()
       std.print_report(test.dev.generate_report())
-      test.set_status('Working')
-      test_log = f'{state.log_dir}/{test.dev.path.name}_benchmark.out'
       tmux.respawn_pane(
-        state.panes['I/O Benchmark'],
+        state.panes['I/O Benchmark'][0],
         watch_cmd='tail',
-        watch_file=test_log,
+        watch_file=f'{state.log_dir}/{test.dev.path.name}_benchmark.out',
+        )
+      _run_tests([test])
+
+  # Mark test(s) aborted if necessary
+  if abort_event.is_set():
+    for test in tests:
+      if test.status in ('Pending', 'Working'):
+        test.set_status('Aborted')
+        test.report.append(std.color_string('  Aborted', 'YELLOW'))
+
+  # Cleanup
+  state.update_progress_pane()
+  with state.ui_lock:
+    tmux.kill_pane(*state.panes.pop('I/O Benchmark', []))
+
+  # Done
+  if abort_event.is_set():
+    raise std.GenericAbort('Aborted')
+
+
+def disk_latency_test(state, test_objects):
+  """Disk latency test using random reads at multiple queue depths."""
+  LOG.info('Disk Latency Test')
+  aborted = False
+  stop_event = state.abort_event
+
+  def _read_random_blocks(fd, block_count, deadline):
+    """Read random blocks until deadline, returns array of latencies (ns).
+
+    NOTE: This should be called as a thread.
+    """
+    block_size = cfg.hw.LATENCY_BLOCK_SIZE
+    buffer = mmap.mmap(-1, block_size)
+    latencies = array('Q')
+    try:
+      while not stop_event.is_set() and time.monotonic() < deadline:
+        offset = random.randrange(block_count) * block_size
+        start = time.perf_counter_ns()
+        os.preadv(fd, [buffer], offset)
+        latencies.append(time.perf_counter_ns() - start)
+    finally:
+      buffer.close()
+    return latencies
+
+  def _run_latency_test(test_obj):
+    """Run latency test for all queue depths, returns dict.
+
+    NOTE: The device is opened once and shared by all reader threads.
+    """
+    block_count = test_obj.dev.details['size'] // cfg.hw.LATENCY_BLOCK_SIZE
+    results = {}
+    fd = open_device(
+      test_obj.dev.path, os.O_RDONLY | getattr(os, 'O_DIRECT', 0),
+      )
+    try:
+      for queue_depth in cfg.hw.LATENCY_QUEUE_DEPTHS:
+        std.print_standard(f'  Queue depth {queue_depth}...', flush=True)
+        deadline = time.monotonic() + cfg.hw.LATENCY_TEST_DURATION
+        with ThreadPoolExecutor(max_workers=queue_depth) as executor:
+          futures = [
+            executor.submit(_read_random_blocks, fd, block_count, deadline)
+            for _ in range(queue_depth)
+            ]
+          try:
+            latencies = array('Q')
+            for future in futures:
+              latencies.extend(future.result())
+          except KeyboardInterrupt:
+            stop_event.set()
+            raise
+        results[queue_depth] = latencies
+    finally:
+      os.close(fd)
+    return results
+
+  # Run tests
+  state.update_top_pane(
+    f'Disk Latency Test{"s" if len(test_objects) > 1 else ""}',
+    )
+  std.clear_screen()
+  for test in test_objects:
+    if test.disabled:
+      # Skip
+      continue
+
+    # Start test
+    aborted = aborted or stop_event.is_set()
+    if not aborted:
+      std.print_info(f'Testing {test.dev.path}...')
+      test.set_status('Working')
+      test.report.append(
+        std.color_string('Latency (4K random reads)', 'BLUE'),
         )
       state.update_progress_pane()
       try:
-        _run_io_benchmark(test, test_log)
+        results = _run_latency_test(test)
+        if stop_event.is_set():
+          raise KeyboardInterrupt
+        check_latency_results(test, results)
       except KeyboardInterrupt:
         aborted = True
-      except (subprocess.CalledProcessError, TypeError, ValueError) as err:
-        # Something went wrong
+      except OSError as err:
+        # Failed to open device, read error(s), or O_DIRECT not supported
         LOG.error('%s', err)
         test.set_status('ERROR')
-        test.report.append(std.color_string('  Unknown Error', 'RED'))
+        test.report.append(std.color_string(f'  {err}', 'RED'))
 
     # Mark test(s) aborted if necessary
     if aborted:
@@ -982,22 +1710,81 @@ def disk_io_benchmark(state, test_objects, skip_usb=True):
     # Update progress after each test
     state.update_progress_pane()
 
-  # Cleanup
-  state.update_progress_pane()
-  tmux.kill_pane(state.panes.pop('I/O Benchmark', None))
-
   # Done
   if aborted:
     raise std.GenericAbort('Aborted')
 
 
+def disk_sampled_scan(state, test_objects):
+  """Read-only sampled disk surface scan using direct reads.
+
+  NOTE: A full surface scan is run if any read errors are found.
+  """
+  LOG.info('Disk Surface Scan (Sampled)')
+  abort_event = state.abort_event
+
+  def _run_sampled_scan(test_obj, dev_path, log_path):
+    """Run sampled scan and escalate to a full scan if necessary."""
+    scan = SampledSurfaceScan(
+      dev_path, test_obj.dev.details['size'], log_path, abort_event,
+      )
+    try:
+      completed = scan.run(cfg.hw.SAMPLED_SCAN_SECONDS)
+    except OSError as err:
+      LOG.error('Failed to open %s: %s', dev_path, err)
+      test_obj.report.append(std.color_string(f'  {err}', 'RED'))
+      test_obj.set_status('ERROR')
+      return
+    test_obj.report.append(std.color_string('Sampled Surface Scan', 'BLUE'))
+    test_obj.report.append(
+      f'  {scan.regions_read} regions read from {scan.strata} strata, '
+      f'{100 * scan.get_coverage():.2f}% coverage',
+      )
+    if not completed:
+      return
+
+    # Check results
+    if scan.bad_regions:
+      test_obj.failed = True
+      test_obj.report.append(
+        std.color_string(
+          f'  Read error found at offset {scan.bad_regions[0]}, '
+          'running full scan', 'YELLOW',
+          ),
+        )
+      if not run_native_surface_scan(test_obj, dev_path, log_path, abort_event):
+        test_obj.report.append(
+          std.color_string('  Failed to run full scan', 'YELLOW'),
+          )
+      # NOTE: Sampled read errors fail the test even if the full scan passes
+      test_obj.passed = False
+      test_obj.set_status('Failed')
+    else:
+      test_obj.passed = True
+      test_obj.report.append(
+        f'  No errors found, defect rate < '
+        f'{100 * scan.get_defect_rate_bound():.3f}% of regions '
+        '(95% confidence)',
+        )
+      test_obj.set_status('Passed')
+
+  # Update panes
+  state.update_top_pane(
+    f'Disk Surface Scan{"s" if len(test_objects) > 1 else ""} (Sampled)',
+    )
+
+  # Run sampled scans
+  run_surface_scans(
+    state, test_objects, _run_sampled_scan, 'Sampled Scan', 'sampled_scan',
+    )
+
+
 def disk_self_test(state, test_objects):
   # pylint: disable=too-many-statements
   """Disk self-test if available."""
   LOG.info('Disk Self-Test(s)')
   aborted = False
   threads = []
-  state.panes['SMART'] = []
 
   def _run_self_test(test_obj, log_path):
     """Run self-test and handle exceptions."""
@@ -1028,7 +1815,6 @@ def disk_self_test(state, test_objects):
   state.update_top_pane(
     f'Disk self-test{"s" if len(test_objects) > 1 else ""}',
     )
-  std.print_info(f'Starting self-test{"s" if len(test_objects) > 1 else ""}')
   for test in reversed(test_objects):
     if test.disabled:
       # Skip
@@ -1041,16 +1827,14 @@ def disk_self_test(state, test_objects):
 
     # Show progress
     if threads[-1].is_alive():
-      state.panes['SMART'].append(
-        tmux.split_window(lines=4, vertical=True, watch_file=test_log),
-        )
+      state.add_test_pane('SMART', lines=4, watch_file=test_log)
 
   # Wait for all tests to complete
   state.update_progress_pane()
   try:
     while True:
       if any(t.is_alive() for t in threads):
-        std.sleep(1)
+        state.sleep(1)
       else:
         break
   except KeyboardInterrupt:
@@ -1065,9 +1849,9 @@ def disk_self_test(state, test_objects):
 
   # Cleanup
   state.update_progress_pane()
-  for pane in state.panes['SMART']:
-    tmux.kill_pane(pane)
-  state.panes.pop('SMART', None)
+  with state.ui_lock:
+    for pane in state.panes.pop('SMART', []):
+      tmux.kill_pane(pane)
 
   # Done
   if aborted:
@@ -1076,23 +1860,27 @@ def disk_self_test(state, test_objects):
 
 def disk_surface_scan(state, test_objects):
   # pylint: disable=too-many-branches,too-many-statements
-  """Read-only disk surface scan using badblocks."""
-  LOG.info('Disk Surface Scan (badblocks)')
-  aborted = False
-  threads = []
-  state.panes['badblocks'] = []
+  """Read-only disk surface scan using direct reads (or badblocks)."""
+  LOG.info('Disk Surface Scan')
+  abort_event = state.abort_event
 
-  def _run_surface_scan(test_obj, log_path):
+  def _run_surface_scan(test_obj, dev_path, log_path):
     """Run surface scan and handle exceptions."""
     block_size = '1024'
     dev = test_obj.dev
-    dev_path = test_obj.dev.path
-    if PLATFORM == 'Darwin':
-      # Use "RAW" disks under macOS
-      dev_path = dev_path.with_name(f'r{dev_path.name}')
-      LOG.info('Using %s for better performance', dev_path)
+
+    # Show failed attributes in the scan pane
+    failed_attributes = [
+      line for line in dev.generate_attribute_report() if 'failed' in line
+      ]
+    if failed_attributes:
+      with open(log_path, 'a', encoding='utf-8') as _f:
+        _f.write('\n'.join([*failed_attributes, '', '']))
+
+    # Run native scan if possible
+    if run_native_surface_scan(test_obj, dev_path, log_path, abort_event):
+      return
     test_obj.report.append(std.color_string('badblocks', 'BLUE'))
-    test_obj.set_status('Working')
 
     # Increase block size if necessary
     if (dev.details['phy-sec'] == 4096
@@ -1102,15 +1890,6 @@ def disk_surface_scan(state, test_objects):
     # Start scan
     cmd = ['sudo', 'badblocks', '-sv', '-b', block_size, '-e', '1', dev_path]
     with open(log_path, 'a', encoding='utf-8') as _f:
-      size_str = std.bytes_to_string(dev.details["size"], use_binary=False)
-      _f.write(
-        std.color_string(
-          ['[', dev.path.name, ' ', size_str, ']\n'],
-          [None, 'BLUE', None, 'CYAN', None],
-          sep='',
-          ),
-        )
-      _f.flush()
       exe.run_program(
         cmd,
         check=False,
@@ -1145,71 +1924,88 @@ def disk_surface_scan(state, test_objects):
   state.update_top_pane(
     f'Disk Surface Scan{"s" if len(test_objects) > 1 else ""}',
     )
-  std.print_info(
-    f'Starting disk surface scan{"s" if len(test_objects) > 1 else ""}',
-    )
-  for disk in state.disks:
-    failed_attributes = [
-      line for line in disk.generate_attribute_report() if 'failed' in line
-      ]
-    if failed_attributes:
-      size_str = std.bytes_to_string(disk.details["size"], use_binary=False)
-      std.print_colored(
-        ['[', disk.path.name, ' ', size_str, ']'],
-        [None, 'BLUE', None, 'CYAN', None],
-        sep='',
-        )
-      #std.print_colored([disk.path.name, disk.description], [None, 'BLUE'])
-      std.print_report(failed_attributes)
-      std.print_standard('')
 
   # Run surface scans
-  for test in reversed(test_objects):
-    if test.disabled:
-      # Skip
-      continue
+  run_surface_scans(
+    state, test_objects, _run_surface_scan, 'badblocks', 'badblocks',
+    )
 
-    # Start thread
-    test_log = f'{state.log_dir}/{test.dev.path.name}_badblocks.log'
-    threads.append(exe.start_thread(_run_surface_scan, args=(test, test_log)))
 
-    # Show progress
-    if threads[-1].is_alive():
-      state.panes['badblocks'].append(
-        tmux.split_window(
-          lines=5,
-          vertical=True,
-          watch_cmd='tail',
-          watch_file=test_log,
-          ),
-        )
+def format_latency(nanoseconds):
+  """Format latency for reports, returns str."""
+  if nanoseconds < 1000**2:
+    return f'{nanoseconds/1000:.0f}us'
+  if nanoseconds < 1000**3:
+    return f'{nanoseconds/1000**2:.1f}ms'
+  return f'{nanoseconds/1000**3:.2f}s'
 
-  # Wait for all tests to complete
+
+def get_controller_id(dev_path):
+  """Get host controller ID for dev_path using sysfs, returns str.
+
+  Disks sharing a SATA port (e.g. port multipliers), USB bus, NVMe or
+  virtio controller, or SCSI host share the same ID.
+
+  NOTE: 'Unknown' is returned if the controller can't be determined.
+  """
   try:
-    while True:
-      if any(t.is_alive() for t in threads):
-        state.update_progress_pane()
-        std.sleep(5)
-      else:
+    sys_path = pathlib.Path(f'/sys/block/{dev_path.name}').resolve(strict=True)
+  except OSError:
+    return 'Unknown'
+
+  # Check for controller in path
+  for regex in (r'(ata|nvme|usb|virtio)\d+', r'host\d+'):
+    for index, part in enumerate(sys_path.parts):
+      if re.fullmatch(regex, part):
+        return '/'.join(sys_path.parts[:index+1])
+
+  # Unknown controller
+  return 'Unknown'
+
+
+def get_io_offsets(dd_values):
+  """Get I/O benchmark read offsets (in blocks), returns generator.
+
+  NOTE: dd_values should be from calc_io_dd_values().
+  """
+  offset = 0
+  for _i in range(1, dd_values['Read Chunks']+1):
+    skip = dd_values['Skip Blocks']
+    if dd_values['Skip Extra'] and _i % dd_values['Skip Extra'] == 0:
+      skip += 1
+    yield offset + skip
+    offset += dd_values['Read Blocks'] + skip
+
+
+def get_latency_histogram(latencies):
+  """Get histogram of latencies using LATENCY_HISTOGRAM_BUCKETS.
+
+  Returns a list of (label, count) tuples.
+  """
+  counts = [0] * len(LATENCY_HISTOGRAM_BUCKETS)
+  for latency in latencies:
+    for index, (limit, _) in enumerate(LATENCY_HISTOGRAM_BUCKETS):
+      if latency < limit:
+        counts[index] += 1
         break
-  except KeyboardInterrupt:
-    aborted = True
-    std.sleep(0.5)
-    # Handle aborts
-    for test in test_objects:
-      if not (test.disabled or test.passed or test.failed):
-        test.set_status('Aborted')
-        test.report.append(std.color_string('  Aborted', 'YELLOW'))
+  return [
+    (label, count)
+    for (_, label), count in zip(LATENCY_HISTOGRAM_BUCKETS, counts)
+    ]
 
-  # Cleanup
-  state.update_progress_pane()
-  for pane in state.panes['badblocks']:
-    tmux.kill_pane(pane)
-  state.panes.pop('badblocks', None)
 
-  # Done
-  if aborted:
-    raise std.GenericAbort('Aborted')
+def get_latency_stats(latencies, duration):
+  """Get IOPS and latency percentiles (in ns), returns dict."""
+  stats = {'IOPS': len(latencies) / duration}
+  latencies = sorted(latencies)
+  if not latencies:
+    latencies = [0]
+  for name, percentile in (('p50', 0.5), ('p99', 0.99), ('p99.9', 0.999)):
+    stats[name] = latencies[min(
+      len(latencies) - 1, int(percentile * len(latencies)),
+      )]
+  stats['max'] = latencies[-1]
+  return stats
 
 
 def keyboard_test():
@@ -1325,9 +2121,54 @@ def network_test():
   std.pause('Press Enter to return to main menu...')
 
 
-def print_countdown(proc, seconds):
-  """Print countdown to screen while proc is alive."""
+def open_device(dev_path, flags=os.O_RDONLY):
+  """Open device, returns file descriptor.
+
+  If the device can't be opened directly (e.g. the live user isn't in
+  the disk group) it's opened by a small helper run via sudo which
+  passes the descriptor back over a socket. Reads then stay in-process
+  instead of running dd for each read.
+
+  NOTE: An OSError is raised if the device can't be opened either way.
+  """
+  try:
+    return os.open(dev_path, flags)
+  except PermissionError:
+    LOG.info('Opening %s via sudo', dev_path)
+
+  # Open via helper
+  parent_sock, child_sock = socket.socketpair()
+  with parent_sock:
+    with child_sock:
+      proc = exe.run_program(
+        [
+          'sudo', sys.executable, '-c', OPEN_DEVICE_SCRIPT,
+          str(dev_path), str(flags),
+          ],
+        check=False,
+        stdin=child_sock,
+        )
+    _, ancdata, _, _ = parent_sock.recvmsg(
+      1, socket.CMSG_SPACE(array('i').itemsize),
+      )
+  for level, kind, data in ancdata:
+    if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+      return array('i', data[:array('i').itemsize])[0]
+
+  # Failed
+  error = (proc.stderr.strip().splitlines() or ['Unknown error'])[-1]
+  raise OSError(f'Failed to open {dev_path} via sudo: {error}')
+
+
+def print_countdown(proc, seconds, abort_event=None):
+  """Print countdown to screen while proc is alive.
+
+  NOTE: KeyboardInterrupt is raised if abort_event is set.
+  """
   for i in range(seconds):
+    if abort_event and abort_event.is_set():
+      print('')
+      raise KeyboardInterrupt
     sec_left = (seconds - i) % 60
     min_left = int((seconds - i) / 60)
 
@@ -1352,6 +2193,93 @@ def print_countdown(proc, seconds):
   print('')
 
 
+def run_io_chunk_dd(dev_path, offset, count):
+  """Read count blocks starting at offset using dd, returns float or None.
+
+  The rate is returned in bytes per second.
+  """
+  cmd = [
+    'sudo', 'dd',
+    f'bs={IO_BLOCK_SIZE}',
+    f'skip={offset}',
+    f'count={count}',
+    f'if={dev_path}',
+    'of=/dev/null',
+    ]
+  if PLATFORM == 'Linux':
+    cmd.append('iflag=direct')
+
+  # Run and get read rate
+  try:
+    proc = exe.run_program(
+      cmd,
+      pipe=False,
+      stdout=subprocess.PIPE,
+      stderr=subprocess.STDOUT,
+      )
+  except PermissionError as err:
+    # Since we're using sudo we can't kill dd
+    # Assuming this happened during a CTRL+c
+    raise KeyboardInterrupt from err
+  match = IO_RATE_REGEX.search(proc.stdout)
+  if not match:
+    return None
+  return int(match.group('bytes')) / float(match.group('seconds'))
+
+
+def run_native_surface_scan(test_obj, dev_path, log_path, abort_event):
+  """Run surface scan using direct reads, returns bool.
+
+  NOTE: The device is opened via sudo if necessary (see open_device()).
+        False is returned if it still couldn't be opened.
+  """
+  scan = SurfaceScan(test_obj.dev, dev_path, log_path, abort_event)
+  scan.load_checkpoint()
+  try:
+    completed = scan.run()
+  except OSError as err:
+    LOG.warning('Falling back to badblocks for %s: %s', dev_path, err)
+    test_obj.report.append(
+      std.color_string(f'  Direct reads unavailable: {err}', 'YELLOW'),
+      )
+    return False
+  test_obj.report.append(std.color_string('Surface Scan', 'BLUE'))
+  if scan.resumed_from:
+    test_obj.report.append(
+      f'  Resumed from {100 * scan.resumed_from / scan.size:.2f}%',
+      )
+
+  # Check results
+  if not completed:
+    test_obj.report.append(
+      std.color_string(
+        f'  Stopped at {100 * scan.position / scan.size:.2f}%, '
+        'progress saved', 'YELLOW',
+        ),
+      )
+    return True
+  line = (
+    f'Pass completed, {len(scan.bad_sectors)} bad blocks found. '
+    f'(0/0/{len(scan.bad_sectors)} errors)'
+    )
+  if scan.bad_sectors:
+    test_obj.failed = True
+    test_obj.report.append(f'  {std.color_string(line, "YELLOW")}')
+    test_obj.report.append(
+      std.color_string(
+        f'  Bad sector(s): {", ".join(map(str, scan.bad_sectors[:10]))}'
+        f'{" ..." if len(scan.bad_sectors) > 10 else ""}',
+        'YELLOW',
+        ),
+      )
+    test_obj.set_status('Failed')
+  else:
+    test_obj.passed = True
+    test_obj.report.append(f'  {line}')
+    test_obj.set_status('Passed')
+  return True
+
+
 def run_diags(state, menu, quick_mode=False):
   """Run selected diagnostics."""
   aborted = False
@@ -1365,28 +2293,12 @@ def run_diags(state, menu, quick_mode=False):
     return
 
   # Run tests
-  for name, details in state.tests.items():
-    if not details['Enabled']:
-      # Skip disabled tests
-      continue
-
-    # Run test(s)
-    function = details['Function']
-    args = [details['Objects']]
-    if name == 'Disk I/O Benchmark':
-      args.append(menu.toggles['Skip USB Benchmarks']['Selected'])
-    std.clear_screen()
-    try:
-      function(state, *args)
-    except (KeyboardInterrupt, std.GenericAbort):
-      aborted = True
-      state.abort_testing()
-      state.update_progress_pane()
-      break
-
-    # Run safety checks
-    if name.startswith('Disk'):
-      state.disk_safety_checks(wait_for_self_tests=name != 'Disk Attributes')
+  try:
+    run_tests(state, menu)
+  except (KeyboardInterrupt, std.GenericAbort):
+    aborted = True
+    state.abort_testing()
+    state.update_progress_pane()
 
   # Handle aborts
   if aborted:
@@ -1407,6 +2319,165 @@ def run_diags(state, menu, quick_mode=False):
     std.pause('Press Enter to return to main menu...')
 
 
+def run_surface_scans(state, test_objects, scan_function, pane, log_suffix):
+  """Run surface scans in parallel and wait for them to finish.
+
+  scan_function is called in a thread for each enabled test as
+  scan_function(test_obj, dev_path, log_path) after the device header is
+  written to the log. Each log is shown in a pane saved under
+  state.panes[pane].
+
+  NOTE: state.abort_event is set if interrupted so scans can save their
+        progress before GenericAbort is raised.
+  """
+  aborted = False
+  threads = []
+
+  def _run_scan(test_obj, log_path):
+    """Write device header to log and run scan_function."""
+    dev = test_obj.dev
+    dev_path = test_obj.dev.path
+    if PLATFORM == 'Darwin':
+      # Use "RAW" disks under macOS
+      dev_path = dev_path.with_name(f'r{dev_path.name}')
+      LOG.info('Using %s for better performance', dev_path)
+    test_obj.set_status('Working')
+    with open(log_path, 'a', encoding='utf-8') as _f:
+      size_str = std.bytes_to_string(dev.details["size"], use_binary=False)
+      _f.write(
+        std.color_string(
+          ['[', dev.path.name, ' ', size_str, ']\n'],
+          [None, 'BLUE', None, 'CYAN', None],
+          sep='',
+          ),
+        )
+    scan_function(test_obj, dev_path, log_path)
+
+  # Start scans
+  for test in reversed(test_objects):
+    if test.disabled:
+      # Skip
+      continue
+
+    # Start thread
+    test_log = f'{state.log_dir}/{test.dev.path.name}_{log_suffix}.log'
+    threads.append(exe.start_thread(_run_scan, args=(test, test_log)))
+
+    # Show progress
+    if threads[-1].is_alive():
+      state.add_test_pane(
+        pane, lines=5, watch_cmd='tail', watch_file=test_log,
+        )
+
+  # Wait for all scans to complete
+  try:
+    while True:
+      if any(t.is_alive() for t in threads):
+        state.update_progress_pane()
+        state.sleep(5)
+      else:
+        break
+  except KeyboardInterrupt:
+    aborted = True
+    state.abort_event.set()
+    for thread in threads:
+      # Give native scans time to save progress
+      thread.join(timeout=5)
+    # Handle aborts
+    for test in test_objects:
+      if not (test.disabled or test.passed or test.failed):
+        test.set_status('Aborted')
+        test.report.append(std.color_string('  Aborted', 'YELLOW'))
+
+  # Cleanup
+  state.update_progress_pane()
+  with state.ui_lock:
+    for pane_id in state.panes.pop(pane, []):
+      tmux.kill_pane(pane_id)
+
+  # Done
+  if aborted:
+    raise std.GenericAbort('Aborted')
+
+
+def run_tests(state, menu):
+  # pylint: disable=too-many-branches
+  """Run enabled tests, concurrently if resources don't conflict.
+
+  Tests are started in order once the enabled tests they depend on have
+  finished and none of their resources are in use.
+
+  NOTE: Tests run as threads and check state.abort_event to stop early.
+  """
+  errors = {}
+  pending = [name for name, test in state.tests.items() if test['Enabled']]
+  resources = {name: state.get_test_resources(name) for name in pending}
+  running = {}
+  state.update_top_pane()
+
+  def _is_ready(name):
+    """Check if test can be started, returns bool."""
+    for dependency in state.tests[name]['After']:
+      if dependency in pending or dependency in running:
+        return False
+    return not any(resources[name] & resources[other] for other in running)
+
+  def _run_test(name, args):
+    """Run test and save exceptions for the main thread."""
+    try:
+      state.tests[name]['Function'](state, *args)
+    except (KeyboardInterrupt, std.GenericAbort) as err:
+      state.abort_event.set()
+      errors[name] = err
+    except Exception as err: # pylint: disable=broad-except
+      LOG.error('%s failed', name, exc_info=True)
+      state.abort_event.set()
+      errors[name] = err
+
+  # Run tests
+  while pending or running:
+    try:
+      # Check finished tests
+      for name, thread in list(running.items()):
+        if thread.is_alive():
+          continue
+        running.pop(name)
+        state.update_top_pane(ident=thread.ident)
+        if name.startswith('Disk') and not state.abort_event.is_set():
+          state.disk_safety_checks(
+            wait_for_self_tests=name != 'Disk Attributes',
+            )
+        state.update_progress_pane()
+
+      # Start tests
+      if state.abort_event.is_set():
+        pending.clear()
+      for name in pending.copy():
+        if not _is_ready(name):
+          continue
+        args = [state.tests[name]['Objects']]
+        if name == 'Disk I/O Benchmark':
+          args.append(menu.toggles['Skip USB Benchmarks']['Selected'])
+          args.append(
+            menu.toggles['Parallel Benchmarks (by controller)']['Selected'],
+            )
+        if not running:
+          std.clear_screen()
+        LOG.info('Starting %s (running: %s)', name, list(running.keys()))
+        pending.remove(name)
+        running[name] = exe.start_thread(_run_test, args=(name, args))
+      std.sleep(0.5)
+    except KeyboardInterrupt:
+      state.abort_event.set()
+
+  # Done
+  for err in errors.values():
+    if not isinstance(err, (KeyboardInterrupt, std.GenericAbort)):
+      raise err
+  if state.abort_event.is_set():
+    raise std.GenericAbort('Aborted')
+
+
 def screensaver(name):
   """Show screensaver"""
   LOG.info('Screensaver (%s)', name)
@@ -1480,7 +2551,10 @@ def show_results(state):
 
 
 def start_mprime(working_dir, log_path):
-  """Start mprime and save filtered output to log, returns Popen object."""
+  """Start mprime and monitor output, returns tuple.
+
+  NOTE: The tuple contains the Popen and MprimeMonitor objects.
+  """
   set_apple_fan_speed('max')
   proc_mprime = subprocess.Popen( # pylint: disable=consider-using-with
     ['mprime', '-t'],
@@ -1488,20 +2562,10 @@ def start_mprime(working_dir, log_path):
     stdout=subprocess.PIPE,
     stderr=subprocess.STDOUT,
     )
-  proc_grep = subprocess.Popen( # pylint: disable=consider-using-with
-    'grep --ignore-case --invert-match --line-buffered stress.txt'.split(),
-    stdin=proc_mprime.stdout,
-    stdout=subprocess.PIPE,
-    )
-  proc_mprime.stdout.close()
-  save_nsbr = exe.NonBlockingStreamReader(proc_grep.stdout)
-  exe.start_thread(
-    save_nsbr.save_to_file,
-    args=(proc_grep, log_path),
-    )
+  monitor = MprimeMonitor(proc_mprime, log_path)
 
   # Return objects
-  return proc_mprime
+  return proc_mprime, monitor
 
 
 def start_sysbench(sensors, sensors_out, log_path, pane):
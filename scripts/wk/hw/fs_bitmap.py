@@ -0,0 +1,420 @@
+"""WizardKit: Filesystem allocation bitmaps"""
+# vim: sts=2 sw=2 ts=2
+
+import logging
+import re
+import struct
+
+
+# STATIC VARIABLES
+LOG = logging.getLogger(__name__)
+BITMAP_RUN_REGEX = re.compile(rb'\x00+|\xff+|[\x01-\xfe]')
+# NOTE: Adjacent block bitmaps (e.g. with flex_bg) are read together
+EXT_BITMAP_READ_SIZE = 16 * 1024**2
+EXT_BLOCK_UNINIT = 0x0002
+EXT_FEATURE_COMPAT_SPARSE_SUPER2 = 0x0200
+EXT_FEATURE_INCOMPAT_64BIT = 0x0080
+EXT_FEATURE_INCOMPAT_META_BG = 0x0010
+EXT_FEATURE_RO_COMPAT_GDT_CSUM = 0x0010
+EXT_FEATURE_RO_COMPAT_METADATA_CSUM = 0x0400
+EXT_FEATURE_RO_COMPAT_SPARSE_SUPER = 0x0001
+EXT_SUPERBLOCK_MAGIC = 0xEF53
+EXT_SUPERBLOCK_OFFSET = 1024
+NTFS_ATTR_DATA = 0x80
+NTFS_ATTR_END = 0xFFFFFFFF
+NTFS_BITMAP_RECORD = 6
+NTFS_FIXUP_STRIDE = 512
+NTFS_OEM_ID = b'NTFS    '
+
+
+# Error Classes
+class UnsupportedFilesystemError(RuntimeError):
+  """Raised when the filesystem is missing or unsupported."""
+
+
+# Functions
+def bitmap_to_ranges(bitmap, unit_size, unit_count, first_unit=0):
+  """Convert allocation bitmap to byte ranges, returns list.
+
+  Each entry is (start, size) in bytes. Bits are read LSB first
+  and only the first unit_count bits are used.
+  """
+  ranges = []
+  run_start = None
+
+  def _add_run(start, end):
+    """Add or extend range using unit numbers."""
+    start = (first_unit + start) * unit_size
+    end = (first_unit + end) * unit_size
+    if ranges and ranges[-1][0] + ranges[-1][1] == start:
+      ranges[-1] = (ranges[-1][0], end - ranges[-1][0])
+    else:
+      ranges.append((start, end - start))
+
+  # Check bitmap using runs of bytes
+  for match in BITMAP_RUN_REGEX.finditer(bitmap):
+    unit = match.start() * 8
+    if unit >= unit_count:
+      break
+    run = match.group()
+    if run[0] == 0xFF:
+      if run_start is None:
+        run_start = unit
+    elif run[0] == 0x00:
+      if run_start is not None:
+        _add_run(run_start, unit)
+        run_start = None
+    else:
+      for bit in range(8):
+        allocated = run[0] >> bit & 1
+        if allocated and run_start is None:
+          run_start = unit + bit
+        elif not allocated and run_start is not None:
+          _add_run(run_start, unit + bit)
+          run_start = None
+  if run_start is not None:
+    _add_run(run_start, unit_count)
+
+  # Limit to unit_count
+  end = (first_unit + unit_count) * unit_size
+  ranges = [
+    (start, min(start + size, end) - start)
+    for start, size in ranges if start < end
+    ]
+
+  # Done
+  return ranges
+
+
+def decode_ntfs_runlist(data):
+  """Decode NTFS data runs, returns list of (lcn, length) tuples.
+
+  NOTE: Sparse runs use None for the lcn.
+  """
+  offset = 0
+  lcn = 0
+  runs = []
+  while offset < len(data) and data[offset]:
+    header = data[offset]
+    len_size = header & 0x0F
+    lcn_size = header >> 4
+    offset += 1
+    length = int.from_bytes(data[offset:offset+len_size], 'little')
+    offset += len_size
+    if lcn_size:
+      lcn += int.from_bytes(
+        data[offset:offset+lcn_size], 'little', signed=True,
+        )
+      runs.append((lcn, length))
+    else:
+      runs.append((None, length))
+    offset += lcn_size
+
+  # Done
+  return runs
+
+
+def ext_group_has_super(group, superblock):
+  """Check if ext block group has a superblock (backup), returns bool."""
+  compat = struct.unpack_from('<I', superblock, 0x5C)[0]
+  ro_compat = struct.unpack_from('<I', superblock, 0x64)[0]
+  if group == 0:
+    return True
+  if compat & EXT_FEATURE_COMPAT_SPARSE_SUPER2:
+    return group in struct.unpack_from('<II', superblock, 0x24C)
+  if not ro_compat & EXT_FEATURE_RO_COMPAT_SPARSE_SUPER or group == 1:
+    return True
+
+  # Check for powers of 3, 5, and 7
+  for base in (3, 5, 7):
+    power = base
+    while power < group:
+      power *= base
+    if power == group:
+      return True
+
+  # Done
+  return False
+
+
+def get_allocated_ranges(read_func):
+  """Get allocated ranges using the filesystem allocation bitmap.
+
+  read_func(offset, length) should return the bytes at that offset
+  (relative to the start of the filesystem). Returns a list of
+  (start, size) tuples in bytes.
+
+  NOTE: An UnsupportedFilesystemError is raised if the filesystem
+        isn't NTFS or ext2/3/4.
+  """
+  boot_sector = read_func(0, 512)
+  if boot_sector[3:11] == NTFS_OEM_ID:
+    return get_allocated_ranges_ntfs(read_func, boot_sector)
+  superblock = read_func(EXT_SUPERBLOCK_OFFSET, 1024)
+  if struct.unpack_from('<H', superblock, 0x38)[0] == EXT_SUPERBLOCK_MAGIC:
+    return get_allocated_ranges_ext(read_func, superblock)
+  raise UnsupportedFilesystemError('Filesystem not supported')
+
+
+def get_allocated_ranges_ext(read_func, superblock):
+  # pylint: disable=too-many-locals
+  """Get allocated ranges using the ext2/3/4 block bitmaps, returns list.
+
+  NOTE: Block groups with uninitialized bitmaps are treated as free
+        except for the metadata stored in them, see get_ext_group_metadata().
+  """
+  ranges = []
+  groups = []
+  blocks_count = struct.unpack_from('<I', superblock, 0x04)[0]
+  first_data_block = struct.unpack_from('<I', superblock, 0x14)[0]
+  block_size = 1024 << struct.unpack_from('<I', superblock, 0x18)[0]
+  blocks_per_group = struct.unpack_from('<I', superblock, 0x20)[0]
+  incompat = struct.unpack_from('<I', superblock, 0x60)[0]
+  ro_compat = struct.unpack_from('<I', superblock, 0x64)[0]
+  desc_size = 32
+  if incompat & EXT_FEATURE_INCOMPAT_64BIT:
+    blocks_count |= struct.unpack_from('<I', superblock, 0x150)[0] << 32
+    desc_size = max(desc_size, struct.unpack_from('<H', superblock, 0xFE)[0])
+  uninit_supported = ro_compat & (
+    EXT_FEATURE_RO_COMPAT_GDT_CSUM | EXT_FEATURE_RO_COMPAT_METADATA_CSUM
+    )
+  if not blocks_per_group:
+    raise UnsupportedFilesystemError('Invalid ext superblock')
+  group_count = -(-(blocks_count - first_data_block) // blocks_per_group)
+
+  # Read group descriptors
+  # NOTE: With meta_bg only the first s_first_meta_bg descriptor blocks
+  #       follow the superblock, the rest are stored in the first group
+  #       of each meta group (after its superblock backup, if any)
+  descs_per_block = block_size // desc_size
+  desc_blocks = -(-group_count // descs_per_block)
+  first_meta_bg = desc_blocks
+  if incompat & EXT_FEATURE_INCOMPAT_META_BG:
+    first_meta_bg = min(
+      struct.unpack_from('<I', superblock, 0x104)[0], desc_blocks,
+      )
+  descriptors = read_func(
+    (first_data_block + 1) * block_size, first_meta_bg * block_size,
+    )
+  for desc_block in range(first_meta_bg, desc_blocks):
+    meta_group = desc_block * descs_per_block
+    block = first_data_block + meta_group * blocks_per_group
+    block += int(ext_group_has_super(meta_group, superblock))
+    descriptors += read_func(block * block_size, block_size)
+
+  # Read group descriptor details
+  for group in range(group_count):
+    offset = group * desc_size
+    group_blocks = []
+    for field in (0x00, 0x04, 0x08):
+      block = struct.unpack_from('<I', descriptors, offset + field)[0]
+      if desc_size >= 64:
+        block |= struct.unpack_from(
+          '<I', descriptors, offset + field + 0x20)[0] << 32
+      group_blocks.append(block)
+    flags = struct.unpack_from('<H', descriptors, offset + 0x12)[0]
+    groups.append((
+      group, *group_blocks, uninit_supported and flags & EXT_BLOCK_UNINIT,
+      ))
+
+  # Read block bitmaps
+  bitmaps = {}
+  bitmap_runs = []
+  max_run = max(EXT_BITMAP_READ_SIZE // block_size, 1)
+  for block in sorted({info[1] for info in groups if not info[4]}):
+    run = bitmap_runs[-1] if bitmap_runs else None
+    if run and run[0] + run[1] == block and run[1] < max_run:
+      run[1] += 1
+    else:
+      bitmap_runs.append([block, 1])
+  for start, count in bitmap_runs:
+    data = read_func(start * block_size, count * block_size)
+    for index in range(count):
+      bitmaps[start + index] = data[index*block_size:(index+1)*block_size]
+
+  # Check groups
+  for group, bitmap_block, inode_bitmap, inode_table, uninit in groups:
+    first_block = first_data_block + group * blocks_per_group
+    group_blocks = min(blocks_per_group, blocks_count - first_block)
+    if uninit:
+      group_ranges = get_ext_group_metadata(
+        superblock, group, first_block, group_blocks, group_count,
+        (bitmap_block, inode_bitmap, inode_table),
+        )
+    else:
+      group_ranges = bitmap_to_ranges(
+        bitmaps[bitmap_block], block_size, group_blocks,
+        first_unit=first_block,
+        )
+    for start, size in group_ranges:
+      if ranges and ranges[-1][0] + ranges[-1][1] == start:
+        ranges[-1] = (ranges[-1][0], ranges[-1][1] + size)
+      else:
+        ranges.append((start, size))
+
+  # Always include the boot block and superblock
+  if first_data_block:
+    ranges.insert(0, (0, block_size))
+
+  # Done
+  return ranges
+
+
+def get_ext_group_metadata(
+    superblock, group, first_block, group_blocks, group_count, locations):
+  # pylint: disable=too-many-arguments,too-many-locals
+  """Get metadata ranges for ext block group, returns list.
+
+  This covers the superblock backup, group descriptors, and reserved
+  GDT blocks (if the group has a backup) along with the block bitmap,
+  inode bitmap, and inode table if they're stored inside the group.
+  locations should be (block_bitmap, inode_bitmap, inode_table).
+  """
+  block_size = 1024 << struct.unpack_from('<I', superblock, 0x18)[0]
+  incompat = struct.unpack_from('<I', superblock, 0x60)[0]
+  inodes_per_group = struct.unpack_from('<I', superblock, 0x28)[0]
+  inode_size = 128
+  if struct.unpack_from('<I', superblock, 0x4C)[0]:
+    # Dynamic revision
+    inode_size = struct.unpack_from('<H', superblock, 0x58)[0]
+  desc_size = 32
+  if incompat & EXT_FEATURE_INCOMPAT_64BIT:
+    desc_size = max(desc_size, struct.unpack_from('<H', superblock, 0xFE)[0])
+  descs_per_block = block_size // desc_size
+  metadata = []
+
+  # Superblock backup and group descriptors
+  has_super = ext_group_has_super(group, superblock)
+  first_meta_bg = struct.unpack_from('<I', superblock, 0x104)[0]
+  if (incompat & EXT_FEATURE_INCOMPAT_META_BG
+      and group >= first_meta_bg * descs_per_block):
+    # Descriptors are in the first, second, and last group of each meta group
+    gdt_blocks = int(
+      group % descs_per_block in (0, 1, descs_per_block - 1)
+      )
+    metadata.append((first_block, int(has_super) + gdt_blocks))
+  elif has_super:
+    gdt_blocks = -(-(group_count * desc_size) // block_size)
+    if incompat & EXT_FEATURE_INCOMPAT_META_BG:
+      gdt_blocks = first_meta_bg
+    reserved_gdt_blocks = struct.unpack_from('<H', superblock, 0xCE)[0]
+    metadata.append((first_block, 1 + gdt_blocks + reserved_gdt_blocks))
+
+  # Bitmaps and inode table
+  inode_table_blocks = -(-(inodes_per_group * inode_size) // block_size)
+  for block, count in zip(locations, (1, 1, inode_table_blocks)):
+    metadata.append((block, count))
+
+  # Limit to group and convert to bytes
+  group_end = first_block + group_blocks
+  ranges = []
+  for block, count in sorted(metadata):
+    if not count or not first_block <= block < group_end:
+      continue
+    count = min(block + count, group_end) - block
+    if ranges and sum(ranges[-1]) >= block * block_size:
+      end = max(sum(ranges[-1]), (block + count) * block_size)
+      ranges[-1] = (ranges[-1][0], end - ranges[-1][0])
+    else:
+      ranges.append((block * block_size, count * block_size))
+
+  # Done
+  return ranges
+
+
+def get_allocated_ranges_ntfs(read_func, boot_sector):
+  # pylint: disable=too-many-locals
+  """Get allocated ranges using the NTFS $Bitmap file, returns list."""
+  bytes_per_sector = struct.unpack_from('<H', boot_sector, 0x0B)[0]
+  sectors_per_cluster = boot_sector[0x0D]
+  if sectors_per_cluster > 0x80:
+    sectors_per_cluster = 1 << (256 - sectors_per_cluster)
+  cluster_size = bytes_per_sector * sectors_per_cluster
+  total_sectors = struct.unpack_from('<Q', boot_sector, 0x28)[0]
+  mft_lcn = struct.unpack_from('<Q', boot_sector, 0x30)[0]
+  record_size = struct.unpack_from('<b', boot_sector, 0x40)[0]
+  if record_size < 0:
+    record_size = 1 << -record_size
+  else:
+    record_size *= cluster_size
+  if not (cluster_size and record_size):
+    raise UnsupportedFilesystemError('Invalid NTFS boot sector')
+  cluster_count = total_sectors // sectors_per_cluster
+
+  # Read $Bitmap MFT record
+  # NOTE: The first 16 MFT records are always contiguous
+  record = read_func(
+    mft_lcn * cluster_size + NTFS_BITMAP_RECORD * record_size, record_size,
+    )
+  record = ntfs_apply_fixups(record)
+
+  # Find unnamed $DATA attribute
+  bitmap = None
+  offset = struct.unpack_from('<H', record, 0x14)[0]
+  while offset + 8 <= len(record):
+    attr_type, attr_len = struct.unpack_from('<II', record, offset)
+    if attr_type == NTFS_ATTR_END or attr_len == 0:
+      break
+    name_len = record[offset+9]
+    if attr_type == NTFS_ATTR_DATA and name_len == 0:
+      if record[offset+8]:
+        # Non-resident
+        runlist_offset = struct.unpack_from('<H', record, offset + 0x20)[0]
+        data_size = struct.unpack_from('<Q', record, offset + 0x30)[0]
+        runs = decode_ntfs_runlist(
+          record[offset+runlist_offset:offset+attr_len],
+          )
+        bitmap = b''.join(
+          read_func(lcn * cluster_size, length * cluster_size)
+          if lcn is not None else bytes(length * cluster_size)
+          for lcn, length in runs
+          )[:data_size]
+      else:
+        # Resident
+        value_len = struct.unpack_from('<I', record, offset + 0x10)[0]
+        value_offset = struct.unpack_from('<H', record, offset + 0x14)[0]
+        bitmap = record[offset+value_offset:offset+value_offset+value_len]
+      break
+    offset += attr_len
+  if bitmap is None:
+    raise UnsupportedFilesystemError('Failed to find NTFS $Bitmap data')
+
+  # Done
+  return bitmap_to_ranges(bitmap, cluster_size, cluster_count)
+
+
+def merge_ranges(ranges, max_gap=0):
+  """Merge ranges separated by at most max_gap bytes, returns list."""
+  merged = []
+  for start, size in sorted(ranges):
+    if merged and start - sum(merged[-1]) <= max_gap:
+      end = max(sum(merged[-1]), start + size)
+      merged[-1] = (merged[-1][0], end - merged[-1][0])
+    else:
+      merged.append((start, size))
+
+  # Done
+  return merged
+
+
+def ntfs_apply_fixups(record):
+  """Apply NTFS update sequence fixups to record, returns bytes."""
+  if record[:4] != b'FILE':
+    raise UnsupportedFilesystemError('Invalid NTFS MFT record')
+  record = bytearray(record)
+  usa_offset, usa_count = struct.unpack_from('<HH', record, 0x04)
+  usn = record[usa_offset:usa_offset+2]
+  for _i in range(1, usa_count):
+    end = _i * NTFS_FIXUP_STRIDE
+    if end > len(record):
+      break
+    if record[end-2:end] != usn:
+      raise UnsupportedFilesystemError('NTFS MFT record fixup mismatch')
+    record[end-2:end] = record[usa_offset+2*_i:usa_offset+2*_i+2]
+
+  # Done
+  return bytes(record)
+
+
+if __name__ == '__main__':
+  print("This file is not meant to be called directly.")
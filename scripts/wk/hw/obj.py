@@ -5,17 +5,24 @@ import logging
 import pathlib
 import plistlib
 import re
+import threading
+import time
 
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from types import MappingProxyType
 
 from wk.cfg.hw import (
   ATTRIBUTE_COLORS,
+  DISK_DISCOVERY_THREADS,
   KEY_NVME,
   KEY_SMART,
   KNOWN_DISK_ATTRIBUTES,
   KNOWN_DISK_MODELS,
   KNOWN_RAM_VENDOR_IDS,
   REGEX_POWER_ON_TIME,
+  SMART_CACHE_SECONDS,
   )
 from wk.cfg.main import KIT_NAME_SHORT
 from wk.exe import get_json_from_command, run_program
@@ -30,11 +37,20 @@ from wk.std import (
 
 # STATIC VARIABLES
 LOG = logging.getLogger(__name__)
+KNOWN_DISK_MODEL_REGEXES = tuple(
+  (re.compile(regex), data) for regex, data in KNOWN_DISK_MODELS.items()
+  )
 NVME_WARNING_KEYS = (
   'spare_below_threshold',
   'reliability_degraded',
   'volatile_memory_backup_failed',
   )
+SMART_QUERY_ARGS = {
+  'all': '--all',
+  'health': '--health',
+  # NOTE: Self-test status and polling times are part of the capabilities
+  'self-test': '--capabilities',
+  }
 SMART_SELF_TEST_START_TIMEOUT_IN_SECONDS = 120
 WK_LABEL_REGEX = re.compile(
   fr'{KIT_NAME_SHORT}_(LINUX|UFD)',
@@ -149,8 +165,14 @@ class CpuRam(BaseObj):
 
 
 class Disk(BaseObj):
-  """Object for tracking disk specific data."""
-  def __init__(self, path):
+  """Object for tracking disk specific data.
+
+  SMART details are cached for SMART_CACHE_SECONDS and concurrent
+  updates share a single smartctl call.
+
+  NOTE: details can be provided to skip running lsblk (Linux only).
+  """
+  def __init__(self, path, details=None):
     super().__init__()
     self.attributes = {}
     self.description = 'Unknown'
@@ -159,23 +181,110 @@ class Disk(BaseObj):
     self.path = pathlib.Path(path).resolve()
     self.smartctl = {}
     self.tests = OrderedDict()
+    self._smart_lock = threading.Lock()
+    self._smart_updated = None
 
     # Update details
-    self.get_details()
+    self.get_details(details)
     self.enable_smart()
     self.update_smart_details()
     if self.details['bus'] == 'USB' and not self.attributes:
       # Try using SAT
       LOG.warning('Using SAT for smartctl for %s', self.path)
       self.enable_smart(use_sat=True)
-      self.update_smart_details(use_sat=True)
+      self.update_smart_details(use_sat=True, max_age=0)
     if not self.is_4k_aligned():
       self.add_note('One or more partitions are not 4K aligned', 'YELLOW')
 
+  def __getstate__(self):
+    """Exclude SMART lock when pickling (e.g. debug reports)."""
+    state = self.__dict__.copy()
+    state.pop('_smart_lock', None)
+    return state
+
+  def __setstate__(self, state):
+    """Restore SMART lock when unpickling."""
+    self.__dict__.update(state)
+    self._smart_lock = threading.Lock()
+
+  def _update_smart_details(self, use_sat, query):
+    """Update SMART details via smartctl (without caching)."""
+
+    # Check if SAT is needed
+    if not use_sat:
+      # use_sat not set, check previous run (if possible)
+      for arg in self.smartctl.get('smartctl', {}).get('argv', []):
+        if arg == '--device=sat,auto':
+          use_sat = True
+          break
+
+    # Get SMART data
+    cmd = [
+      'sudo',
+      'smartctl',
+      f'--device={"sat,auto" if use_sat else "auto"}',
+      '--tolerance=verypermissive',
+      SMART_QUERY_ARGS[query],
+      '--json',
+      self.path,
+      ]
+    json_data = get_json_from_command(cmd, check=False)
+
+    # Update partial details if necessary
+    if query == 'health':
+      self.smartctl['smart_status'] = json_data.get('smart_status', {})
+      return
+    if query == 'self-test':
+      self.smartctl.setdefault('ata_smart_data', {})['self_test'] = (
+        json_data.get('ata_smart_data', {}).get('self_test', {})
+        )
+      return
+    self.attributes = {}
+    self.smartctl = json_data
+    self._smart_updated = time.monotonic()
+
+    # Check for attributes
+    if KEY_NVME in self.smartctl:
+      for name, value in self.smartctl[KEY_NVME].items():
+        try:
+          self.attributes[name] = {
+            'name': name,
+            'raw': int(value),
+            'raw_str': str(value),
+            }
+        except (TypeError, ValueError):
+          # Ignoring invalid attribute
+          LOG.error('Invalid NVMe attribute: %s %s', name, value)
+    elif KEY_SMART in self.smartctl:
+      for attribute in self.smartctl[KEY_SMART].get('table', {}):
+        try:
+          _id = int(attribute['id'])
+        except (KeyError, ValueError):
+          # Ignoring invalid attribute
+          LOG.error('Invalid SMART attribute: %s', attribute)
+          continue
+        name = str(attribute.get('name', 'Unknown')).replace('_', ' ').title()
+        raw = int(attribute.get('raw', {}).get('value', -1))
+        raw_str = attribute.get('raw', {}).get('string', 'Unknown')
+
+        # Fix power-on time
+        match = REGEX_POWER_ON_TIME.match(raw_str)
+        if _id == 9 and match:
+          raw = int(match.group(1))
+
+        # Add to dict
+        self.attributes[_id] = {
+          'name': name, 'raw': raw, 'raw_str': raw_str}
+
+    # Add note if necessary
+    if not self.attributes:
+      self.add_note('No NVMe or SMART data available', 'YELLOW')
+
   def abort_self_test(self):
     """Abort currently running non-captive self-test."""
     cmd = ['sudo', 'smartctl', '--abort', self.path]
     run_program(cmd, check=False)
+    self.invalidate_smart_details()
 
   def add_note(self, note, color=None):
     """Add note that will be included in the disk report."""
@@ -187,37 +296,19 @@ class Disk(BaseObj):
 
   def check_attributes(self, only_blocking=False):
     """Check if any known attributes are failing, returns bool."""
-    attributes_ok = True
-    known_attributes = get_known_disk_attributes(self.details['model'])
-    for attr, value in self.attributes.items():
-      # Skip unknown attributes
-      if attr not in known_attributes:
+    checks = get_attribute_checks(self.details['model'], only_blocking)
+    for attr, err_thresh, max_thresh, percentage_life in checks:
+      if attr not in self.attributes:
         continue
-
-      # Get thresholds
-      blocking_attribute = known_attributes[attr].get('Blocking', False)
-      err_thresh = known_attributes[attr].get('Error', None)
-      max_thresh = known_attributes[attr].get('Maximum', None)
-      if not max_thresh:
-        max_thresh = float('inf')
-
-      # Skip non-blocking attributes if necessary
-      if only_blocking and not blocking_attribute:
-        continue
-
-      # Skip informational attributes
-      if not err_thresh:
-        continue
-
-      # Check attribute
-      if known_attributes[attr].get('PercentageLife', False):
-        if 0 <= value['raw'] <= err_thresh:
-          attributes_ok = False
-      elif err_thresh <= value['raw'] < max_thresh:
-        attributes_ok = False
+      raw = self.attributes[attr]['raw']
+      if percentage_life:
+        if 0 <= raw <= err_thresh:
+          return False
+      elif err_thresh <= raw < max_thresh:
+        return False
 
     # Done
-    return attributes_ok
+    return True
 
   def disable_disk_tests(self):
     """Disable all tests."""
@@ -319,7 +410,7 @@ class Disk(BaseObj):
 
     return report
 
-  def get_details(self):
+  def get_details(self, details=None):
     """Get disk details using OS specific methods.
 
     Required details default to generic descriptions
@@ -328,7 +419,7 @@ class Disk(BaseObj):
     if PLATFORM == 'Darwin':
       self.details = get_disk_details_macos(self.path)
     elif PLATFORM == 'Linux':
-      self.details = get_disk_details_linux(self.path)
+      self.details = get_disk_details_linux(self.path, details)
 
     # Set necessary details
     self.details['bus'] = str(self.details.get('bus', '???')).upper()
@@ -390,6 +481,10 @@ class Disk(BaseObj):
     # Done
     return details
 
+  def invalidate_smart_details(self):
+    """Force the next SMART update to run smartctl."""
+    self._smart_updated = None
+
   def is_4k_aligned(self):
     """Check that all disk partitions are aligned, returns bool."""
     aligned = True
@@ -400,6 +495,10 @@ class Disk(BaseObj):
 
     return aligned
 
+  def is_ata(self):
+    """Check if disk uses the ATA protocol (per smartctl), returns bool."""
+    return self.smartctl.get('device', {}).get('protocol', None) == 'ATA'
+
   def safety_checks(self):
     """Run safety checks and raise an exception if necessary."""
     blocking_event_encountered = False
@@ -494,13 +593,14 @@ class Disk(BaseObj):
       self.path,
       ]
     run_program(cmd, check=False)
+    self.invalidate_smart_details()
 
     # Monitor progress (in five second intervals)
     for _i in range(int(test_minutes*60/5)):
       sleep(5)
 
       # Update status
-      self.update_smart_details()
+      self.update_smart_details(query='self-test')
       test_details = self.get_smart_self_test_details()
 
       # Check test progress
@@ -532,66 +632,31 @@ class Disk(BaseObj):
     # Done
     return result
 
-  def update_smart_details(self, use_sat=False):
-    """Update SMART details via smartctl."""
-    self.attributes = {}
-
-    # Check if SAT is needed
-    if not use_sat:
-      # use_sat not set, check previous run (if possible)
-      for arg in self.smartctl.get('smartctl', {}).get('argv', []):
-        if arg == '--device=sat,auto':
-          use_sat = True
-          break
-
-    # Get SMART data
-    cmd = [
-      'sudo',
-      'smartctl',
-      f'--device={"sat,auto" if use_sat else "auto"}',
-      '--tolerance=verypermissive',
-      '--all',
-      '--json',
-      self.path,
-      ]
-    self.smartctl = get_json_from_command(cmd, check=False)
-
-    # Check for attributes
-    if KEY_NVME in self.smartctl:
-      for name, value in self.smartctl[KEY_NVME].items():
-        try:
-          self.attributes[name] = {
-            'name': name,
-            'raw': int(value),
-            'raw_str': str(value),
-            }
-        except (TypeError, ValueError):
-          # Ignoring invalid attribute
-          LOG.error('Invalid NVMe attribute: %s %s', name, value)
-    elif KEY_SMART in self.smartctl:
-      for attribute in self.smartctl[KEY_SMART].get('table', {}):
-        try:
-          _id = int(attribute['id'])
-        except (KeyError, ValueError):
-          # Ignoring invalid attribute
-          LOG.error('Invalid SMART attribute: %s', attribute)
-          continue
-        name = str(attribute.get('name', 'Unknown')).replace('_', ' ').title()
-        raw = int(attribute.get('raw', {}).get('value', -1))
-        raw_str = attribute.get('raw', {}).get('string', 'Unknown')
-
-        # Fix power-on time
-        match = REGEX_POWER_ON_TIME.match(raw_str)
-        if _id == 9 and match:
-          raw = int(match.group(1))
+  def update_smart_details(self, use_sat=False, max_age=None, query='all'):
+    """Update SMART details via smartctl.
 
-        # Add to dict
-        self.attributes[_id] = {
-          'name': name, 'raw': raw, 'raw_str': raw_str}
+    Full details newer than max_age seconds (SMART_CACHE_SECONDS by
+    default) are reused. Callers waiting on an in-flight smartctl call
+    share its results instead of running smartctl again.
 
-    # Add note if necessary
-    if not self.attributes:
-      self.add_note('No NVMe or SMART data available', 'YELLOW')
+    NOTE: The 'health' and 'self-test' queries are cheaper and only
+          update the overall health or self-test status respectively.
+          The 'self-test' query is only used for ATA disks, the full
+          details are updated for the rest (e.g. NVMe).
+    """
+    request_time = time.monotonic()
+    if max_age is None:
+      max_age = SMART_CACHE_SECONDS
+    if query == 'self-test' and not self.is_ata():
+      max_age = 0
+      query = 'all'
+    with self._smart_lock:
+      if query == 'all' and self._smart_updated is not None and (
+          self._smart_updated >= request_time
+          or request_time - self._smart_updated < max_age):
+        # Use cached details
+        return
+      self._update_smart_details(use_sat, query)
 
 
 class Test():
@@ -616,11 +681,40 @@ class Test():
 
 
 # Functions
-def get_disk_details_linux(path):
-  """Get disk details using lsblk, returns dict."""
-  cmd = ['lsblk', '--bytes', '--json', '--output-all', '--paths', path]
-  json_data = get_json_from_command(cmd, check=False)
-  details = json_data.get('blockdevices', [{}])[0]
+@lru_cache(maxsize=None)
+def get_attribute_checks(model, only_blocking=False):
+  """Get failure checks for known attributes (model specific), returns tuple.
+
+  Each check is (attr, error_threshold, max_threshold, percentage_life)
+  and informational attributes (without an error threshold) are skipped.
+  """
+  checks = []
+  for attr, thresholds in get_known_disk_attributes(model).items():
+    if only_blocking and not thresholds.get('Blocking', False):
+      continue
+    if not thresholds.get('Error', None):
+      continue
+    checks.append((
+      attr,
+      thresholds['Error'],
+      thresholds.get('Maximum', None) or float('inf'),
+      thresholds.get('PercentageLife', False),
+      ))
+
+  # Done
+  return tuple(checks)
+
+
+def get_disk_details_linux(path, details=None):
+  """Get disk details using lsblk, returns dict.
+
+  NOTE: If details are provided (e.g. from get_disks_linux) they are
+        fixed and returned without running lsblk again.
+  """
+  if details is None:
+    cmd = ['lsblk', '--bytes', '--json', '--output-all', '--paths', path]
+    json_data = get_json_from_command(cmd, check=False)
+    details = json_data.get('blockdevices', [{}])[0]
 
   # Fix details
   for dev in [details, *details.get('children', [])]:
@@ -725,21 +819,25 @@ def get_disks(skip_kits=False):
 
 
 def get_disks_linux():
-  """Get disks via lsblk, returns list."""
-  cmd = ['lsblk', '--json', '--nodeps', '--paths']
-  disks = []
+  """Get disks via lsblk, returns list.
 
-  # Add valid disks
-  json_data = get_json_from_command(cmd)
-  for disk in json_data.get('blockdevices', []):
-    disk_obj = Disk(disk['name'])
+  NOTE: lsblk is only run once and the SMART/partition details for
+        each disk are collected in parallel.
+  """
+  cmd = ['lsblk', '--bytes', '--json', '--output-all', '--paths']
 
-    # Skip loopback devices, optical devices, etc
-    if disk_obj.details['type'] != 'disk':
-      continue
+  # Skip loopback devices, optical devices, etc
+  json_data = get_json_from_command(cmd)
+  devices = [
+    dev for dev in json_data.get('blockdevices', [])
+    if dev.get('type') == 'disk'
+    ]
 
-    # Add disk
-    disks.append(disk_obj)
+  # Add disks
+  with ThreadPoolExecutor(max_workers=DISK_DISCOVERY_THREADS) as executor:
+    disks = list(
+      executor.map(lambda dev: Disk(dev['name'], details=dev), devices),
+      )
 
   # Done
   return disks
@@ -766,8 +864,10 @@ def get_disks_macos():
     return disks
 
   # Add valid disks
-  for disk in plist_data['WholeDisks']:
-    disks.append(Disk(f'/dev/{disk}'))
+  with ThreadPoolExecutor(max_workers=DISK_DISCOVERY_THREADS) as executor:
+    disks = list(
+      executor.map(Disk, [f'/dev/{disk}' for disk in plist_data['WholeDisks']]),
+      )
 
   # Remove virtual disks
   # TODO: Test more to figure out why some drives are being marked 'Unknown'
@@ -779,21 +879,29 @@ def get_disks_macos():
   return disks
 
 
+@lru_cache(maxsize=None)
 def get_known_disk_attributes(model):
-  """Get known NVMe/SMART attributes (model specific), returns str."""
-  known_attributes = KNOWN_DISK_ATTRIBUTES.copy()
+  """Get known NVMe/SMART attributes (model specific), returns mapping.
+
+  NOTE: The results are cached per model and are read-only so the
+        shared thresholds can't be modified.
+  """
+  known_attributes = {
+    attr: dict(thresholds)
+    for attr, thresholds in KNOWN_DISK_ATTRIBUTES.items()
+    }
 
   # Apply model-specific data
-  for regex, data in KNOWN_DISK_MODELS.items():
-    if re.search(regex, model):
+  for regex, data in KNOWN_DISK_MODEL_REGEXES:
+    if regex.search(model):
       for attr, thresholds in data.items():
-        if attr in known_attributes:
-          known_attributes[attr].update(thresholds)
-        else:
-          known_attributes[attr] = thresholds
+        known_attributes.setdefault(attr, {}).update(thresholds)
 
   # Done
-  return known_attributes
+  return MappingProxyType({
+    attr: MappingProxyType(thresholds)
+    for attr, thresholds in known_attributes.items()
+    })
 
 
 def get_ram_list_linux():
@@ -3,12 +3,29 @@
 
 import json
 import logging
+import os
 import pathlib
 import re
+import threading
+import time
 
+from array import array
 from subprocess import CalledProcessError
 
-from wk.cfg.hw import CPU_CRITICAL_TEMP, SMC_IDS, TEMP_COLORS
+from wk.cfg.hw import (
+  CPU_CRITICAL_TEMP,
+  CPU_THERMAL_GUARD_HOLD,
+  CPU_THERMAL_GUARD_HORIZON,
+  CPU_THERMAL_GUARD_MAX_SLOPE,
+  CPU_THERMAL_GUARD_MIN_TEMP,
+  CPU_THERMAL_GUARD_WINDOW,
+  SENSORS_EWMA_ALPHA,
+  SENSORS_HISTORY_SIZE,
+  SENSORS_POLL_INTERVAL,
+  SENSORS_REPORT_INTERVAL,
+  SMC_IDS,
+  TEMP_COLORS,
+  )
 from wk.exe import run_program, start_thread
 from wk.io import non_clobber_path
 from wk.std import PLATFORM, color_string, sleep
@@ -16,6 +33,8 @@ from wk.std import PLATFORM, color_string, sleep
 
 # STATIC VARIABLES
 LOG = logging.getLogger(__name__)
+HWMON_PATH = pathlib.Path('/sys/class/hwmon')
+HWMON_TEMP_REGEX = re.compile(r'^temp(\d+)_input$')
 LM_SENSORS_CPU_REGEX = re.compile(r'(core|k\d+)temp', re.IGNORECASE)
 SMC_REGEX = re.compile(
   r'^\s*(?P<ID>\w{4})'
@@ -33,52 +52,145 @@ class ThermalLimitReachedError(RuntimeError):
 
 # Classes
 class Sensors():
-  """Class for holding sensor specific data."""
+  """Class for holding sensor specific data.
+
+  NOTE: Under Linux the hwmon sysfs files are read directly if possible
+        and the file descriptors are kept open between updates.
+
+  NOTE: The thermal guard raises ThermalLimitReachedError early if a CPU
+        temp is projected to reach CPU_CRITICAL_TEMP soon. The trigger
+        details and the peak temp measured afterwards are saved in
+        thermal_guard for the report.
+  """
   def __init__(self):
     self.background_thread = None
     self.data = get_sensor_data()
+    self.guard_times = {}
+    self.hwmon_fds = {}
     self.out_path = None
+    self.thermal_guard = None
+    self._hwmon_lock = threading.Lock()
+
+    # Flat lists for hot paths
+    self.sources = [
+      (section, adapter, source, source_data)
+      for section, adapters in self.data.items()
+      for adapter, sources in adapters.items()
+      for source, source_data in sources.items()
+      ]
+    self.cpu_sources = [
+      source_data for section, _, _, source_data in self.sources
+      if section.startswith('CPU')
+      ]
+
+  def __getstate__(self):
+    """Exclude open file descriptors and hwmon lock when pickling."""
+    state = self.__dict__.copy()
+    state['hwmon_fds'] = {}
+    state.pop('_hwmon_lock', None)
+    return state
+
+  def __setstate__(self, state):
+    """Restore hwmon lock when unpickling."""
+    self.__dict__.update(state)
+    self._hwmon_lock = threading.Lock()
+
+  def _add_temp(self, source_data, temp, alt_max=None):
+    """Add temp to source_data and update stats."""
+    history = source_data['Temps']
+    if alt_max and alt_max not in history.windows:
+      history.start_window(alt_max)
+    history.append(temp)
+    source_data['Current'] = temp
+    source_data['Max'] = history.max
+    if alt_max:
+      source_data[alt_max] = history.window_max(alt_max)
+
+  def _check_thermal_limit(self, source, source_data):
+    """Check if CPU temp reached or is about to reach the limit.
+
+    NOTE: The slope is based on the last CPU_THERMAL_GUARD_WINDOW seconds
+          and is only trusted once temps have stayed at or above
+          CPU_THERMAL_GUARD_MIN_TEMP for that long.
+    """
+    current = source_data['Current']
+    history = source_data['Temps']
+    now = history.latest_time()
+    times = self.guard_times.setdefault(
+      source, {'Above': None, 'Projected': None},
+      )
+
+    # Update peak after guard was triggered
+    if self.thermal_guard and self.thermal_guard['Source'] == source:
+      self.thermal_guard['Peak'] = max(self.thermal_guard['Peak'], current)
+
+    if current >= CPU_CRITICAL_TEMP:
+      raise ThermalLimitReachedError('CPU temps reached limit')
+    if current < CPU_THERMAL_GUARD_MIN_TEMP:
+      times['Above'] = None
+      times['Projected'] = None
+      return
+    if times['Above'] is None:
+      times['Above'] = now
+    if now - times['Above'] < CPU_THERMAL_GUARD_WINDOW:
+      # Slope window still includes the rise (e.g. a load step)
+      return
+
+    # Estimate time until limit is reached
+    seconds = None
+    slope = history.slope(CPU_THERMAL_GUARD_WINDOW)
+    if slope and 0 < slope <= CPU_THERMAL_GUARD_MAX_SLOPE:
+      seconds = (CPU_CRITICAL_TEMP - current) / slope
+    if seconds is None or seconds > CPU_THERMAL_GUARD_HORIZON:
+      times['Projected'] = None
+      return
+    if times['Projected'] is None:
+      times['Projected'] = now
+    if now - times['Projected'] < CPU_THERMAL_GUARD_HOLD:
+      return
+
+    # Save first trigger and raise exception
+    if not self.thermal_guard:
+      self.thermal_guard = {
+        'Peak': current,
+        'Seconds': seconds,
+        'Slope': slope,
+        'Source': source,
+        'Temp': current,
+        }
+      LOG.warning(
+        'CPU temps projected to reach limit in %.1fs (%s: %.1f, %.2f/s)',
+        seconds, source, current, slope,
+        )
+    raise ThermalLimitReachedError('CPU temps projected to reach limit')
 
   def clear_temps(self):
     """Clear saved temps but keep structure"""
-    for adapters in self.data.values():
-      for sources in adapters.values():
-        for source_data in sources.values():
-          source_data['Temps'] = []
+    for _, _, _, source_data in self.sources:
+      source_data['Temps'].clear()
+
+  def close_hwmon_files(self):
+    """Close hwmon file descriptors."""
+    with self._hwmon_lock:
+      for fd in self.hwmon_fds.values():
+        os.close(fd)
+      self.hwmon_fds.clear()
 
   def cpu_max_temp(self):
     """Get max temp from any CPU source, returns float.
 
     NOTE: If no temps are found this returns zero.
     """
-    max_temp = 0.0
-
-    # Check all CPU Temps
-    for section, adapters in self.data.items():
-      if not section.startswith('CPU'):
-        continue
-      for sources in adapters.values():
-        for source_data in sources.values():
-          max_temp = max(max_temp, source_data.get('Max', 0))
-
-    # Done
-    return max_temp
+    return max(
+      [0.0, *(source_data.get('Max', 0) for source_data in self.cpu_sources)],
+      )
 
   def cpu_reached_critical_temp(self):
     """Check if CPU reached CPU_CRITICAL_TEMP, returns bool."""
-    for section, adapters in self.data.items():
-      if not section.startswith('CPU'):
-        # Limit to CPU temps
-        continue
-
-      # Ugly section
-      for sources in adapters.values():
-        for source_data in sources.values():
-          if source_data.get('Max', -1) >= CPU_CRITICAL_TEMP:
-            return True
-
-    # Didn't return above so temps are within the threshold
-    return False
+    return any(
+      source_data.get('Max', -1) >= CPU_CRITICAL_TEMP
+      for source_data in self.cpu_sources
+      )
 
   def generate_report(self, *temp_labels, colored=True, only_cpu=False):
     """Generate report based on given temp_labels, returns list."""
@@ -121,7 +233,8 @@ class Sensors():
     # pylint: disable=too-many-arguments
     """Write report to path every second until stopped.
 
-    thermal_action is a cmd to run if ThermalLimitReachedError is caught.
+    thermal_action is a cmd to run the first time ThermalLimitReachedError
+    is caught during this run.
     """
     stop_path = pathlib.Path(out_path).resolve().with_suffix('.stop')
     if stop_path.exists():
@@ -133,48 +246,73 @@ class Sensors():
     if alt_max:
       temp_labels.append(alt_max)
 
+    # Poll faster if all temps are read directly
+    poll_interval = SENSORS_REPORT_INTERVAL
+    if self.uses_hwmon():
+      poll_interval = SENSORS_POLL_INTERVAL
+
     # Start loop
+    next_report = 0
+    thermal_action_done = False
     while True:
       try:
         self.update_sensor_data(alt_max, exit_on_thermal_limit)
       except ThermalLimitReachedError:
-        if thermal_action:
+        if thermal_action and not thermal_action_done:
           run_program(thermal_action, check=False)
-      report = self.generate_report(*temp_labels)
-      with open(out_path, 'w', encoding='utf-8') as _f:
-        _f.write('\n'.join(report))
-
-      # Check if we should stop
-      if stop_path.exists():
-        break
+          thermal_action_done = True
+      now = time.monotonic()
+      if now >= next_report:
+        next_report = now + SENSORS_REPORT_INTERVAL
+        report = self.generate_report(*temp_labels)
+        with open(out_path, 'w', encoding='utf-8') as _f:
+          _f.write('\n'.join(report))
+
+        # Check if we should stop
+        if stop_path.exists():
+          break
 
       # Sleep before next loop
-      sleep(0.5)
+      sleep(poll_interval)
+
+  def read_hwmon_temp(self, path):
+    """Read temp from hwmon file, returns float.
+
+    NOTE: Files are opened once and read using os.pread().
+    """
+    with self._hwmon_lock:
+      if path not in self.hwmon_fds:
+        self.hwmon_fds[path] = os.open(path, os.O_RDONLY)
+      return int(os.pread(self.hwmon_fds[path], 32, 0)) / 1000
 
   def save_average_temps(self, temp_label, seconds=10):
-    # pylint: disable=unused-variable
-    """Save average temps under temp_label over provided seconds.."""
-    self.clear_temps()
+    """Save average temps under temp_label over provided seconds.
+
+    NOTE: If the background monitor is running its temps are used.
+    """
+    for _, _, _, source_data in self.sources:
+      source_data['Temps'].start_window(temp_label)
 
     # Get temps
-    for i in range(seconds):
-      self.update_sensor_data(exit_on_thermal_limit=False)
-      sleep(1)
+    if self.background_thread:
+      sleep(seconds)
+    else:
+      for _ in range(seconds):
+        self.update_sensor_data(exit_on_thermal_limit=False)
+        sleep(1)
 
     # Calculate averages
-    for adapters in self.data.values():
-      for sources in adapters.values():
-        for source_data in sources.values():
-          temps = source_data['Temps']
-          try:
-            source_data[temp_label] = sum(temps) / len(temps)
-          except ZeroDivisionError:
-            # Going to use unrealistic 0°C instead
-            LOG.error(
-              'No temps saved for %s',
-              source_data.get('label', 'UNKNOWN'),
-              )
-            source_data[temp_label] = 0
+    for _, _, _, source_data in self.sources:
+      source_data['Temps'].stop_window(temp_label)
+      average = source_data['Temps'].mean(temp_label)
+      if average is None:
+        # Going to use unrealistic 0°C instead
+        LOG.error(
+          'No temps saved for %s',
+          source_data.get('Label', 'UNKNOWN'),
+          )
+        average = 0
+      source_data[temp_label] = average
 
   def start_background_monitor(
       self, out_path, alt_max=None,
@@ -182,7 +320,8 @@ class Sensors():
     # pylint: disable=too-many-arguments
     """Start background thread to save report to file.
 
-    thermal_action is a cmd to run if ThermalLimitReachedError is caught.
+    thermal_action is a cmd to run the first time ThermalLimitReachedError
+    is caught during this run.
     """
     if self.background_thread:
       raise RuntimeError('Background thread already running')
@@ -199,6 +338,7 @@ class Sensors():
     """Stop background thread."""
     self.out_path.with_suffix('.stop').touch()
     self.background_thread.join()
+    self.close_hwmon_files()
 
     # Reset vars to None
     self.background_thread = None
@@ -212,53 +352,169 @@ class Sensors():
       self.update_sensor_data_linux(alt_max, exit_on_thermal_limit)
 
   def update_sensor_data_linux(self, alt_max, exit_on_thermal_limit=True):
-    """Update sensor data via lm_sensors."""
-    lm_sensor_data = get_sensor_data_lm()
-    for section, adapters in self.data.items():
-      for adapter, sources in adapters.items():
-        for source, source_data in sources.items():
-          try:
-            label = source_data['Label']
-            temp = lm_sensor_data[adapter][source][label]
-            source_data['Current'] = temp
-            source_data['Max'] = max(temp, source_data['Max'])
-            source_data['Temps'].append(temp)
-            if alt_max:
-              source_data[alt_max] = max(temp, source_data.get(alt_max, 0))
-          except KeyError:
-            # Dumb workaround for Dell sensors with changing source names
-            pass
-
-          # Raise exception if thermal limit reached
-          if exit_on_thermal_limit and section == 'CPUTemps':
-            if source_data['Current'] >= CPU_CRITICAL_TEMP:
-              raise ThermalLimitReachedError('CPU temps reached limit')
+    """Update sensor data via hwmon (or lm_sensors)."""
+    lm_sensor_data = None
+    for section, adapter, source, source_data in self.sources:
+      try:
+        if 'Path' in source_data:
+          temp = self.read_hwmon_temp(source_data['Path'])
+        else:
+          if lm_sensor_data is None:
+            lm_sensor_data = get_sensor_data_lm()
+          temp = lm_sensor_data[adapter][source][source_data['Label']]
+        self._add_temp(source_data, temp, alt_max)
+      except KeyError:
+        # Dumb workaround for Dell sensors with changing source names
+        pass
+      except (OSError, ValueError):
+        # Sensor read failed (e.g. temporarily unavailable)
+        LOG.debug('Failed to read sensor %s %s', adapter, source)
+
+      # Raise exception if thermal limit reached (or will be soon)
+      if exit_on_thermal_limit and section == 'CPUTemps':
+        self._check_thermal_limit(source, source_data)
 
   def update_sensor_data_macos(self, alt_max, exit_on_thermal_limit=True):
     """Update sensor data via SMC."""
-    for section, adapters in self.data.items():
-      for sources in adapters.values():
-        for source_data in sources.values():
-          cmd = ['smc', '-k', source_data['Label'], '-r']
-          proc = run_program(cmd)
-          match = SMC_REGEX.match(proc.stdout.strip())
-          try:
-            temp = float(match.group('Value'))
-          except (TypeError, ValueError):
-            LOG.error('Failed to update temp %s', source_data['Label'])
-            continue
-
-          # Update source
-          source_data['Current'] = temp
-          source_data['Max'] = max(temp, source_data['Max'])
-          source_data['Temps'].append(temp)
-          if alt_max:
-            source_data[alt_max] = max(temp, source_data.get(alt_max, 0))
-
-          # Raise exception if thermal limit reached
-          if exit_on_thermal_limit and section == 'CPUTemps':
-            if source_data['Current'] >= CPU_CRITICAL_TEMP:
-              raise ThermalLimitReachedError('CPU temps reached limit')
+    for section, _, source, source_data in self.sources:
+      cmd = ['smc', '-k', source_data['Label'], '-r']
+      proc = run_program(cmd)
+      match = SMC_REGEX.match(proc.stdout.strip())
+      try:
+        temp = float(match.group('Value'))
+      except (TypeError, ValueError):
+        LOG.error('Failed to update temp %s', source_data['Label'])
+        continue
+
+      # Update source
+      self._add_temp(source_data, temp, alt_max)
+
+      # Raise exception if thermal limit reached (or will be soon)
+      if exit_on_thermal_limit and section == 'CPUTemps':
+        self._check_thermal_limit(source, source_data)
+
+  def uses_hwmon(self):
+    """Check if all temps are read directly from hwmon, returns bool."""
+    return bool(self.sources) and all(
+      'Path' in source_data for _, _, _, source_data in self.sources
+      )
+
+
+class TempHistory():
+  """Object for tracking sensor temps using a fixed-size ring buffer.
+
+  The running stats are updated as temps are added so nothing needs to
+  walk the history. Each temp's timestamp is saved for slope estimates.
+  Labelled windows (e.g. Idle or Sysbench) are saved as positions
+  instead of copies of the temps.
+  """
+  def __init__(self, temp=None, size=SENSORS_HISTORY_SIZE):
+    self.count = 0
+    self.ewma = None
+    self.max = float('-inf')
+    self.min = float('inf')
+    self.temps = array('f', bytes(4 * size))
+    self.times = array('d', bytes(8 * size))
+    self.total = 0.0
+    self.windows = {}
+    if temp is not None:
+      self.append(temp)
+
+  def __iter__(self):
+    """Iterate over saved temps from oldest to newest."""
+    size = len(self.temps)
+    for index in range(max(self.count - size, 0), self.count):
+      yield self.temps[index % size]
+
+  def __len__(self):
+    return min(self.count, len(self.temps))
+
+  def append(self, temp, timestamp=None):
+    """Add temp and update running stats."""
+    if timestamp is None:
+      timestamp = time.monotonic()
+    self.temps[self.count % len(self.temps)] = temp
+    self.times[self.count % len(self.times)] = timestamp
+    self.count += 1
+    self.total += temp
+    self.max = max(self.max, temp)
+    self.min = min(self.min, temp)
+    if self.ewma is None:
+      self.ewma = temp
+    else:
+      self.ewma += SENSORS_EWMA_ALPHA * (temp - self.ewma)
+    for window in self.windows.values():
+      if window['End'] is None:
+        window['Max'] = max(window['Max'], temp)
+
+  def clear(self):
+    """Clear saved temps, stats, and windows."""
+    self.__init__(size=len(self.temps))
+
+  def latest_time(self):
+    """Get timestamp of the newest temp, returns float or None."""
+    if not self.count:
+      return None
+    return self.times[(self.count - 1) % len(self.times)]
+
+  def mean(self, label=None):
+    """Get average temp overall or for the labelled window, returns float.
+
+    NOTE: None is returned if there are no temps.
+    """
+    count, total = self.count, self.total
+    if label:
+      window = self.windows[label]
+      if window['End'] is not None:
+        count, total = window['End'], window['End Total']
+      count -= window['Start']
+      total -= window['Start Total']
+    return total / count if count else None
+
+  def slope(self, seconds):
+    """Get temp slope (per second) over the last N seconds, returns float.
+
+    NOTE: None is returned if there are fewer than three temps.
+    """
+    points = []
+    size = len(self.temps)
+    for index in range(self.count - 1, max(self.count - size, 0) - 1, -1):
+      timestamp = self.times[index % size]
+      if points and points[0][0] - timestamp > seconds:
+        break
+      points.append((timestamp, self.temps[index % size]))
+    if len(points) < 3:
+      return None
+
+    # Least squares fit
+    mean_time = sum(point[0] for point in points) / len(points)
+    mean_temp = sum(point[1] for point in points) / len(points)
+    variance = sum((point[0] - mean_time)**2 for point in points)
+    if not variance:
+      return None
+    covariance = sum(
+      (point[0] - mean_time) * (point[1] - mean_temp) for point in points
+      )
+    return covariance / variance
+
+  def start_window(self, label):
+    """Start labelled window at the current position."""
+    self.windows[label] = {
+      'End': None,
+      'End Total': None,
+      'Max': float('-inf'),
+      'Start': self.count,
+      'Start Total': self.total,
+      }
+
+  def stop_window(self, label):
+    """Stop labelled window at the current position."""
+    self.windows[label]['End'] = self.count
+    self.windows[label]['End Total'] = self.total
+
+  def window_max(self, label):
+    """Get max temp for the labelled window, returns float."""
+    return self.windows[label]['Max']
 
 
 # Functions
@@ -292,8 +548,96 @@ def get_sensor_data():
   return sensor_data
 
 
+def get_hwmon_chip_name(hwmon_dir):
+  """Get lm_sensors style chip name for hwmon_dir, returns str.
+
+  NOTE: This follows the libsensors naming scheme, e.g. coretemp-isa-0000,
+        k10temp-pci-00c3, or acpitz-acpi-0.
+  """
+  name = (hwmon_dir / 'name').read_text(encoding='utf-8').strip()
+  device = hwmon_dir / 'device'
+  if not device.exists():
+    return f'{name}-virtual-0'
+
+  # Find bus
+  device = device.resolve()
+  while device != device.parent:
+    subsystem = device / 'subsystem'
+    subsystem = subsystem.resolve().name if subsystem.exists() else None
+    if subsystem == 'pci':
+      match = re.match(
+        r'^([0-9a-f]+):([0-9a-f]+):([0-9a-f]+)\.([0-9a-f])$', device.name,
+        )
+      if match:
+        domain, bus, slot, func = (int(x, 16) for x in match.groups())
+        return f'{name}-pci-{(domain<<16) + (bus<<8) + (slot<<3) + func:04x}'
+    if subsystem == 'i2c':
+      match = re.match(r'^(\d+)-([0-9a-f]+)$', device.name)
+      if match:
+        return f'{name}-i2c-{match.group(1)}-{int(match.group(2), 16):02x}'
+    if subsystem == 'acpi':
+      match = re.match(r'^\w+:(\d+)$', device.name)
+      return f'{name}-acpi-{int(match.group(1)) if match else 0:x}'
+    if subsystem in ('isa', 'platform', 'of_platform'):
+      match = re.match(r'^[a-z0-9_]+\.(\d+)$', device.name)
+      return f'{name}-isa-{int(match.group(1)) if match else 0:04x}'
+
+    # Check parent device (e.g. nvme -> pci)
+    device = device.parent
+
+  # Unknown bus
+  return f'{name}-virtual-0'
+
+
+def get_sensor_data_hwmon():
+  """Get sensor data via hwmon sysfs files, returns dict.
+
+  NOTE: The data is structured like the lm_sensor data.
+  """
+  sensor_data = {'CPUTemps': {}, 'Others': {}}
+  for hwmon_dir in sorted(HWMON_PATH.glob('hwmon*')):
+    try:
+      adapter = get_hwmon_chip_name(hwmon_dir)
+    except OSError:
+      # Skip devices without a name
+      continue
+    section = 'Others'
+    if LM_SENSORS_CPU_REGEX.search(adapter):
+      section = 'CPUTemps'
+
+    # Add temps
+    for input_path in sorted(hwmon_dir.glob('temp*_input')):
+      match = HWMON_TEMP_REGEX.match(input_path.name)
+      if not match:
+        continue
+      label_path = input_path.with_name(f'temp{match.group(1)}_label')
+      try:
+        source = f'temp{match.group(1)}'
+        if label_path.exists():
+          source = label_path.read_text(encoding='utf-8').strip()
+        temp = int(input_path.read_text(encoding='utf-8')) / 1000
+      except (OSError, ValueError):
+        # Skip unreadable sensors
+        continue
+      sensor_data[section].setdefault(adapter, {})[source] = {
+        'Current': temp,
+        'Label': input_path.name,
+        'Max': temp,
+        'Path': str(input_path),
+        'Temps': TempHistory(temp),
+        }
+
+  # Done
+  return sensor_data
+
+
 def get_sensor_data_linux():
-  """Get sensor data via lm_sensors, returns dict."""
+  """Get sensor data via hwmon (or lm_sensors), returns dict."""
+  sensor_data = get_sensor_data_hwmon()
+  if any(sensor_data.values()):
+    return sensor_data
+
+  # Fallback to lm_sensors
   raw_lm_sensor_data = get_sensor_data_lm()
   sensor_data = {'CPUTemps': {}, 'Others': {}}
 
@@ -317,7 +661,7 @@ def get_sensor_data_linux():
             'Current': temp,
             'Label': label,
             'Max': temp,
-            'Temps': [temp],
+            'Temps': TempHistory(temp),
             }
 
     # Remove empty adapters
@@ -401,7 +745,7 @@ def get_sensor_data_macos():
         'Current': value,
         'Label': sensor_id,
         'Max': value,
-        'Temps': [value],
+        'Temps': TempHistory(value),
         }
 
   # Done
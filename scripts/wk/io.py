@@ -1,15 +1,151 @@
 """WizardKit: I/O Functions"""
 # vim: sts=2 sw=2 ts=2
 
+import ctypes
+import ctypes.util
 import logging
 import os
 import pathlib
 import re
+import select
 import shutil
+import struct
+import time
 
 
 # STATIC VARIABLES
 LOG = logging.getLogger(__name__)
+INOTIFY_EVENT_STRUCT = struct.Struct('iIII')
+INOTIFY_IN_CLOSE_WRITE = 0x00000008
+INOTIFY_IN_MOVED_TO = 0x00000080
+INOTIFY_IN_CREATE = 0x00000100
+INOTIFY_IN_Q_OVERFLOW = 0x00004000
+
+
+# Classes
+class FileWatcher():
+  """Class to wait for files to be (re)written.
+
+  inotify is used if available, otherwise the files are polled using
+  stat() every poll_interval seconds.
+
+  NOTE: The parent directories are watched so files that are replaced
+        (e.g. via os.replace()) are still tracked.
+  """
+  def __init__(self, *paths, poll_interval=1):
+    self.paths = [pathlib.Path(path).resolve() for path in paths]
+    self.poll_interval = poll_interval
+    self._fd = None
+    self._stats = {}
+    self._init_inotify()
+    self._update_stats()
+
+  def _init_inotify(self):
+    """Setup inotify watches if possible."""
+    mask = INOTIFY_IN_CLOSE_WRITE | INOTIFY_IN_CREATE | INOTIFY_IN_MOVED_TO
+    try:
+      libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+      inotify_fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (AttributeError, OSError):
+      LOG.warning('inotify not available, falling back to polling')
+      return
+    if inotify_fd < 0:
+      LOG.warning('Failed to init inotify, falling back to polling')
+      return
+
+    # Watch parent dirs
+    for parent in {path.parent for path in self.paths}:
+      if libc.inotify_add_watch(inotify_fd, bytes(parent), mask) < 0:
+        LOG.warning('Failed to watch %s, falling back to polling', parent)
+        os.close(inotify_fd)
+        return
+    self._fd = inotify_fd
+
+  def _read_events(self):
+    """Read pending inotify events, returns bool.
+
+    NOTE: True is returned if any watched file was written.
+    """
+    changed = False
+    names = {path.name.encode() for path in self.paths}
+    while True:
+      try:
+        buf = os.read(self._fd, 4096)
+      except BlockingIOError:
+        break
+      offset = 0
+      while offset < len(buf):
+        _, mask, _, name_len = INOTIFY_EVENT_STRUCT.unpack_from(buf, offset)
+        offset += INOTIFY_EVENT_STRUCT.size
+        name = buf[offset:offset+name_len].rstrip(b'\0')
+        offset += name_len
+        if mask & INOTIFY_IN_Q_OVERFLOW or name in names:
+          changed = True
+
+    # Done
+    return changed
+
+  def _update_stats(self):
+    """Update stat details for all paths, returns bool.
+
+    NOTE: True is returned if any details changed.
+    """
+    changed = False
+    for path in self.paths:
+      try:
+        stat = path.stat()
+        details = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+      except FileNotFoundError:
+        details = None
+      if self._stats.get(path, None) != details:
+        changed = True
+        self._stats[path] = details
+
+    # Done
+    return changed
+
+  def close(self):
+    """Stop watching files."""
+    if self._fd is not None:
+      os.close(self._fd)
+      self._fd = None
+
+  def uses_inotify(self):
+    """Check if inotify is being used, returns bool."""
+    return self._fd is not None
+
+  def wait(self, timeout=None, fds=()):
+    """Wait for a watched file to be written, returns bool.
+
+    fds can list other file descriptors (e.g. a pidfd) that end the
+    wait early once they're ready to read. They aren't read here.
+
+    NOTE: False is returned if the timeout expired (or one of fds is
+          ready) without any changes.
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    if self._fd is not None:
+      while True:
+        remaining = None
+        if deadline is not None:
+          remaining = max(deadline - time.monotonic(), 0)
+        ready = select.select([self._fd, *fds], [], [], remaining)[0]
+        if self._fd in ready and self._read_events():
+          return True
+        if ready != [self._fd]:
+          return False
+
+    # Poll files
+    while True:
+      if self._update_stats():
+        return True
+      remaining = self.poll_interval
+      if deadline is not None:
+        remaining = min(remaining, deadline - time.monotonic())
+        if remaining <= 0:
+          return False
+      if select.select(list(fds), [], [], remaining)[0]:
+        return self._update_stats()
 
 
 # Functions
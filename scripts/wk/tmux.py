@@ -1,37 +1,198 @@
 """WizardKit: tmux Functions"""
 # vim: sts=2 sw=2 ts=2
 
+import atexit
 import logging
+import os
 import pathlib
+import queue
+import shlex
+import subprocess
+import threading
 
-from wk.exe import run_program
-from wk.std import PLATFORM
+from wk.exe import run_program, start_thread
+from wk.std import PLATFORM, sleep
 
 
 # STATIC_VARIABLES
 LOG = logging.getLogger(__name__)
+# NOTE: ignore-size and no-output require tmux 3.2 or newer
+CONTROL_CLIENT = {'Client': None, 'Failed': False}
+CONTROL_CLIENT_FLAGS = 'ignore-size,no-output'
+CONTROL_CLIENT_LOCK = threading.Lock()
+CONTROL_CLIENT_TIMEOUT = 5
+# NOTE: Layout changes are handled once things settle for this long
+LAYOUT_DEBOUNCE = 0.25
+LAYOUT_NOTIFICATIONS = ('%layout-change', '%exit')
+LAYOUT_POLL_INTERVAL = 1
+
+
+# Classes
+class ControlClient():
+  """Class for running tmux commands using a control mode client.
+
+  Commands are written to a single long-lived `tmux -C` process and the
+  responses are read back in order by a background thread.
+
+  NOTE: Notifications (e.g. %layout-change) are passed to any listeners
+        from the reader thread so listeners must not run tmux commands.
+  """
+  def __init__(self, target=None):
+    self.exited = False
+    self.listeners = []
+    self.lock = threading.Lock()
+    self.responses = queue.Queue()
+
+    # Start client
+    cmd = ['tmux', '-C', 'attach-session', '-f', CONTROL_CLIENT_FLAGS]
+    if target:
+      cmd.extend(['-t', target])
+    self.proc = subprocess.Popen( # pylint: disable=consider-using-with
+      cmd,
+      stdin=subprocess.PIPE,
+      stdout=subprocess.PIPE,
+      stderr=subprocess.DEVNULL,
+      encoding='utf-8',
+      errors='replace',
+      )
+    self.thread = start_thread(self._read_output)
+    self._wait_until_ready()
+
+  def _read_output(self):
+    """Read output from client and save responses or notify listeners."""
+    block = None
+    block_fields = None
+    for line in self.proc.stdout:
+      line = line.rstrip('\n')
+      fields = line.split(' ')
+      if block is not None:
+        if fields[0] in ('%end', '%error') and fields[2:] == block_fields:
+          # NOTE: Only blocks flagged as from this client are responses
+          if block_fields[1:] != ['0']:
+            self.responses.put((fields[0] == '%end', block))
+          block = None
+        else:
+          block.append(line)
+      elif fields[0] == '%begin':
+        block = []
+        block_fields = fields[2:]
+      elif line.startswith('%'):
+        self._notify(line)
+
+    # Client exited, unblock any waiting requests and listeners
+    self.exited = True
+    self.responses.put(None)
+    self._notify('%exit')
+
+  def _notify(self, line):
+    """Pass notification line to listeners."""
+    for listener in list(self.listeners):
+      try:
+        listener(line)
+      except Exception: # pylint: disable=broad-except
+        LOG.exception('tmux notification listener failed: %s', line)
+
+  def _wait_until_ready(self):
+    """Wait until client responds to commands."""
+    token = f'wk-control-client-{os.getpid()}'
+    try:
+      self.proc.stdin.write(f'display-message -p {token}\n')
+      self.proc.stdin.flush()
+    except OSError as err:
+      self.stop()
+      raise RuntimeError('Failed to start tmux control client') from err
+    while True:
+      try:
+        response = self.responses.get(timeout=CONTROL_CLIENT_TIMEOUT)
+      except queue.Empty:
+        response = None
+      if response is None:
+        self.stop()
+        raise RuntimeError('Failed to start tmux control client')
+      if response == (True, [token]):
+        break
+
+  def add_listener(self, listener):
+    """Add function to call with each notification line."""
+    self.listeners.append(listener)
+
+  def is_running(self):
+    """Check if client is still running, returns bool."""
+    return not self.exited and self.proc.poll() is None
+
+  def remove_listener(self, listener):
+    """Remove notification listener."""
+    try:
+      self.listeners.remove(listener)
+    except ValueError:
+      # Already removed
+      pass
+
+  def run(self, *cmds):
+    """Run tmux command(s), returns list of str.
+
+    All commands are sent at once and the output for each is returned
+    in order. Commands that fail return an empty str like
+    run_program(cmd, check=False) would.
+
+    NOTE: OSError is raised if the commands couldn't be sent and
+          RuntimeError is raised if the responses weren't received.
+          ValueError is raised for empty commands or arguments with
+          newlines since tmux reads each line as a separate command.
+    """
+    results = []
+    for cmd in cmds:
+      if not cmd or any('\n' in str(arg) for arg in cmd):
+        raise ValueError(f'Invalid cmd for tmux control client: {cmd}')
+    with self.lock:
+      self.proc.stdin.write(''.join(f'{shlex.join(cmd)}\n' for cmd in cmds))
+      self.proc.stdin.flush()
+
+      # Get responses
+      for cmd in cmds:
+        try:
+          response = self.responses.get(timeout=CONTROL_CLIENT_TIMEOUT)
+        except queue.Empty:
+          response = None
+        if response is None:
+          self.stop()
+          raise RuntimeError('tmux control client stopped responding')
+        success, lines = response
+        if not success:
+          LOG.debug('tmux cmd failed: %s, output: %s', cmd, lines)
+        results.append('\n'.join(lines) if success else '')
+
+    # Done
+    return results
+
+  def stop(self):
+    """Stop client."""
+    try:
+      self.proc.stdin.close()
+    except OSError:
+      # Assuming client already exited
+      pass
+    try:
+      self.proc.wait(timeout=2)
+    except subprocess.TimeoutExpired:
+      self.proc.kill()
 
 
 # Functions
 def capture_pane(pane_id=None):
   """Capture text from current or target pane, returns str."""
-  cmd = ['tmux', 'capture-pane', '-p']
-  if pane_id:
-    cmd.extend(['-t', pane_id])
+  cmd = ['tmux', 'capture-pane', '-p', *get_target_args(pane_id)]
 
   # Capture and return
-  proc = run_program(cmd, check=False)
-  return proc.stdout.strip()
+  return run_tmux(cmd)[0].strip()
 
 
 def clear_pane(pane_id=None):
   """Clear pane buffer for current or target pane."""
-  cmd = ['tmux', 'send-keys', '-R']
-  if pane_id:
-    cmd.extend(['-t', pane_id])
+  cmd = ['tmux', 'send-keys', '-R', *get_target_args(pane_id)]
 
   # Clear pane
-  run_program(cmd, check=False)
+  run_tmux(cmd)
 
 
 def fix_layout(panes, layout, forced=False):
@@ -41,6 +202,7 @@ def fix_layout(panes, layout, forced=False):
     return
 
   # Update panes
+  cmds = []
   for name, data in layout.items():
     # Skip missing panes
     if name not in panes:
@@ -54,51 +216,138 @@ def fix_layout(panes, layout, forced=False):
       if name == 'Current':
         pane_id = None
       try:
-        resize_pane(pane_id, **data)
+        cmds.append(get_resize_cmd(pane_id, **data))
       except RuntimeError:
         # Assuming pane was closed just before resizing
         pass
 
+  # Resize all panes at once
+  if cmds:
+    run_tmux(*cmds)
+
+
+def get_control_client():
+  """Get shared control mode client, returns ControlClient or None.
+
+  NOTE: None is returned if not running inside tmux or if control mode
+        isn't available (e.g. tmux is older than 3.2).
+  """
+  with CONTROL_CLIENT_LOCK:
+    client = CONTROL_CLIENT['Client']
+    if not (client or CONTROL_CLIENT['Failed'] or 'TMUX' not in os.environ):
+      # NOTE: Attaching to a pane would select its window so the session
+      #       is used instead
+      session_id = None
+      if 'TMUX_PANE' in os.environ:
+        cmd = [
+          'tmux', 'display-message', '-p',
+          '-t', os.environ['TMUX_PANE'], '#{session_id}',
+          ]
+        session_id = run_program(cmd, check=False).stdout.strip() or None
+      try:
+        client = ControlClient(target=session_id)
+      except (OSError, RuntimeError):
+        LOG.warning('tmux control mode not available, using subprocesses')
+        CONTROL_CLIENT['Failed'] = True
+      else:
+        atexit.register(client.stop)
+        CONTROL_CLIENT['Client'] = client
+    if client and not client.is_running():
+      LOG.warning('tmux control client exited, using subprocesses')
+      CONTROL_CLIENT['Client'] = None
+      CONTROL_CLIENT['Failed'] = True
+      client = None
+
+  # Done
+  return client
+
 
 def get_pane_size(pane_id=None):
   """Get current or target pane size, returns tuple."""
-  cmd = ['tmux', 'display', '-p']
-  if pane_id:
-    cmd.extend(['-t', pane_id])
-  cmd.append('#{pane_width} #{pane_height}')
+  size = get_pane_sizes(pane_id)[0]
+  if not size:
+    raise ValueError(f'Failed to get pane size: {pane_id}')
+  return size
+
 
-  # Get resolution
-  proc = run_program(cmd, check=False)
-  width, height = proc.stdout.strip().split()
-  width = int(width)
-  height = int(height)
+def get_pane_sizes(*pane_ids):
+  """Get sizes for pane(s) using a single request, returns list.
+
+  NOTE: None is used for any panes that weren't found.
+  """
+  sizes = []
+  cmds = [
+    ['tmux', 'display', '-p', *get_target_args(pane_id),
+     '#{pane_width} #{pane_height}']
+    for pane_id in pane_ids
+    ]
+
+  # Get resolutions
+  for output in run_tmux(*cmds):
+    try:
+      width, height = output.strip().split()
+      sizes.append((int(width), int(height)))
+    except ValueError:
+      sizes.append(None)
 
   # Done
-  return (width, height)
+  return sizes
+
+
+def get_resize_cmd(pane_id=None, width=None, height=None, **kwargs):
+  # pylint: disable=unused-argument
+  """Get cmd to resize current or target pane, returns list.
+
+  NOTE: kwargs is only here to make calling this function easier
+        by dropping any extra kwargs passed.
+  """
+  cmd = ['tmux', 'resize-pane', *get_target_args(pane_id)]
+
+  # Safety checks
+  if not (width or height):
+    LOG.error('Neither width nor height specified')
+    raise RuntimeError('Neither width nor height specified')
+
+  # Finish building cmd
+  if width:
+    cmd.extend(['-x', str(width)])
+  if height:
+    cmd.extend(['-y', str(height)])
+
+  # Done
+  return cmd
+
+
+def get_target_args(pane_id=None):
+  """Get target args for the current or target pane, returns list.
+
+  NOTE: The current pane is set explicitly since the control mode
+        client doesn't share this process's current pane.
+  """
+  pane_id = pane_id or os.environ.get('TMUX_PANE')
+  return ['-t', pane_id] if pane_id else []
 
 
 def kill_all_panes(pane_id=None):
   """Kill all panes except for the current or target pane."""
-  cmd = ['tmux', 'kill-pane', '-a']
-  if pane_id:
-    cmd.extend(['-t', pane_id])
+  cmd = ['tmux', 'kill-pane', '-a', *get_target_args(pane_id)]
 
   # Kill
-  run_program(cmd, check=False)
+  run_tmux(cmd)
 
 
 def kill_pane(*pane_ids):
   """Kill pane(s) by id."""
   cmd = ['tmux', 'kill-pane', '-t']
 
-  # Iterate over all passed pane IDs
-  for pane_id in pane_ids:
-    run_program(cmd+[pane_id], check=False)
+  # Kill all passed pane IDs at once
+  if pane_ids:
+    run_tmux(*[cmd+[pane_id] for pane_id in pane_ids])
 
 
 def layout_needs_fixed(panes, layout):
   """Check if layout needs fixed, returns bool."""
-  needs_fixed = False
+  checks = []
 
   # Check panes
   for name, data in layout.items():
@@ -110,32 +359,50 @@ def layout_needs_fixed(panes, layout):
     if name not in panes:
       continue
 
-    # Check pane size(s)
+    # Queue pane size check(s)
     pane_list = panes[name]
     if isinstance(pane_list, str):
       pane_list = [pane_list]
     for pane_id in pane_list:
-      try:
-        width, height = get_pane_size(pane_id)
-      except ValueError:
-        # Pane may have disappeared during this loop
-        continue
-      if data.get('width', False) and data['width'] != width:
-        needs_fixed = True
-      if data.get('height', False) and data['height'] != height:
-        needs_fixed = True
+      checks.append((pane_id, data))
+
+  # Check all pane sizes at once
+  sizes = get_pane_sizes(*[pane_id for pane_id, _ in checks]) if checks else []
+  for (_, data), size in zip(checks, sizes):
+    if not size:
+      # Pane may have disappeared during this check
+      continue
+    width, height = size
+    if data.get('width', False) and data['width'] != width:
+      return True
+    if data.get('height', False) and data['height'] != height:
+      return True
 
   # Done
-  return needs_fixed
+  return False
+
+
+def new_window(name=None, detached=True, **action):
+  """Create new tmux window, run action, and return window_id as str."""
+  cmd = ['tmux', 'new-window', '-PF', '#{window_id}']
+  if detached:
+    cmd.append('-d')
+  if name:
+    cmd.extend(['-n', name])
+
+  # New window action
+  cmd.extend(prep_action(**action))
+
+  # Run and return window_id
+  return run_tmux(cmd)[0].strip()
 
 
 def poll_pane(pane_id):
   """Check if pane exists, returns bool."""
-  cmd = ['tmux', 'list-panes', '-F', '#D']
+  cmd = ['tmux', 'list-panes', *get_target_args(), '-F', '#D']
 
   # Get list of panes
-  proc = run_program(cmd, check=False)
-  existant_panes = proc.stdout.splitlines()
+  existant_panes = run_tmux(cmd)[0].splitlines()
 
   # Check if pane exists
   return pane_id in existant_panes
@@ -209,23 +476,7 @@ def resize_pane(pane_id=None, width=None, height=None, **kwargs):
   NOTE: kwargs is only here to make calling this function easier
         by dropping any extra kwargs passed.
   """
-  cmd = ['tmux', 'resize-pane']
-
-  # Safety checks
-  if not (width or height):
-    LOG.error('Neither width nor height specified')
-    raise RuntimeError('Neither width nor height specified')
-
-  # Finish building cmd
-  if pane_id:
-    cmd.extend(['-t', pane_id])
-  if width:
-    cmd.extend(['-x', str(width)])
-  if height:
-    cmd.extend(['-y', str(height)])
-
-  # Resize
-  run_program(cmd, check=False)
+  run_tmux(get_resize_cmd(pane_id, width=width, height=height))
 
 
 def split_window(
@@ -247,8 +498,7 @@ def split_window(
     cmd.append('-v')
   else:
     cmd.append('-h')
-  if target_id:
-    cmd.extend(['-t', target_id])
+  cmd.extend(get_target_args(target_id))
 
   # New pane size
   if lines:
@@ -260,8 +510,7 @@ def split_window(
   cmd.extend(prep_action(**action))
 
   # Run and return pane_id
-  proc = run_program(cmd, check=False)
-  return proc.stdout.strip()
+  return run_tmux(cmd)[0].strip()
 
 
 def respawn_pane(pane_id, **action):
@@ -270,17 +519,78 @@ def respawn_pane(pane_id, **action):
   cmd.extend(prep_action(**action))
 
   # Respawn
-  run_program(cmd, check=False)
+  run_tmux(cmd)
+
+
+def run_tmux(*cmds):
+  """Run tmux command(s), returns list of str.
+
+  NOTE: The shared control mode client is used if possible so all cmds
+        are sent in a single round trip. Otherwise each cmd is run in
+        its own subprocess.
+  """
+  client = get_control_client()
+  if client:
+    try:
+      return client.run(*[cmd[1:] for cmd in cmds])
+    except ValueError:
+      # Multi-line text (e.g. pane titles) can't be sent over control mode
+      LOG.debug('Running cmds in subprocesses: %s', cmds)
+    except OSError:
+      # Client exited before cmds were sent, safe to run them below
+      LOG.warning('Failed to send cmds to tmux control client')
+    except RuntimeError:
+      LOG.error('No response from tmux control client for cmds: %s', cmds)
+      return ['' for _ in cmds]
+
+  # Fallback
+  return [run_program(cmd, check=False).stdout for cmd in cmds]
+
+
+def watch_layout(fix_function):
+  """Call fix_function whenever the layout may need fixed, never returns.
+
+  With the control mode client this waits for %layout-change
+  notifications (sent when a window is resized or a pane is split or
+  exits) and calls fix_function once after they stop for
+  LAYOUT_DEBOUNCE seconds. Otherwise fix_function is called every
+  LAYOUT_POLL_INTERVAL seconds.
+
+  NOTE: This should be called as a thread.
+  """
+  client = get_control_client()
+  if client:
+    changed = threading.Event()
+
+    def _check_notification(line):
+      """Flag layout changes."""
+      if line.startswith(LAYOUT_NOTIFICATIONS):
+        changed.set()
+
+    # Wait for changes
+    client.add_listener(_check_notification)
+    changed.set()
+    while client.is_running():
+      changed.wait()
+      changed.clear()
+      while changed.wait(LAYOUT_DEBOUNCE):
+        changed.clear()
+      fix_function()
+    client.remove_listener(_check_notification)
+    LOG.warning('tmux control client exited, polling layout instead')
+
+  # Fallback
+  while True:
+    fix_function()
+    sleep(LAYOUT_POLL_INTERVAL)
 
 
 def zoom_pane(pane_id=None):
   """Toggle zoom status for current or target pane."""
-  cmd = ['tmux', 'resize-pane', '-Z']
-  if pane_id:
-    cmd.extend(['-t', pane_id])
+  cmd = ['tmux', 'resize-pane', '-Z', *get_target_args(pane_id)]
 
   # Toggle
-  run_program(cmd, check=False)
+  run_tmux(cmd)
 
 
 if __name__ == '__main__':